@@ -0,0 +1,263 @@
+# Offline benchmark for the PLLM pipeline
+# Runs TestExecutor over a fixed, stratified subset of hard-gists.tar.gz with stand-ins for Ollama, Docker and PyPI
+# (see helpers/fake_backends.py), so throughput can be measured on a laptop with no network.
+# LLM responses come from recordings of a live model (captured with --record), prompts that weren't recorded get
+# synthetic heuristic answers, the report says how many of each there were.
+# Must be run from the tools/pllm folder, like test_executor.py
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import redirect_stdout
+
+from test_executor import TestExecutor
+from helpers.ollama_helper_base import OllamaHelperBase
+from helpers.ollama_helper_tester import OllamaHelper, preload_prompts
+from helpers.fake_backends import RecordedModel, SimulatedDockerHelper, LocalPyPIQuery
+from helpers.gist_archive import GistArchive
+from helpers.tracer import tracer, summarise_events
+from helpers.llm_metrics import llm_metrics, summarise_calls
+from helpers.log_excerpt import POLICIES
+
+# Stages reported by the benchmark, taken from the tracing spans. Stages can nest
+# (get_module_specifics contains query_module and get_module_versions, process_error contains every process_error:<type>)
+STAGES = ['evaluate_file', 'get_module_specifics', 'query_module', 'get_module_versions', 'create_dockerfile',
+          'build_dockerfile', 'run_container_test', 'process_error', 'end_test']
+
+
+class Benchmark():
+    def __init__(self, archive, results_csv, work_dir, sample_size=30, search_range=0, end_loop=5, recordings=None,
+                 docker_script=None, pypi_fixture=None, latency_scale=0.01, llm_latency=0.0, excerpt_policy='decisive', live_model=None, verbose=False) -> None:
+        self.archive = GistArchive(archive)
+        self.results_csv = results_csv
+        self.work_dir = work_dir
+        self.sample_size = sample_size
+        self.search_range = search_range
+        self.end_loop = end_loop
+        self.recordings = recordings
+        self.docker_script = SimulatedDockerHelper.load_script(docker_script) if docker_script else {}
+        self.pypi_fixture = pypi_fixture
+        self.latency_scale = latency_scale
+        self.llm_latency = llm_latency
+        # Record mode: prompts that weren't recorded go to this model and their responses are saved to the recordings
+        self.live_model = live_model
+        self.excerpt_policy = excerpt_policy
+        self.excerpt_stats = {'logs': 0, 'raw_chars': 0, 'excerpt_chars': 0}
+        # Spans and LLM calls of the whole run, taken off the tracer and LLM metrics as each version finishes
+        self.events = []
+        self.calls = []
+        self.verbose = verbose
+
+    # Selects a fixed subset of snippets, stratified by the Python version and result of the original PLLM runs
+    # Each stratum is ordered by a hash of the snippet name so the subset is the same on every machine
+    def select_snippets(self, available):
+        def name_key(name):
+            return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+        strata = defaultdict(list)
+        if self.results_csv and os.path.isfile(self.results_csv):
+            with open(self.results_csv, 'r') as file:
+                for row in csv.DictReader(file):
+                    if row['name'] in available:
+                        python_version = row['file'].replace('output_data_', '').replace('.yml', '')
+                        strata[(python_version, row['result'])].append(row['name'])
+        if not strata:
+            strata[('unknown', 'unknown')] = list(available)
+
+        total = sum(len(names) for names in strata.values())
+        sample_size = min(self.sample_size, total)
+
+        # Proportional allocation, remainder goes to the strata with the largest fractional share
+        allocation = {}
+        remainders = []
+        for key, names in strata.items():
+            share = sample_size * len(names) / total
+            allocation[key] = int(share)
+            remainders.append((share - int(share), len(names), key))
+        for _, _, key in sorted(remainders, reverse=True)[:sample_size - sum(allocation.values())]:
+            allocation[key] += 1
+
+        selected = []
+        for key in sorted(strata):
+            selected += sorted(set(strata[key]), key=name_key)[:allocation[key]]
+        return selected
+
+    # Writes just the selected snippet files into the work folder
+    def extract_snippets(self, names):
+        files = []
+        for name, source in self.archive.snippets(names):
+            files.append(self.archive.write_snippet(self.work_dir, name, source))
+        return sorted(files)
+
+    # Builds a TestExecutor wired up to the stand-in backends
+    def create_executor(self, file, model):
+        file_path = '/'.join(file.split('/')[:-1])
+        pypi = LocalPyPIQuery(logging=False, base_modules=file_path+"/modules", fixture_file=self.pypi_fixture)
+        ollama_helper = OllamaHelper(logging=False, base_modules=file_path+"/modules", llm=model, pypi=pypi, excerpt_policy=self.excerpt_policy)
+
+        def backend(logging=False):
+            return SimulatedDockerHelper(logging=logging, script=self.docker_script, latency_scale=self.latency_scale)
+
+        return TestExecutor(logging=False, end_loop=self.end_loop, search_range=self.search_range, base_modules=file_path+"/modules",
+                            ollama_helper=ollama_helper, pypi=pypi, backend=backend)
+
+    # Moves what the tracer and LLM metrics have recorded onto the run, so each export only holds its own version,
+    # like the forked processes of a real run, rather than everything since the benchmark started
+    def collect(self):
+        self.events += tracer.drain()
+        self.calls += llm_metrics.drain()
+
+    # Runs one snippet through the same steps as test_executor.main, one Python version after another
+    # end_test exits when a run is finished, so SystemExit marks the end of each version
+    def run_snippet(self, file, model):
+        executor = self.create_executor(file, model)
+        llm_eval = executor.initial_evaluation(file)
+        self.collect()
+        python_versions = executor.pypi.get_python_range(python_version=llm_eval['python_version'], pyrange=self.search_range)
+        for i in range(0, (self.search_range * 2) + 1):
+            run_details = llm_eval.copy()
+            run_details['python_version'] = python_versions[i]
+            try:
+                executor.docker_create_process(executor.ollama_helper, run_details, file, i)
+            except SystemExit:
+                pass
+            self.collect()
+        for key, value in executor.ollama_helper.excerpter.stats.items():
+            self.excerpt_stats[key] += value
+
+    def run(self):
+        available = set(self.archive.names())
+        names = self.select_snippets(available)
+        files = self.extract_snippets(names)
+        model = RecordedModel(recordings_file=self.recordings, latency=self.llm_latency, live_model=self.live_model)
+        tracer.enabled = True
+        tracer.reset()
+        llm_metrics.enabled = True
+        llm_metrics.reset()
+        self.events = []
+        self.calls = []
+        # Loaded before the clock starts, as test_executor does before forking its workers
+        preload_prompts()
+
+        start = time.perf_counter()
+        for file in files:
+            if self.verbose:
+                self.run_snippet(file, model)
+            else:
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    self.run_snippet(file, model)
+        wall_time = time.perf_counter() - start
+        if self.live_model is not None: model.save_recordings()
+
+        summary = summarise_events(self.events)
+        # Roll the process_error:<error type> branches up into a single stage
+        stages = {stage: {'wall_time': summary.get(stage, {}).get('total', 0.0), 'calls': summary.get(stage, {}).get('count', 0)} for stage in STAGES}
+        for name, details in summary.items():
+            if name.startswith('process_error:'):
+                stages['process_error']['wall_time'] += details['total']
+                stages['process_error']['calls'] += details['count']
+                stages[name] = {'wall_time': details['total'], 'calls': details['count']}
+
+        return {
+            'snippets': len(files),
+            'python_versions_per_snippet': (self.search_range * 2) + 1,
+            'wall_time': wall_time,
+            'snippets_per_hour': len(files) / wall_time * 3600 if wall_time > 0 else 0,
+            'iterations_per_snippet': stages['end_test']['calls'] / len(files) if files else 0,
+            'llm_calls': model.calls,
+            'llm_recorded_hits': model.hits,
+            'llm_live_calls': model.live_calls,
+            'llm_synthetic_calls': model.synthetic_calls,
+            'llm_call_sites': summarise_calls(self.calls),
+            'log_excerpt': dict(self.excerpt_stats, policy=self.excerpt_policy),
+            'stages': stages,
+        }
+
+
+# Prints the report as a table
+def print_report(report):
+    print(f"Snippets: {report['snippets']} | Wall time: {report['wall_time']:.2f}s | Snippets per hour: {report['snippets_per_hour']:.1f} | Iterations per snippet: {report['iterations_per_snippet']:.2f}")
+    call_sites = report.get('llm_call_sites', {}).values()
+    print(f"LLM calls: {report['llm_calls']} ({report['llm_recorded_hits']} recorded, {report.get('llm_live_calls', 0)} live, {report.get('llm_synthetic_calls', 0)} synthetic) | Prompt tokens: {sum(site['prompt_tokens'] for site in call_sites)}"
+          f" | Retries: {sum(site['retries'] for site in call_sites)} | Parse failures: {sum(site['parse_failures'] for site in call_sites)}")
+    if report.get('llm_synthetic_calls'):
+        print(f"Note: {report['llm_synthetic_calls']} responses were synthetic heuristics, not model behaviour. Record a model's responses with --record")
+    excerpt = report.get('log_excerpt', {})
+    if excerpt.get('raw_chars'):
+        print(f"Log excerpts ({excerpt['policy']}): {excerpt['logs']} logs, {excerpt['raw_chars']} -> {excerpt['excerpt_chars']} characters"
+              f" ({1 - excerpt['excerpt_chars'] / excerpt['raw_chars']:.0%} smaller)")
+    print(f"{'stage':<32}{'wall time (s)':>15}{'calls':>8}{'share':>8}")
+    for stage, details in report['stages'].items():
+        share = details['wall_time'] / report['wall_time'] * 100 if report['wall_time'] > 0 else 0
+        print(f"{stage:<32}{details['wall_time']:>15.3f}{details['calls']:>8}{share:>7.1f}%")
+
+# Compares snippets per hour against a previous report
+# Returns False if throughput dropped by more than the tolerance (a fraction, e.g. 0.1 for 10%)
+def compare_report(report, baseline_file, tolerance):
+    with open(baseline_file, 'r') as file:
+        baseline = json.load(file)
+    change = (report['snippets_per_hour'] - baseline['snippets_per_hour']) / baseline['snippets_per_hour'] if baseline['snippets_per_hour'] > 0 else 0
+    print(f"Snippets per hour: {baseline['snippets_per_hour']:.1f} -> {report['snippets_per_hour']:.1f} ({change*100:+.1f}%)")
+    for stage, details in report['stages'].items():
+        if stage in baseline['stages']:
+            print(f"  {stage:<32}{baseline['stages'][stage]['wall_time']:>10.3f}s -> {details['wall_time']:.3f}s")
+    if change < -tolerance:
+        print(f"REGRESSION: throughput dropped by more than {tolerance*100:.0f}%")
+        return False
+    return True
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the PLLM pipeline')
+    parser.add_argument('-a', '--archive', type=str, default='../../hard-gists.tar.gz', help="The hard-gists archive to sample snippets from")
+    parser.add_argument('-c', '--csv', type=str, default='../../pllm_results/csv/summary-all-runs.csv', help="Previous results, used to stratify the sample by Python version and result")
+    parser.add_argument('-n', '--sample', type=int, default=30, help="How many snippets to run, defaults to 30")
+    parser.add_argument('-l', '--loop', type=int, default=5, help="How many times we will loop to find a solution")
+    parser.add_argument('-r', '--range', type=int, default=0, help="The search range, expands out above and below the found Python version, defaults to 0")
+    parser.add_argument('--recordings', type=str, default='helpers/ref_files/benchmark/llm_recordings.json', help="Recorded LLM responses keyed by prompt hash")
+    parser.add_argument('--record', type=str, default=None, help="Send prompts that aren't recorded to this live model (e.g. phi3:medium) and save its responses to --recordings, timings then include its inference")
+    parser.add_argument('--base', type=str, default='http://localhost:11434', help="The Ollama server for --record, defaults to http://localhost:11434")
+    parser.add_argument('--docker-script', type=str, default='helpers/ref_files/benchmark/docker_script.json', help="Simulated Docker latency and failure script")
+    parser.add_argument('--pypi-fixture', type=str, default='helpers/ref_files/benchmark/pypi_metadata.json', help="Local PyPI metadata fixture")
+    parser.add_argument('--latency-scale', type=float, default=0.01, help="Multiplier for the simulated Docker latencies, defaults to 0.01")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="Simulated seconds per LLM call, defaults to 0")
+    parser.add_argument('--excerpt-policy', type=str, choices=POLICIES, default='decisive', help="How logs are cut down for the error prompts (see helpers/log_excerpt.py), defaults to decisive")
+    parser.add_argument('-w', '--work', type=str, default=None, help="Folder to extract snippets into, defaults to a temporary folder which is removed afterwards")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write the report as JSON to this file")
+    parser.add_argument('--trace-out', type=str, default=None, help="Write every span from the run to this Chrome trace file")
+    parser.add_argument('--baseline', type=str, default=None, help="A previous JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed drop in snippets per hour against the baseline, defaults to 0.1 (10%%)")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Show the pipelines own output")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    work_dir = args.work if args.work else tempfile.mkdtemp(prefix='pllm-benchmark-')
+
+    benchmark = Benchmark(args.archive, args.csv, work_dir, sample_size=args.sample, search_range=args.range, end_loop=args.loop,
+                          recordings=args.recordings, docker_script=args.docker_script, pypi_fixture=args.pypi_fixture,
+                          latency_scale=args.latency_scale, llm_latency=args.llm_latency, excerpt_policy=args.excerpt_policy, verbose=args.verbose,
+                          live_model=OllamaHelperBase(base_url=args.base, model=args.record, temp=0.0).model if args.record else None)
+    try:
+        report = benchmark.run()
+    finally:
+        if not args.work: shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.trace_out:
+        with open(args.trace_out, 'w') as file:
+            json.dump({'traceEvents': benchmark.events, 'otherData': {'benchmark': report}}, file)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline and not compare_report(report, args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
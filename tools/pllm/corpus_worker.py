@@ -0,0 +1,123 @@
+# Corpus worker
+# Runs a corpus across several hosts. The snippets are queued once, then a worker on each host (each with its own
+# Docker daemon) claims snippets from the shared queue, resolves them with test_executor and hands the outputs back.
+# A worker keeps its lease on a snippet with heartbeats, a snippet whose worker goes away is picked up by another.
+# See helpers/work_queue.py for the queue itself.
+#
+#   python corpus_worker.py --queue /shared/work_queue.db --enqueue -a hard-gists.tar.gz -g my_gists.csv
+#   python corpus_worker.py --queue /shared/work_queue.db -m phi3:medium -l 10       (on every host)
+#   python -m helpers.work_queue -q /shared/work_queue.db -m ./results                 (merge the results)
+#
+# Every other option (model, executor, loop, range...) is a test_executor flag, used for every snippet the worker runs.
+import argparse
+import os
+import socket
+import threading
+import time
+
+import test_executor
+from helpers.gist_archive import GistArchive
+from helpers.work_queue import WorkQueue
+
+# Queues every snippet in the archive (or those listed with -g), up to -n of them
+def enqueue(queue, args):
+    archive = GistArchive(args.archive)
+    names = None
+    if args.gists:
+        with open(args.gists, 'r') as file:
+            names = [line.strip().split('/')[-1] for line in file if line.strip()]
+    snippets = list(archive.snippets(names))
+    if args.limit: snippets = snippets[:args.limit]
+    return queue.enqueue(snippets)
+
+class CorpusWorker():
+    # args: test_executor arguments used for every snippet
+    # worker: this workers name in the queue, defaults to <host>:<pid>
+    # wait: keep polling an empty queue for this many seconds before stopping, other workers' leases may still run out
+    def __init__(self, queue, args, worker=None, wait=0, logging=False) -> None:
+        self.queue = queue
+        self.args = args
+        self.worker = worker if worker else f"{socket.gethostname()}:{os.getpid()}"
+        self.wait = wait
+        self.logging = logging
+        # Snippets are written to the local results tree like archive mode, <output>/<name>/snippet.py
+        self.archive = GistArchive(None)
+        self.completed = 0
+
+    def run_job(self, job, name):
+        self.archive.clear_results(self.args.output, job['name'])
+        file = self.archive.write_snippet(self.args.output, job['name'], job['source'])
+        print(f"{name} running {job['name']} (attempt {job['attempts']})")
+        # Each snippet runs in its own process, --jobs threads would otherwise share the tracer and LLM metrics
+        try:
+            with self.queue.leased(job['name'], self.worker):
+                error = test_executor.run_snippet_process(self.args, file, base_modules=self.args.modules if self.args.modules else f"{self.args.output}/modules")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        if error:
+            # An error (e.g. run_snippet exiting when no versions are found) hands the snippet back rather than ending the worker
+            self.queue.fail(job['name'], self.worker, error)
+            return
+        if self.queue.complete(job['name'], self.worker, self.archive.read_results(self.args.output, job['name'])):
+            self.completed += 1
+        elif self.logging:
+            print(f"{job['name']} was handed to another worker, dropping these results")
+
+    # Claims and runs snippets until the queue has nothing left
+    def work(self, name=None):
+        name = name if name else self.worker
+        idle_since = None
+        while True:
+            job = self.queue.claim(self.worker)
+            if job is None:
+                idle_since = idle_since if idle_since else time.time()
+                if time.time() - idle_since >= self.wait: break
+                time.sleep(min(10, self.queue.lease / 3))
+                continue
+            idle_since = None
+            self.run_job(job, name)
+
+    # Runs `jobs` snippets at once, each still runs a process per Python version
+    def start(self, jobs=1):
+        threads = [threading.Thread(target=self.work, args=(f"{self.worker}/{i}",)) for i in range(jobs)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+# Handle argument parsing
+# The worker options are long flags only, everything else is passed on to test_executor
+def process_args():
+    parser = argparse.ArgumentParser(description='Runs a corpus from a queue shared by workers on several hosts, other flags are passed to test_executor')
+    parser.add_argument('--queue', type=str, default='./work_queue.db', help="The shared work queue, defaults to ./work_queue.db")
+    parser.add_argument('--enqueue', action="store_true", help="Queue the snippets in the archive given with -a (and -g/-n) and stop")
+    parser.add_argument('--worker', type=str, default=None, help="This workers name in the queue, defaults to <host>:<pid>")
+    parser.add_argument('--jobs', type=int, default=1, help="How many snippets this worker resolves at once, defaults to 1")
+    parser.add_argument('--lease', type=int, default=600, help="Seconds a snippet stays with a worker without a heartbeat, defaults to 600")
+    parser.add_argument('--attempts', type=int, default=3, help="How many times a snippet is handed out before it's marked failed, defaults to 3")
+    parser.add_argument('--wait', type=int, default=0, help="Seconds to keep polling an empty queue for abandoned snippets before stopping, defaults to 0")
+    args, executor_args = parser.parse_known_args()
+    return args, test_executor.process_args(executor_args)
+
+def main():
+    args, executor_args = process_args()
+    queue = WorkQueue(args.queue, lease=args.lease, max_attempts=args.attempts, logging=True)
+    if args.enqueue:
+        print(f"Queued {enqueue(queue, executor_args)} snippets")
+        print(queue.stats())
+        return
+
+    test_executor.preload_workers(executor_args)
+    test_executor.tracer.enabled = executor_args.trace
+    test_executor.llm_metrics.enabled = executor_args.llm_metrics
+    os.makedirs(executor_args.output, exist_ok=True)
+
+    worker = CorpusWorker(queue, executor_args, worker=args.worker, wait=args.wait, logging=executor_args.verbose)
+    try:
+        worker.start(args.jobs)
+    finally:
+        if executor_args.keep_alive:
+            test_executor.OllamaHelperBase(base_url=executor_args.base, model=executor_args.model, logging=True, keep_alive=executor_args.keep_alive).release()
+    print(f"{worker.worker} finished {worker.completed} snippets")
+    print(queue.stats())
+
+if __name__ == "__main__":
+    main()
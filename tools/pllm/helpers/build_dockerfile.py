@@ -1,13 +1,33 @@
 # Helper file to build a docker file based off of our model intuitions
-import docker
+# docker is imported when a DockerHelper is created, so the venv backend and the tools don't need it
+import time
 from time import sleep
+import json
 import os
 import sys
+import tarfile
 # from docker import APIClient
 from io import BytesIO
 
-class DockerHelper():
-    def __init__(self, logging=False, image_name="", dockerfile_name="", container_name = "") -> None:
+from helpers.execution_backend import ExecutionBackend
+from helpers.build_memo import BuildMemo
+from helpers.run_cache import RunCache
+from helpers.image_cache import ImageRetentionManager
+from helpers.wheelhouse import Wheelhouse
+from helpers.resolution_probe import DockerProbe
+
+# Docker execution backend
+# Each snippet/Python version gets its own Dockerfile, image and container
+class DockerHelper(ExecutionBackend):
+    # image_budget: keep finished images under this many bytes of image disk use instead of deleting them (see image_cache.py)
+    # image_state: the shared retention state file
+    # shared_wheels: install from (and add to) a shared wheelhouse served by a local index container (see wheelhouse.py)
+    # build_memo: folder of earlier build outcomes, a Dockerfile that failed before isn't built again (see build_memo.py)
+    # run_cache: folder of earlier run outcomes, a snippet that already ran in an identical image isn't run again (see run_cache.py)
+    # memory_limit: bytes of memory each build and run container may use, cpu_limit: CPUs each run container may use
+    # admission: an AdmissionController every build and run waits on (see resources.py)
+    def __init__(self, logging=False, image_name="", dockerfile_name="", container_name = "", image_budget=None, image_state='./image_cache.json', shared_wheels=False, install_mode='sequential', build_memo=None, run_cache=None, memory_limit=None, cpu_limit=None, admission=None) -> None:
+        super().__init__(logging=logging, install_mode=install_mode, admission=admission)
         # Stores the dockerfile information for output
         self.dockerfile_out = ""
         # The name of the docker image- This is unique based on snippet name and python version
@@ -15,7 +35,17 @@ class DockerHelper():
         # Dockerfile name usually Dockerfile-llm-<python version>
         self.dockerfile_name = dockerfile_name
         self.container_name = container_name
+        # Seconds spent building the current image
+        self.build_time = 0.0
+        # Python version and pins of the current Dockerfile
+        self.python_version = ''
+        self.pins = []
+        # The snippet being built and run
+        self.snippet_file = ''
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
         # Connection for docker client
+        import docker
         try:
             self.client = docker.from_env()
         except docker.errors.DockerException as e:
@@ -41,23 +71,55 @@ class DockerHelper():
                 raise
             else:
                 raise
-        # Logging for output
-        self.logging = logging
-        # When an error occurs, we want to know what it was on a previous run
-        self.previous_error = {"error_message": '', "module": ''}
+        self.retention = ImageRetentionManager(self.client, image_budget, image_state, logging=logging) if image_budget else None
+        self.wheelhouse = Wheelhouse(self.client, logging=logging) if shared_wheels else None
+        self.prober = None
+        self.memo = BuildMemo(build_memo, logging=logging) if build_memo else None
+        self.run_cache = RunCache(run_cache, logging=logging) if run_cache else None
 
     def query_docker(self):
         return self.client.api.images()
 
-    # Breaks down the file path to get the folder and the file name
-    # file: The path to the file
-    def get_project_dir(self, file):
-        split_path = file.split('/')
-        file_path = '/'.join(split_path[:-1])
-        file_name = split_path[-1]
-        dir_name = split_path[-2]
-        return file_path, dir_name, file_name
-    
+    # ExecutionBackend interface
+    def create_environment(self, llm_out, file):
+        self.snippet_file = file
+        self.create_dockerfile(llm_out, file)
+
+    def build_environment(self, file):
+        return self.build_dockerfile(file)
+
+    # With a run cache, a snippet that already ran in an identical image gets the recorded logs back straight away
+    def run_test(self):
+        key = self.run_cache.key(self.snippet_file, self.image_id()) if self.run_cache else None
+        outcome = self.run_cache.lookup(key) if key else None
+        if outcome:
+            if self.logging: print(f"Run cache: {self.snippet_file} already ran in {self.image_name}, using the recorded logs")
+            self.run_cache_hits += 1
+            self.exit_code = outcome['exit_code']
+            return outcome['logs']
+        logs = self.run_container_test()
+        if key:
+            from helpers.ollama_helper_tester import classify_error
+            self.run_cache.record(key, self.exit_code, classify_error(logs), logs)
+        return logs
+
+    # Resolves the pins in a warm pllm-probe-<version> container, using the wheelhouse if there is one
+    def probe_environment(self, llm_out):
+        if self.prober is None:
+            if self.wheelhouse: self.wheelhouse.start()
+            self.prober = DockerProbe(self.client, network=self.wheelhouse.network if self.wheelhouse else None, logging=self.logging)
+        extra_args = self.wheelhouse.pip_args(llm_out['python_version']) if self.wheelhouse else []
+        return self.prober.probe(llm_out['python_version'], self.get_pins(llm_out), extra_args)
+
+    # With a retention budget the image is kept for reuse and the least valuable images are evicted instead
+    def cleanup(self):
+        self.delete_container()
+        if self.retention:
+            self.retention.touch(self.image_name, self.build_time)
+            self.retention.enforce(keep=[self.image_name])
+        else:
+            self.delete_image()
+
     # Creates the dockerfile based on the llm information
     # llm_out: contains the python version and modules
     # file: The provided file with path
@@ -73,22 +135,19 @@ class DockerHelper():
         self.dockerfile_out += f"""# Add install commands for all of the python modules\n"""
         self.dockerfile_out += f"""RUN ["pip","install","--upgrade","pip"]\n"""
         # Loop through the modules and add these to the docker file as pip installs
-        python_modules = llm_out['python_modules']
-        if self.logging: print(python_modules)
-        for module in python_modules:
-            if type(module) == dict:
-                name = module['module']
-                version = module['version']
-            else:
-                name = module
-                version = python_modules[module]
-
-            # if self.logging: print(type(data))
-            # if self.logging: print(data)
-            if type(version) == str:
-                self.dockerfile_out += f"""RUN ["pip","install","--trusted-host","pypi.python.org","--default-timeout=100","{name}=={version}"]\n"""
-            else:
-                self.dockerfile_out += f"""RUN ["pip","install","--trusted-host","pypi.python.org","--default-timeout=100","{name}=={version[0]}"]\n"""
+        if self.logging: print(llm_out['python_modules'])
+        self.python_version = llm_out['python_version']
+        self.pins = self.get_pins(llm_out)
+        # Wheels from the shared wheelhouse are used ahead of PyPI
+        find_links = ''.join(f'"{arg}",' for arg in self.wheelhouse.pip_args(self.python_version)) if self.wheelhouse else ''
+        if self.install_mode == 'single':
+            # One install so pip resolves the whole set together
+            if self.pins:
+                pins = ','.join(f'"{name}=={version}"' for name, version in self.pins)
+                self.dockerfile_out += f"""RUN ["pip","install","--trusted-host","pypi.python.org",{find_links}"--default-timeout=100",{pins}]\n"""
+        else:
+            for name, version in self.pins:
+                self.dockerfile_out += f"""RUN ["pip","install","--trusted-host","pypi.python.org",{find_links}"--default-timeout=100","{name}=={version}"]\n"""
 
         # Copys the snippet to the app dir for running
         self.dockerfile_out += f"""# Copy the specified directory to /app\n"""
@@ -103,17 +162,135 @@ class DockerHelper():
         with open(f"{project_dir}/{self.dockerfile_name}", "w") as file:
             file.write(self.dockerfile_out)
 
+    # The plain text of a chunk of the docker build stream ({"stream": ...} and {"error": ...} objects)
+    def stream_text(self, chunk):
+        text = ''
+        for piece in chunk.splitlines():
+            try:
+                message = json.loads(piece)
+                text += message.get('stream', '') or message.get('error', '') + '\n'
+            except ValueError:
+                text += piece + '\n'
+        return text
+
     # Uses the docker api to build the created dockerfiles
     # Returns true if good and false with the error message if there was an issue
+    # With a build memo, a Dockerfile that already failed on the same base image fails straight away with the same output,
+    # and one that already passed for this snippet reuses its image while it's still on the daemon
     def build_dockerfile(self, path, dockerfile=None):
         if not dockerfile: dockerfile = self.dockerfile_name
+        base_digest = self.base_digest() if self.memo else None
+        # Nothing can have been built on a base image that hasn't been pulled yet
+        if base_digest is None:
+            return self.docker_build(path, dockerfile)
+
+        project_dir, dir_name, project_file = self.get_project_dir(path)
+        with open(f"{project_dir}/{dockerfile}", 'r') as in_file:
+            key = self.memo.key(in_file.read(), base_digest)
+        with open(f"{project_dir}/{project_file}", 'rb') as in_file:
+            snippet = self.memo.snippet_key(in_file.read())
+        # Waits for an identical build already running elsewhere
+        with self.memo.claim(key) as outcome:
+            if outcome and not outcome['passed']:
+                if self.logging: print(f"Build memo: {dockerfile} failed before, skipping the build")
+                self.build_log = outcome['build_log']
+                self.build_time = 0.0
+                return False, outcome['output']
+            if outcome and self.reuse_image(outcome.get('images', {}).get(snippet)):
+                if self.logging: print(f"Build memo: {dockerfile} passed before, reusing its image")
+                self.build_log = outcome['build_log']
+                self.build_time = 0.0
+                return True, outcome['output']
+            passed, output = self.docker_build(path, dockerfile)
+            self.memo.record(key, passed, output, self.build_log, snippet, self.image_id() if passed else None)
+        return passed, output
+
+    # Tags an image an earlier identical build made with this builds image name
+    # False if there isn't one or it's no longer on the daemon
+    def reuse_image(self, image_id):
+        if not image_id: return False
+        try:
+            repository, tag = self.image_name.rsplit(':', 1)
+            return self.client.images.get(image_id).tag(repository, tag)
+        except Exception as e:
+            if self.logging: print(e)
+            return False
+
+    # Image ID of the built image, None if it can't be found
+    def image_id(self):
+        try:
+            return self.client.images.get(self.image_name).id
+        except Exception as e:
+            if self.logging: print(e)
+            return None
+
+    # Image ID of the Python base image, None if it hasn't been pulled
+    def base_digest(self):
+        try:
+            return self.client.images.get(f"python:{self.python_version}").id
+        except Exception:
+            return None
+
+    # Limits for the build containers, docker build only takes a memory limit and a relative CPU share
+    def build_limits(self):
+        limits = {}
+        if self.memory_limit:
+            limits['memory'] = self.memory_limit
+            limits['memswap'] = self.memory_limit
+        if self.cpu_limit:
+            limits['cpushares'] = int(self.cpu_limit * 1024)
+        return limits if limits else None
+
+    # Limits for the run container
+    def run_limits(self):
+        limits = {}
+        if self.memory_limit:
+            limits['mem_limit'] = self.memory_limit
+            limits['memswap_limit'] = self.memory_limit
+        if self.cpu_limit:
+            limits['nano_cpus'] = int(self.cpu_limit * 1e9)
+        return limits
+
+    # The build context as an in-memory tar holding just the Dockerfile and the snippet
+    # Sending the snippets folder would upload the modules catalog, every other Dockerfile and the logs on every build
+    # The entries have a fixed time and owner so an unchanged snippet keeps hitting the COPY layer in the build cache
+    def build_context(self, project_dir, dockerfile, project_file):
+        context = BytesIO()
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            for name in [dockerfile, project_file]:
+                with open(f"{project_dir}/{name}", 'rb') as in_file:
+                    data = in_file.read()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, BytesIO(data))
+        context.seek(0)
+        return context
+
+    def docker_build(self, path, dockerfile):
         error_lines = ""
         project_dir, dir_name, project_file = self.get_project_dir(path)
-        for line in self.client.api.build(path=project_dir, dockerfile=dockerfile, forcerm=True, tag=self.image_name):
-            decoded_line = line.decode('utf-8')
-            if 'ERROR' in decoded_line or 'Could not fetch URL' in decoded_line or 'errorDetail' in decoded_line:
-                error_lines += decoded_line
-            if self.logging: print(decoded_line)
+        start = time.time()
+        self.build_log = ''
+        network_mode = None
+        if self.wheelhouse:
+            # Wheel any new pins first, the build then joins the wheelhouse network to install them
+            # Compiling wheels takes as much memory as a build, so it waits for a slot the same way
+            with self.admit('wheels'):
+                self.wheelhouse.ensure(self.python_version, self.pins)
+            network_mode = self.wheelhouse.network
+        with self.admit('build'):
+            context = self.build_context(project_dir, dockerfile, project_file)
+            for line in self.client.api.build(fileobj=context, custom_context=True, dockerfile=dockerfile, forcerm=True, tag=self.image_name, network_mode=network_mode, container_limits=self.build_limits()):
+                decoded_line = line.decode('utf-8')
+                self.build_log += self.stream_text(decoded_line)
+                # Count the layers that came from the build cache, to measure how well the snippets were scheduled
+                if '"stream":"Step ' in decoded_line: self.cache_steps += 1
+                if 'Using cache' in decoded_line: self.cache_hits += 1
+                if 'ERROR' in decoded_line or 'Could not fetch URL' in decoded_line or 'errorDetail' in decoded_line:
+                    error_lines += decoded_line
+                if self.logging: print(decoded_line)
+        self.build_time = time.time() - start
         
         if error_lines == "":
             return True, ""
@@ -135,28 +312,36 @@ class DockerHelper():
     # Runs the container we built to see if the python snippet runs
     # Returns the logs for analysis
     def run_container_test(self):
+        import docker
         self.delete_container()
-        logs = ''
-        try:
-            self.container = self.client.containers.create(self.image_name, name=self.container_name)
-            self.container.start()
-            sleep(10)
-            while(self.container.status == 'running'):
-                # container.logs()
-                sleep(5)
-            if self.logging: print(self.container.status)
-            logs = self.container.logs()
-            self.container.remove(v=True, force=True)
-            self.container = None
-        except docker.errors.ContainerError as e:
-            if self.logging: print(e)
-            if self.container:
+        self.exit_code = None
+        logs = b''
+        with self.admit('run'):
+            try:
+                self.container = self.client.containers.create(self.image_name, name=self.container_name, **self.run_limits())
+                self.container.start()
+                sleep(10)
                 while(self.container.status == 'running'):
+                    # container.logs()
                     sleep(5)
                 if self.logging: print(self.container.status)
                 logs = self.container.logs()
+                self.container.reload()
+                self.exit_code = self.container.attrs.get('State', {}).get('ExitCode')
+                # Killed for going over --memory-limit, the snippets own output doesn't say so
+                if self.container.attrs.get('State', {}).get('OOMKilled'):
+                    logs += f"\nOOMKilled: the container ran out of memory (exit code {self.exit_code})\n".encode('utf-8')
                 self.container.remove(v=True, force=True)
                 self.container = None
+            except docker.errors.ContainerError as e:
+                if self.logging: print(e)
+                if self.container:
+                    while(self.container.status == 'running'):
+                        sleep(5)
+                    if self.logging: print(self.container.status)
+                    logs = self.container.logs()
+                    self.container.remove(v=True, force=True)
+                    self.container = None
 
         return logs.decode('utf-8')
 
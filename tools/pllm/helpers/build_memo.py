@@ -0,0 +1,94 @@
+# Build outcome memo for the Docker backend
+# The LLM often proposes a pin set that's already been tried, and separate processes or snippets converge on the
+# same pins, so byte identical Dockerfiles get built again and again. Outcomes are kept by a hash of the Dockerfile
+# and the base image digest, one JSON file per key, shared by every process using the same memo folder.
+# A build that failed before fails straight away with the same output. A build that passed records the image it made
+# for the snippet it copied in, the same snippet then gets that image tagged again instead of a build. The image is
+# only built again once it's been deleted or evicted (see image_cache.py).
+# Concurrent identical builds are coalesced, a lock per key lets one run while the others wait for its outcome.
+# Failures that look like network trouble or running out of memory aren't kept, they may well pass next time.
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Output that means the build could fail differently next time
+TRANSIENT = ['Could not fetch URL', 'Read timed out', 'Connection reset', 'Temporary failure in name resolution', 'Max retries exceeded', 'No space left on device', 'returned a non-zero code: 137']
+
+class BuildMemo():
+    # memo_dir: folder holding the outcomes, shared between processes
+    # max_age: seconds an outcome is trusted for, packages are released and yanked over time
+    def __init__(self, memo_dir='./build_memo', max_age=7 * 24 * 3600, logging=False) -> None:
+        self.memo_dir = memo_dir
+        self.max_age = max_age
+        self.logging = logging
+        os.makedirs(memo_dir, exist_ok=True)
+
+    def key(self, dockerfile, base_digest):
+        return hashlib.sha256(f"{base_digest}\n{dockerfile}".encode('utf-8')).hexdigest()
+
+    # Images are kept per snippet, the Dockerfile only names the file it copies in
+    def snippet_key(self, source):
+        return hashlib.sha256(source).hexdigest()
+
+    def path(self, key):
+        return f"{self.memo_dir}/{key}.json"
+
+    # The recorded outcome for a key, None if there isn't one or it's too old
+    def lookup(self, key):
+        try:
+            with open(self.path(key), 'r') as in_file:
+                entry = json.load(in_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('time', 0) > self.max_age: return None
+        return entry
+
+    def transient(self, output):
+        return any(pattern in output for pattern in TRANSIENT)
+
+    # snippet: snippet_key of the snippet built, image_id: the image a passing build made for it
+    def record(self, key, passed, output, build_log='', snippet=None, image_id=None):
+        if not passed and self.transient(output): return
+        entry = {'passed': passed, 'output': output, 'build_log': build_log, 'time': time.time(), 'images': {}}
+        previous = self.lookup(key)
+        if passed and previous and previous['passed']:
+            entry['images'] = previous.get('images', {})
+        if passed and snippet and image_id:
+            entry['images'][snippet] = image_id
+        with open(f"{self.path(key)}.tmp", 'w') as out_file:
+            json.dump(entry, out_file)
+        os.replace(f"{self.path(key)}.tmp", self.path(key))
+
+    # Holds the lock for a key, yielding its recorded outcome once any identical build in progress has finished
+    @contextmanager
+    def claim(self, key):
+        with open(f"{self.path(key)}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield self.lookup(key)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        entries = [self.lookup(os.path.basename(file)[:-len('.json')]) for file in glob.glob(f"{self.memo_dir}/*.json")]
+        entries = [entry for entry in entries if entry]
+        return {'outcomes': len(entries), 'passed': sum(1 for entry in entries if entry['passed']), 'failed': sum(1 for entry in entries if not entry['passed']),
+                'images': sum(len(entry.get('images', {})) for entry in entries)}
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Reports on the build outcome memo')
+    parser.add_argument('-m', '--memo', type=str, default='./build_memo', help="The build memo folder")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    print(BuildMemo(args.memo).stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# Checkpoints of a snippets iteration state
+# A run killed part way (a worker dying, the 20 minute join timeout, an interrupted sweep) otherwise loses the LLMs
+# initial evaluation and every iterations pins and error history. The state is saved next to the snippet as JSON:
+# checkpoint_main.json holds the initial evaluation, checkpoint_<python version>.json each Python versions
+# current pins, the error history and the next iteration. Each version's checkpoint is marked finished once it's done.
+# test_executor --resume picks a snippet up from its checkpoints, without evaluating the file or selecting module
+# versions again.
+import glob
+import json
+import os
+import time
+
+class Checkpoint():
+    # project_dir: the folder the snippet and its outputs are in
+    def __init__(self, project_dir, logging=False) -> None:
+        self.project_dir = project_dir
+        self.logging = logging
+
+    def path(self, name):
+        return f"{self.project_dir}/checkpoint_{name}.json"
+
+    # Saves the given state, replacing the file in one step so a kill never leaves half a checkpoint
+    def save(self, name, **state):
+        state['time'] = time.time()
+        with open(f"{self.path(name)}.tmp", 'w') as out_file:
+            json.dump(state, out_file, separators=(',', ':'))
+        os.replace(f"{self.path(name)}.tmp", self.path(name))
+
+    # The saved state, None if there isn't any
+    def load(self, name):
+        try:
+            with open(self.path(name), 'r') as in_file:
+                return json.load(in_file)
+        except (OSError, ValueError):
+            return None
+
+    # Names of the Python versions that stopped before they finished
+    def unfinished(self):
+        names = [os.path.basename(file)[len('checkpoint_'):-len('.json')] for file in glob.glob(self.path('*'))]
+        return sorted(name for name in names if name != 'main' and not (self.load(name) or {}).get('finished'))
@@ -3,7 +3,6 @@ import os
 import sys
 import importlib.util
 import sysconfig
-import requests
 
 class DepsScraper():
 
@@ -56,6 +55,8 @@ class DepsScraper():
     # Check to see if a package is on pypi
     # If it is then it's something we can install
     def is_package_on_pypi(self, package_name):
+        # requests is only loaded by the processes that ask PyPI
+        import requests
         pypi_url = f"https://pypi.org/pypi/{package_name}/json"
 
         try:
@@ -144,42 +145,50 @@ class DepsScraper():
     # target_word: the word we're looking for in the file
     def find_word_in_file(self, file_path, target_word, folders):
         imports = []
-        block_quote = False
         try:
             with open(file_path, 'r') as file:
-                for line_number, line in enumerate(file, start=1):
-                    block_quote = self.block_quote(block_quote, line)
-                    if not block_quote:
-                        if target_word in line:
-                            if self.logging: print(f'Found "{target_word}" in {file_path} at line {line_number}:')
-                            # if self.logging: print(line.strip())  # Print the entire line
-                            if not '#' in line:
-                                stripped = line.strip().split(' ')
-                                for i in range(0, len(stripped)):
-                                    if i == 0 and stripped[i] == 'import':
-                                        # if self.logging: print(f"A: {stripped}")
-                                        # # if stripped[i+1] == '': print(f"BAD_WORD: {file_path}")
-                                        # import_name = self.dot_notation(stripped[i+1], folders)
-                                        # if import_name:
-                                        #     if 'models' in stripped:
-                                        #         print(stripped)
-                                        #         print('woof')
-                                        imports = self.append_to_list(imports, stripped[i+1])
-                                    elif i > 0 and stripped[i] == 'import':
-                                        if self.logging: print(f"B: {stripped}")
-                                        # if stripped[i-1] == '': print(f"BAD_WORD: {file_path}")
-                                        # import_name = self.dot_notation(stripped[i-1], folders)
-                                        # if import_name:
-                                        #     if 'models' in stripped:
-                                        #         print(stripped)
-                                        #         print('meow')
-                                        #     if import_name.istitle():
-                                        #         pass
-                                        #     else:
-                                        imports = self.append_to_list(imports, stripped[i-1])
-
+                # imports is filled in place, so anything found before an error is still returned
+                self.find_word_in_lines(file, target_word, folders, file_path, imports)
         except FileNotFoundError:
             print(f"File not found: {file_path}")
         except Exception as e:
             print(f"An error occurred: {e}")
         return imports
+
+    # Same as find_word_in_file, for lines that are already in memory (e.g. read from an archive)
+    # source: where the lines came from, for logging
+    # imports: list to add the found imports to
+    def find_word_in_lines(self, lines, target_word, folders, source='', imports=None):
+        imports = imports if imports is not None else []
+        block_quote = False
+        for line_number, line in enumerate(lines, start=1):
+            block_quote = self.block_quote(block_quote, line)
+            if not block_quote:
+                if target_word in line:
+                    if self.logging: print(f'Found "{target_word}" in {source} at line {line_number}:')
+                    # if self.logging: print(line.strip())  # Print the entire line
+                    if not '#' in line:
+                        stripped = line.strip().split(' ')
+                        for i in range(0, len(stripped)):
+                            if i == 0 and stripped[i] == 'import':
+                                # if self.logging: print(f"A: {stripped}")
+                                # # if stripped[i+1] == '': print(f"BAD_WORD: {file_path}")
+                                # import_name = self.dot_notation(stripped[i+1], folders)
+                                # if import_name:
+                                #     if 'models' in stripped:
+                                #         print(stripped)
+                                #         print('woof')
+                                imports = self.append_to_list(imports, stripped[i+1])
+                            elif i > 0 and stripped[i] == 'import':
+                                if self.logging: print(f"B: {stripped}")
+                                # if stripped[i-1] == '': print(f"BAD_WORD: {file_path}")
+                                # import_name = self.dot_notation(stripped[i-1], folders)
+                                # if import_name:
+                                #     if 'models' in stripped:
+                                #         print(stripped)
+                                #         print('meow')
+                                #     if import_name.istitle():
+                                #         pass
+                                #     else:
+                                imports = self.append_to_list(imports, stripped[i-1])
+        return imports
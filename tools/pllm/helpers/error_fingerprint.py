@@ -0,0 +1,90 @@
+# Error fingerprints and loop detection for the build/run loop
+# The LLM often re-proposes a version that already failed, or swaps between two that both fail, so the same error
+# comes back iteration after iteration until the loop runs out. Each failure is reduced to a fingerprint of its error
+# type, module and key message line, with ANSI codes, paths, versions, addresses and numbers stripped, so the same
+# failure fingerprints the same whichever version or folder it came from.
+# The LoopDetector watches the fingerprints for the same one repeating or a short cycle (A B A B) and escalates each
+# time: first the LLMs version is swapped for the newest one that hasn't failed, then the module is dropped, then
+# the loop stops early, leaving the iterations for snippets that can still make progress.
+import hashlib
+import re
+
+ANSI = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|[␛␈]\[?[0-9;]*[A-Za-z]?')
+PATH = re.compile(r'(?:[A-Za-z]:)?(?:/[\w.+-]+){2,}/?')
+VERSION = re.compile(r'\b\d+(?:\.\d+)+(?:[a-z]+\d*)?(?:\.post\d+|\.dev\d+)?\b')
+ADDRESS = re.compile(r'0x[0-9a-fA-F]+')
+NUMBER = re.compile(r'\b\d+\b')
+
+# Markers of the line that says what went wrong, the last matching line is used
+KEY_LINES = re.compile(r'(Error|ERROR|Exception|Could not find a version|dependency conflicts|non-zero code|OOMKilled)')
+
+# The escalations, in the order they're tried
+ESCALATIONS = ['switch', 'drop', 'stop']
+
+# The message with the details that change between otherwise identical failures removed
+def normalise(message):
+    message = ANSI.sub('', message)
+    message = message.replace('\\n', '\n').replace('{"stream":"', '').replace('"}', '')
+    message = re.sub(r'\(from versions:[^)]*\)', '(from versions: ...)', message)
+    message = PATH.sub('<path>', message)
+    message = VERSION.sub('<version>', message)
+    message = ADDRESS.sub('<address>', message)
+    message = NUMBER.sub('<n>', message)
+    return re.sub(r'[ \t]+', ' ', message).strip()
+
+# The line of the message saying what went wrong, the last line if none of them match
+def key_line(message):
+    lines = [line.strip() for line in normalise(message).splitlines() if line.strip()]
+    if not lines: return ''
+    matching = [line for line in lines if KEY_LINES.search(line)]
+    return (matching[-1] if matching else lines[-1])[:200]
+
+# A short stable fingerprint of a failure
+def fingerprint(error_type, module, message):
+    key = f"{error_type}|{module if module else ''}|{key_line(message)}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+class LoopDetector():
+    # repeats: how many of the same fingerprint in a row is a loop, 0 turns detection off
+    # max_cycle: the longest cycle looked for, a cycle has to go round twice
+    def __init__(self, repeats=3, max_cycle=3, logging=False) -> None:
+        self.repeats = repeats
+        self.max_cycle = max_cycle
+        self.logging = logging
+        self.history = []
+        # (fingerprint, action) of each escalation so far
+        self.escalations = []
+
+    def state(self):
+        return {'history': self.history, 'escalations': self.escalations}
+
+    def restore(self, state):
+        if state:
+            self.history = list(state.get('history', []))
+            self.escalations = [tuple(escalation) for escalation in state.get('escalations', [])]
+        return self
+
+    # 'repeat' or 'cycle' if the latest fingerprints are going round in circles, None otherwise
+    def pattern(self):
+        if not self.repeats: return None
+        if len(self.history) >= self.repeats and len(set(self.history[-self.repeats:])) == 1:
+            return 'repeat'
+        for length in range(2, self.max_cycle + 1):
+            recent = self.history[-length * 2:]
+            if len(recent) == length * 2 and recent[:length] == recent[length:] and len(set(recent[:length])) == length:
+                return 'cycle'
+        return None
+
+    # Records a failure, returning the next escalation if it completes a loop
+    # A module with nothing to switch or drop goes straight to stopping
+    # The history starts again after each escalation, so the next one needs a new loop
+    def add(self, fingerprint, has_module=True):
+        self.history.append(fingerprint)
+        pattern = self.pattern()
+        if pattern is None: return None
+        level = len(self.escalations)
+        action = ESCALATIONS[min(level, len(ESCALATIONS) - 1)] if has_module else 'stop'
+        self.escalations.append((fingerprint, action))
+        self.history = []
+        if self.logging: print(f"Loop detected ({pattern} of {fingerprint}), escalating: {action}")
+        return action
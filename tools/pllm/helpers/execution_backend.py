@@ -0,0 +1,83 @@
+# Base class for execution backends
+# A backend takes the LLMs Python version and module pins, builds an environment with them installed,
+# runs the snippet in it and hands back the logs for error processing.
+# DockerHelper (build_dockerfile.py) and VenvHelper (venv_helper.py) are the two implementations.
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+
+class ExecutionBackend(ABC):
+    # install_mode: 'sequential' installs one pin at a time in order, 'single' hands pip every pin in one install
+    # admission: an AdmissionController every build and run waits on (see resources.py)
+    def __init__(self, logging=False, install_mode='sequential', admission=None) -> None:
+        self.logging = logging
+        self.install_mode = install_mode
+        self.admission = admission
+        # Everything the last build printed, for attributing a single install failure to its pins
+        self.build_log = ''
+        # When an error occurs, we want to know what it was on a previous run
+        self.previous_error = {"error_message": '', "module": ''}
+        # Build steps that were reused from a cache, across every build this backend has done
+        self.cache_hits = 0
+        self.cache_steps = 0
+        # Exit code of the last run, None if the backend couldn't tell
+        self.exit_code = None
+        # Runs answered from the run cache (see run_cache.py)
+        self.run_cache_hits = 0
+
+    # Breaks down the file path to get the folder and the file name
+    # file: The path to the file
+    def get_project_dir(self, file):
+        split_path = file.split('/')
+        file_path = '/'.join(split_path[:-1])
+        file_name = split_path[-1]
+        dir_name = split_path[-2]
+        return file_path, dir_name, file_name
+
+    # Gets the (name, version) pins, in install order, from the LLM output
+    # Modules can be a list of {'module', 'version'} dicts or a dict of name: version (or name: [versions])
+    def get_pins(self, llm_out):
+        pins = []
+        python_modules = llm_out['python_modules']
+        for module in python_modules:
+            if type(module) == dict:
+                name = module['module']
+                version = module['version']
+            else:
+                name = module
+                version = python_modules[module]
+
+            if type(version) != str:
+                version = version[0]
+            pins.append((name, version))
+        return pins
+
+    # Writes out the environment definition (Dockerfile, requirements file...) for the given Python version and pins
+    # llm_out: contains the python version and modules
+    # file: The provided file with path
+    @abstractmethod
+    def create_environment(self, llm_out, file):
+        pass
+
+    # Checks the pins resolve together without building anything (see resolution_probe.py)
+    # Returns the probe result, or None if the backend can't probe this Python version
+    def probe_environment(self, llm_out):
+        return None
+
+    # Builds the environment and installs the pins
+    # Returns true if good and false with the error message if there was an issue
+    @abstractmethod
+    def build_environment(self, file):
+        pass
+
+    # Runs the snippet in the built environment and returns the logs for analysis
+    @abstractmethod
+    def run_test(self):
+        pass
+
+    # Holds an admission slot for a build or run, if there's an admission controller
+    def admit(self, stage):
+        return self.admission.admit(stage) if self.admission else nullcontext()
+
+    # Removes anything left over from the build and run
+    def cleanup(self):
+        pass
@@ -0,0 +1,235 @@
+# Stand-ins for Ollama, Docker and PyPI
+# Lets the full pipeline run on a machine with no network, no Ollama server and no Docker daemon
+# Used by benchmark.py to measure the pipelines own overhead and catch performance regressions
+import hashlib
+import json
+import os
+import re
+from time import sleep
+from types import SimpleNamespace
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from helpers.build_dockerfile import DockerHelper
+from helpers.execution_backend import ExecutionBackend
+from helpers.py_pi_query import PyPIQuery
+from helpers.tracer import tracer
+
+VERSION_PATTERN = r"\b\d+(?:\.\d+){1,2}(?:[a-zA-Z]+\d*)?\b"
+
+# Stable percentage (0-99) for a given string, used to pick which snippets a scripted failure hits
+def stable_percent(value):
+    return int(hashlib.sha1(value.encode('utf-8')).hexdigest(), 16) % 100
+
+# Hash used as the key for recorded prompts
+def prompt_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# Recorded-response LLM
+# Responses are looked up by a hash of the rendered prompt, anything not recorded falls back to a
+# deterministic responder that answers in the same JSON shape the parsers expect. Those synthetic answers are
+# heuristics (regexes over the prompt), not model behaviour, so they're counted separately.
+# If a live model is given then misses are sent to it and recorded for later offline runs (benchmark.py --record).
+class RecordedModel(RunnableLambda):
+    def __init__(self, recordings_file=None, latency=0.0, live_model=None, logging=False) -> None:
+        super().__init__(self.respond)
+        self.recordings_file = recordings_file
+        self.recordings = {}
+        if recordings_file and os.path.isfile(recordings_file):
+            with open(recordings_file, 'r') as file:
+                self.recordings = json.load(file)
+        # Simulated inference time per call, in seconds
+        self.latency = latency
+        self.live_model = live_model
+        self.logging = logging
+        self.calls = 0
+        self.hits = 0
+        self.live_calls = 0
+        self.synthetic_calls = 0
+
+    def respond(self, prompt, **kwargs):
+        text = prompt.to_string() if hasattr(prompt, 'to_string') else str(prompt)
+        key = prompt_key(text)
+        self.calls += 1
+
+        if key in self.recordings:
+            self.hits += 1
+            content = self.recordings[key]
+        elif self.live_model is not None:
+            content = self.live_model.invoke(prompt).content
+            self.recordings[key] = content
+            self.live_calls += 1
+        else:
+            content = json.dumps(self.fallback_response(text))
+            self.synthetic_calls += 1
+
+        if self.latency > 0: sleep(self.latency)
+        if self.logging: print(content)
+        return AIMessage(content=content)
+
+    # Writes out the recordings, including anything captured from a live model
+    def save_recordings(self, recordings_file=None):
+        recordings_file = recordings_file if recordings_file else self.recordings_file
+        with open(recordings_file, 'w') as file:
+            json.dump(self.recordings, file, indent=2)
+
+    # Deterministic answers for the three prompt shapes used in OllamaHelper
+    # PythonFile for the initial evaluation, Module when identifying a module from an error,
+    # ModuleVersion for everything else
+    def fallback_response(self, text):
+        if text.startswith('Given a python file:'):
+            return self.evaluate_file_response(text)
+        elif 'Identify the' in text:
+            return {'module': self.find_module(text)}
+        else:
+            return self.module_version_response(text)
+
+    def evaluate_file_response(self, text):
+        body = text[len('Given a python file:'):text.find('\nReturn just a list')]
+        modules = []
+        for module in re.findall(r'(?:from|import)\s+([A-Za-z_][A-Za-z0-9_]*)', body):
+            if module not in modules: modules.append(module)
+        python_version = '2.7' if re.search(r'print\s+["\']', body) else '3.6'
+        return {'python_version': python_version, 'python_modules': modules[:5]}
+
+    def find_module(self, text):
+        patterns = [
+            r"requirement ([A-Za-z0-9_\-\.]+)==",
+            r"No module named '?([A-Za-z0-9_]+)",
+            r"([A-Za-z0-9_\-\.]+)==\d",
+            r"from ([A-Za-z_][A-Za-z0-9_]*) import",
+            r"existing modules \(([A-Za-z0-9_\-\.]+)",
+            r"import ([A-Za-z_][A-Za-z0-9_]*)",
+        ]
+        for pattern in patterns:
+            found = re.search(pattern, text)
+            if found: return found.group(1)
+        return 'unknown'
+
+    def module_version_response(self, text):
+        found = re.search(r"'([^']+)' module", text)
+        module = found.group(1) if found else self.find_module(text)
+
+        previous = set()
+        for group in re.findall(r"[Pp]revious[a-z ]*:?\s*\(([^)]*)\)", text):
+            previous.update(re.findall(VERSION_PATTERN, group))
+
+        candidates = []
+        for version in re.findall(VERSION_PATTERN, text):
+            if version not in previous and version not in candidates:
+                candidates.append(version)
+
+        # Select a recent version, three quarters of the way through the (oldest to newest) list
+        version = candidates[(len(candidates) * 3) // 4] if candidates else 'None'
+        return {'module': module, 'version': version}
+
+
+# Simulated Docker backend
+# Builds and runs sleep for a configurable time and fail according to a failure script instead of calling the daemon
+# The script is JSON of the form:
+# {
+#   "build_latency": {"base": 20.0, "per_module": 8.0},
+#   "run_latency": 10.0,
+#   "failures": [{"stage": "build", "attempt": 1, "fraction": 0.4, "output": "... {module}=={version} ..."}]
+# }
+# A failure fires on the given build/run attempt for the given fraction of snippets (selected by a stable hash)
+class SimulatedDockerHelper(DockerHelper):
+    def __init__(self, logging=False, script=None, latency_scale=1.0, image_name="", dockerfile_name="", container_name="") -> None:
+        # No docker client is created, everything else matches DockerHelper
+        ExecutionBackend.__init__(self, logging=logging)
+        self.dockerfile_out = ""
+        self.image_name = image_name
+        self.dockerfile_name = dockerfile_name
+        self.container_name = container_name
+        self.build_time = 0.0
+        # Images are never kept and wheels never built, there is no daemon to keep them on
+        self.retention = None
+        self.wheelhouse = None
+        # Every run is simulated, there's nothing worth caching
+        self.run_cache = None
+        self.snippet_file = ''
+        self.script = script if script else {}
+        self.latency_scale = latency_scale
+        self.builds = 0
+        self.runs = 0
+
+    # Loads a failure script from file
+    @staticmethod
+    def load_script(script_file):
+        with open(script_file, 'r') as file:
+            return json.load(file)
+
+    def query_docker(self):
+        return []
+
+    # Pulls the pinned modules back out of the generated dockerfile
+    def pinned_modules(self):
+        return re.findall(r'"([^"=]+)==([^"]+)"\]', self.dockerfile_out)
+
+    def scripted_failure(self, stage, attempt, modules):
+        for failure in self.script.get('failures', []):
+            if failure.get('stage') != stage or failure.get('attempt', attempt) != attempt:
+                continue
+            if stable_percent(f"{self.container_name}_{stage}_{attempt}") >= failure.get('fraction', 1.0) * 100:
+                continue
+            pins = dict(modules)
+            module = failure.get('module', modules[0][0] if modules else 'unknown')
+            if 'module' in failure and module not in pins:
+                continue
+            return failure['output'].replace('{module}', module).replace('{version}', pins.get(module, '0.0.1'))
+        return None
+
+    def build_dockerfile(self, path, dockerfile=None):
+        self.builds += 1
+        modules = self.pinned_modules()
+        latency = self.script.get('build_latency', {})
+        sleep((latency.get('base', 0.0) + latency.get('per_module', 0.0) * len(modules)) * self.latency_scale)
+
+        output = self.scripted_failure('build', self.builds, modules)
+        if output:
+            return False, output
+        return True, ""
+
+    def run_container_test(self):
+        self.runs += 1
+        sleep(self.script.get('run_latency', 0.0) * self.latency_scale)
+
+        output = self.scripted_failure('run', self.runs, self.pinned_modules())
+        return output if output else self.script.get('success_output', '')
+
+    # There's no daemon to probe on, every pin set goes straight to the simulated build
+    def probe_environment(self, llm_out):
+        return None
+
+    def delete_container(self):
+        pass
+
+    def delete_image(self):
+        pass
+
+
+# Local PyPI metadata fixture
+# Answers query_module from a JSON file of {module: [[version, upload date, python tag], ...]}
+# Everything else (date windows, version files) is the real PyPIQuery code
+class LocalPyPIQuery(PyPIQuery):
+    def __init__(self, logging=False, base_modules="./modules", fixture_file="helpers/ref_files/benchmark/pypi_metadata.json", latency=0.0) -> None:
+        super().__init__(logging=logging, base_modules=base_modules)
+        with open(fixture_file, 'r') as file:
+            self.fixture = json.load(file)
+        # Simulated request time per metadata lookup, in seconds
+        self.latency = latency
+        self.queries = 0
+
+    def query_module(self, module_name):
+        self.queries += 1
+        with tracer.span('query_module', module=module_name):
+            if self.latency > 0: sleep(self.latency)
+        if module_name not in self.fixture:
+            return None
+
+        releases = {}
+        for version, upload_date, python_version in self.fixture[module_name]:
+            releases[version] = [{'upload_time': f"{upload_date}T00:00:00", 'yanked': False, 'python_version': python_version}]
+        return SimpleNamespace(releases=releases)
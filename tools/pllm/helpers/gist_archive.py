@@ -0,0 +1,159 @@
+# Reads snippets straight out of a gist archive (e.g. hard-gists.tar.gz) without extracting it
+# The archive is read as a stream, one member at a time, so only the snippet being worked on is ever on disk.
+# Outputs go to a separate results tree (results/<gist>/...), which can optionally be packed into a tar as each snippet finishes.
+import glob
+import json
+import os
+import shutil
+import tarfile
+
+from helpers.checkpoint import Checkpoint
+
+class GistArchive():
+    def __init__(self, archive, snippet_name='snippet.py', logging=False) -> None:
+        self.archive = archive
+        self.snippet_name = snippet_name
+        self.logging = logging
+
+    # Gets the gist name for a member, or None if it isn't a snippet
+    # Skips the macOS resource forks (._name) that are in hard-gists.tar.gz
+    def gist_name(self, member):
+        parts = member.name.split('/')
+        if not member.isfile() or parts[-1] != self.snippet_name or len(parts) < 2:
+            return None
+        if parts[-2].startswith('._'):
+            return None
+        return parts[-2]
+
+    # Lazily yields (gist name, snippet source) for every snippet in the archive
+    # names: only yield these gists
+    def snippets(self, names=None):
+        wanted = set(names) if names is not None else None
+        with tarfile.open(self.archive, 'r|*') as tar:
+            for member in tar:
+                name = self.gist_name(member)
+                if name is None or (wanted is not None and name not in wanted):
+                    continue
+                if self.logging: print(f"Reading {member.name}")
+                yield name, tar.extractfile(member).read()
+
+    # Yields (gist name, snippet source) in the order of names, streaming the archive once
+    # Only snippets read ahead of their turn are held in memory, until their turn comes
+    # A name missing from the archive holds back the ones after it until the stream ends
+    def snippets_in_order(self, names):
+        names = list(dict.fromkeys(names))
+        buffered = {}
+        position = 0
+        for name, source in self.snippets(names):
+            buffered[name] = source
+            while position < len(names) and names[position] in buffered:
+                yield names[position], buffered.pop(names[position])
+                position += 1
+        for name in names[position:]:
+            if name in buffered: yield name, buffered.pop(name)
+
+    # Lists the gist names in the archive
+    def names(self):
+        names = []
+        with tarfile.open(self.archive, 'r|*') as tar:
+            for member in tar:
+                name = self.gist_name(member)
+                if name is not None: names.append(name)
+        return names
+
+    # Writes a single snippet into the results tree, returning the path to it
+    def write_snippet(self, results_dir, name, source):
+        os.makedirs(f"{results_dir}/{name}", exist_ok=True)
+        file = f"{results_dir}/{name}/{self.snippet_name}"
+        with open(file, 'wb') as out_file:
+            out_file.write(source)
+        return file
+
+    # A snippet is done once it has any output logs in the results tree, and no Python version was stopped part way
+    # packed: the names already done in the results archive (see packed()), their folders are no longer on disk
+    def is_done(self, results_dir, name, packed=None):
+        if packed and name in packed: return True
+        return len(glob.glob(f"{results_dir}/{name}/output_data_*.yml")) > 0 and not Checkpoint(f"{results_dir}/{name}").unfinished()
+
+    # Copies one snippets outputs (logs, results, Dockerfiles...) to another, marking where they came from
+    # The snippet itself and any folders (modules, venvs) are left alone
+    # results_archive: where to find the outputs once they've been packed
+    def copy_results(self, results_dir, from_name, to_name, results_archive=None):
+        os.makedirs(f"{results_dir}/{to_name}", exist_ok=True)
+        for file, content in self.outputs(results_dir, from_name, results_archive).items():
+            with open(f"{results_dir}/{to_name}/{file}", 'wb') as out_file:
+                out_file.write(content)
+        with open(f"{results_dir}/{to_name}/duplicate_of", 'w') as out_file:
+            out_file.write(from_name)
+
+    # Every file in a snippets results folder ({file name: bytes}), folders (modules, venvs) are left out
+    def read_results(self, results_dir, name):
+        results = {}
+        for file in glob.glob(f"{results_dir}/{name}/*"):
+            if os.path.isfile(file):
+                with open(file, 'rb') as in_file:
+                    results[os.path.basename(file)] = in_file.read()
+        return results
+
+    # A packed snippets files ({file name: bytes}), from the last time it was packed
+    def read_packed(self, results_archive, name):
+        results = {}
+        if not os.path.isfile(results_archive): return results
+        with tarfile.open(results_archive, 'r') as tar:
+            for member in tar:
+                # Each time a snippet is packed its folder comes first, then its files
+                if member.isdir() and member.name == name:
+                    results = {}
+                parts = member.name.split('/')
+                if member.isfile() and len(parts) == 2 and parts[0] == name:
+                    results[parts[1]] = tar.extractfile(member).read()
+        return results
+
+    # A snippets outputs without the snippet itself, from the results tree or the results archive once it's been packed
+    def outputs(self, results_dir, name, results_archive=None):
+        results = self.read_results(results_dir, name)
+        if results_archive and not any(file.startswith('output_data_') for file in results):
+            results = self.read_packed(results_archive, name)
+        results.pop(self.snippet_name, None)
+        return results
+
+    # Removes a snippets outputs from an earlier attempt, the logs are appended to so they'd otherwise mix
+    def clear_results(self, results_dir, name):
+        for file in glob.glob(f"{results_dir}/{name}/*"):
+            if os.path.isfile(file) and os.path.basename(file) != self.snippet_name:
+                os.remove(file)
+
+    # Loads the first passing result_<python version>.json of a snippet, None if it has none
+    def load_result(self, results_dir, name, results_archive=None):
+        if not name: return None
+        outputs = self.outputs(results_dir, name, results_archive)
+        for file in sorted(file for file in outputs if file.startswith('result_') and file.endswith('.json')):
+            result = json.loads(outputs[file])
+            if result.get('passed'):
+                return result
+        return None
+
+    # The manifest of a results archive, a line per snippet that was done when it was packed
+    def manifest(self, results_archive):
+        return f"{results_archive}.manifest"
+
+    # Names of the snippets packed into a results archive as done
+    def packed(self, results_archive):
+        try:
+            with open(self.manifest(results_archive), 'r') as in_file:
+                return {line.strip() for line in in_file if line.strip()}
+        except OSError:
+            return set()
+
+    # Moves a finished snippet's results folder into an (uncompressed, appendable) tar
+    # Snippets that were done are added to the manifest, one stopped part way is run again and packed again
+    # Returns whether the snippet was recorded as done
+    def pack_results(self, results_dir, name, results_archive):
+        done = self.is_done(results_dir, name)
+        with tarfile.open(results_archive, 'a') as tar:
+            tar.add(f"{results_dir}/{name}", arcname=name)
+        if done:
+            with open(self.manifest(results_archive), 'a') as out_file:
+                out_file.write(f"{name}\n")
+        shutil.rmtree(f"{results_dir}/{name}", ignore_errors=True)
+        return done
@@ -1,6 +1,5 @@
 import subprocess
 import json
-import requests
 import time
 
 class GithubCruiserCore:
@@ -86,6 +85,7 @@ class GithubCruiserCore:
         return json.load(open_file)
     
     def get_repo_api_data(self, repo):
+        import requests
         # Make a GET request to the GitHub API
         repo_url = f"https://api.github.com/repos/{repo}"
         
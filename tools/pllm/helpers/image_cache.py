@@ -0,0 +1,143 @@
+# Image retention for the Docker backend
+# Instead of force deleting every snippet image when a run ends, finished images are kept so the next run of the
+# snippet (or any snippet installing the same base and pins) can reuse their layers. Disk use is bounded by a budget,
+# when it's exceeded the least valuable images are evicted and the dangling layers they leave behind are pruned.
+# The state is a JSON file shared between the per Python version processes, guarded by a lock file.
+# Asking the daemon for its disk use is slow, so it's only done every usage_interval seconds, or when the estimate
+# (the last measurement plus images built since, minus images evicted) says the budget is exceeded.
+import argparse
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+class ImageRetentionManager():
+    # client: docker client, budget: bytes of image disk use allowed on the daemon
+    # state_file: JSON file tracking the retained images, shared between processes
+    # usage_interval: seconds the measured disk use is trusted for before the daemon is asked again
+    def __init__(self, client, budget, state_file='./image_cache.json', usage_interval=300, logging=False) -> None:
+        self.client = client
+        self.budget = budget
+        self.state_file = state_file
+        self.usage_interval = usage_interval
+        self.logging = logging
+
+    # Holds an exclusive lock and the loaded state, writing the state back when done
+    @contextmanager
+    def locked_state(self):
+        state_dir = os.path.dirname(os.path.abspath(self.state_file))
+        os.makedirs(state_dir, exist_ok=True)
+        with open(f"{self.state_file}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = {'images': {}, 'stats': {'evictions': 0, 'reclaimed': 0}}
+                if os.path.isfile(self.state_file):
+                    with open(self.state_file, 'r') as in_file:
+                        state = json.load(in_file)
+                yield state
+                with open(f"{self.state_file}.tmp", 'w') as out_file:
+                    json.dump(state, out_file, indent=2)
+                os.replace(f"{self.state_file}.tmp", self.state_file)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Records that an image was just used, along with how long it took to build
+    def touch(self, image_name, build_time=0.0):
+        try:
+            size = self.client.images.get(image_name).attrs.get('Size', 0)
+        except Exception as e:
+            if self.logging: print(e)
+            return
+        with self.locked_state() as state:
+            entry = state['images'].get(image_name, {'uses': 0, 'build_time': 0.0})
+            # A new or rebuilt image adds to the estimated disk use until it's next measured
+            if 'usage' in state and entry.get('size') != size:
+                state['usage']['bytes'] += size
+            entry['uses'] += 1
+            entry['last_used'] = time.time()
+            entry['size'] = size
+            # Keep the slowest build seen, a cached rebuild says little about what the image saves
+            entry['build_time'] = max(entry['build_time'], build_time)
+            state['images'][image_name] = entry
+
+    # Value of keeping an image: build seconds saved per MB, decaying with time since it was last used
+    # The lowest value is evicted first, so a large, cheap, stale image goes before a small, slow, recently used one
+    def value(self, entry, now):
+        size_mb = max(entry.get('size', 0) / 1e6, 1.0)
+        age = max(now - entry.get('last_used', 0), 1.0)
+        return (entry['uses'] * max(entry['build_time'], 1.0)) / (size_mb * age)
+
+    # Disk used by images on the daemon, counting shared layers once
+    def usage(self):
+        df = self.client.df()
+        if df.get('LayersSize') is not None:
+            return df['LayersSize']
+        return sum(image.get('Size', 0) for image in df.get('Images', []) or [])
+
+    # Evicts images until the daemon is under budget, then prunes the dangling layers
+    # keep: image names that mustn't be evicted (e.g. the one just built)
+    def enforce(self, keep=()):
+        with self.locked_state() as state:
+            estimate = state.get('usage')
+            if estimate and time.time() - estimate['time'] < self.usage_interval and estimate['bytes'] <= self.budget: return 0
+        usage = self.usage()
+        reclaimed = 0
+        with self.locked_state() as state:
+            now = time.time()
+            state['usage'] = {'bytes': usage, 'time': now}
+            if usage <= self.budget: return 0
+            candidates = sorted((name for name in state['images'] if name not in keep), key=lambda name: self.value(state['images'][name], now))
+            for name in candidates:
+                if usage - reclaimed <= self.budget: break
+                try:
+                    # Not forced, an image another process has a container for is left alone
+                    self.client.images.remove(image=name)
+                except Exception as e:
+                    if 'No such image' not in str(e):
+                        if self.logging: print(e)
+                        continue
+                if self.logging: print(f"Evicted {name}")
+                reclaimed += state['images'].pop(name).get('size', 0)
+                state['stats']['evictions'] += 1
+            try:
+                pruned = self.client.images.prune(filters={'dangling': True})
+                state['stats']['reclaimed'] += (pruned or {}).get('SpaceReclaimed', 0) or 0
+            except Exception as e:
+                if self.logging: print(e)
+            state['usage']['bytes'] = usage - reclaimed
+        return reclaimed
+
+    # Usage statistics for the retained images
+    def stats(self):
+        with self.locked_state() as state:
+            images = state['images']
+            return {
+                'images': len(images),
+                'retained_size': sum(entry.get('size', 0) for entry in images.values()),
+                'uses': sum(entry['uses'] for entry in images.values()),
+                'reuses': sum(entry['uses'] - 1 for entry in images.values()),
+                'usage': self.usage(),
+                'budget': self.budget,
+                **state['stats'],
+            }
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Reports on and enforces the image disk budget')
+    parser.add_argument('-b', '--budget', type=float, default=20, help="Image disk budget in GB, defaults to 20")
+    parser.add_argument('-s', '--state', type=str, default='./image_cache.json', help="The retention state file")
+    parser.add_argument('-e', '--enforce', action="store_true", help="Evict images until under the budget")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Verbose logging of information")
+    return parser.parse_args()
+
+def main():
+    import docker
+    args = process_args()
+    manager = ImageRetentionManager(docker.from_env(), int(args.budget * 1e9), args.state, logging=args.verbose)
+    if args.enforce:
+        manager.enforce()
+    print(manager.stats())
+
+if __name__ == "__main__":
+    main()
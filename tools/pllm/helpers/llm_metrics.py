@@ -0,0 +1,161 @@
+# Per call LLM accounting
+# Every model call made through OllamaHelperBase.invoke is recorded with its call site, prompt and output tokens,
+# latency, which attempt it was (anything after the first is a retry) and whether the output failed to parse.
+# Calls where the model had to be loaded first (Ollama's load_duration) are counted as cold starts.
+# Like the tracer there is one recorder per process (see `llm_metrics` below), each run exports its calls and a
+# summary by call site to llm_metrics_*.json next to the snippet, which the CLI aggregates across a corpus run.
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Token counts from a model response, (prompt tokens, output tokens, estimated)
+# Ollama reports prompt_eval_count/eval_count, OpenAI token_usage, newer langchain versions usage_metadata for both
+# Without any of them (e.g. the benchmarks recorded model) the counts are estimated at ~4 characters a token
+def token_counts(message, prompt_text=''):
+    usage = getattr(message, 'usage_metadata', None)
+    if usage:
+        return usage.get('input_tokens', 0), usage.get('output_tokens', 0), False
+    metadata = getattr(message, 'response_metadata', None) or {}
+    if 'prompt_eval_count' in metadata or 'eval_count' in metadata:
+        return metadata.get('prompt_eval_count', 0), metadata.get('eval_count', 0), False
+    if 'token_usage' in metadata:
+        return metadata['token_usage'].get('prompt_tokens', 0), metadata['token_usage'].get('completion_tokens', 0), False
+    content = getattr(message, 'content', message)
+    return math.ceil(len(prompt_text) / 4), math.ceil(len(str(content)) / 4), True
+
+# A call spending longer than this loading the model (in seconds) is a cold start
+COLD_LOAD = 1.0
+
+# Seconds Ollama spent loading the model for a response, 0 if it was already loaded or the model doesn't say
+def load_time(message):
+    metadata = getattr(message, 'response_metadata', None) or {}
+    return (metadata.get('load_duration') or 0) / 1e9
+
+class LLMMetrics():
+    def __init__(self, enabled=False) -> None:
+        self.enabled = enabled
+        self.calls = []
+        self.lock = threading.Lock()
+
+    # Records a single model call
+    # error: the exception type name if the model call itself failed, load_time: seconds spent loading the model
+    def record(self, call_site, latency, prompt_tokens=0, output_tokens=0, estimated=False, attempt=0, parse_failure=False, error=None, load_time=0.0):
+        if not self.enabled: return
+        call = {'call_site': call_site, 'time': time.time(), 'latency': latency, 'prompt_tokens': prompt_tokens, 'output_tokens': output_tokens,
+                'estimated': estimated, 'attempt': attempt, 'retry': attempt > 0, 'parse_failure': parse_failure, 'error': error,
+                'load_time': load_time, 'cold': load_time > COLD_LOAD, 'pid': os.getpid()}
+        with self.lock:
+            self.calls.append(call)
+
+    # Drops all recorded calls, used by forked processes so the parents calls aren't exported twice
+    def reset(self):
+        with self.lock:
+            self.calls = []
+
+    # Hands over the recorded calls and starts again, like Tracer.drain
+    def drain(self):
+        with self.lock:
+            calls, self.calls = self.calls, []
+        return calls
+
+    # Writes the calls and their summary out as JSON
+    def export(self, file, metadata=None):
+        if not self.enabled: return
+        with self.lock:
+            calls = list(self.calls)
+        with open(file, 'w') as out_file:
+            json.dump({'summary': summarise_calls(calls), 'calls': calls, 'metadata': metadata if metadata else {}}, out_file, indent=2)
+
+    def summary(self):
+        with self.lock:
+            return summarise_calls(self.calls)
+
+# The recorder for this process
+llm_metrics = LLMMetrics()
+
+
+# Calls, tokens, latency, retries and parse failures for each call site
+def summarise_calls(calls):
+    totals = defaultdict(lambda: {'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'latency': 0.0, 'max_latency': 0.0,
+                                  'retries': 0, 'parse_failures': 0, 'errors': 0, 'estimated': 0, 'cold_calls': 0, 'cold_latency': 0.0, 'load_time': 0.0})
+    for call in calls:
+        details = totals[call['call_site']]
+        details['calls'] += 1
+        details['prompt_tokens'] += call['prompt_tokens']
+        details['output_tokens'] += call['output_tokens']
+        details['latency'] += call['latency']
+        details['max_latency'] = max(details['max_latency'], call['latency'])
+        details['retries'] += 1 if call['retry'] else 0
+        details['parse_failures'] += 1 if call['parse_failure'] else 0
+        details['errors'] += 1 if call['error'] else 0
+        details['estimated'] += 1 if call['estimated'] else 0
+        # Older files don't have the load time
+        if call.get('cold'):
+            details['cold_calls'] += 1
+            details['cold_latency'] += call['latency']
+        details['load_time'] += call.get('load_time', 0.0)
+    for details in totals.values():
+        details['mean_latency'] = details['latency'] / details['calls']
+        details['mean_prompt_tokens'] = details['prompt_tokens'] / details['calls']
+    return dict(totals)
+
+# Finds every exported metrics file under the given folder
+def find_metrics(folder):
+    metrics = []
+    for root, dirs, files in os.walk(folder):
+        for file_name in files:
+            if file_name.startswith('llm_metrics_') and file_name.endswith('.json'):
+                metrics.append(os.path.join(root, file_name))
+    return sorted(metrics)
+
+# Loads the calls from a list of metrics files
+def load_calls(metrics):
+    calls = []
+    for metric in metrics:
+        try:
+            with open(metric, 'r') as file:
+                calls += json.load(file)['calls']
+        except Exception as e:
+            print(f"Unable to load metrics {metric}: {e}")
+    return calls
+
+def print_summary(summary):
+    print(f"{'call site':<36}{'calls':>7}{'prompt tok':>12}{'output tok':>12}{'latency (s)':>13}{'mean (s)':>10}{'retries':>9}{'parse fails':>13}")
+    for name, details in sorted(summary.items(), key=lambda item: item[1]['latency'], reverse=True):
+        print(f"{name:<36}{details['calls']:>7}{details['prompt_tokens']:>12}{details['output_tokens']:>12}{details['latency']:>13.2f}"
+              f"{details['mean_latency']:>10.2f}{details['retries']:>9}{details['parse_failures']:>13}")
+    cold_calls = sum(details['cold_calls'] for details in summary.values())
+    cold_latency = sum(details['cold_latency'] for details in summary.values())
+    warm_calls = sum(details['calls'] for details in summary.values()) - cold_calls
+    warm_latency = sum(details['latency'] for details in summary.values()) - cold_latency
+    print(f"Cold starts: {cold_calls} (mean {cold_latency / cold_calls if cold_calls else 0:.2f}s, {sum(details['load_time'] for details in summary.values()):.2f}s loading)"
+          f" | Warm calls: {warm_calls} (mean {warm_latency / warm_calls if warm_calls else 0:.2f}s)")
+    if any(details['estimated'] for details in summary.values()):
+        print("Some token counts were estimated, the model didn't report them")
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Aggregate LLM metrics files across a corpus run')
+    parser.add_argument('-f', '--folder', type=str, help="The folder containing the snippets and their llm_metrics_*.json files")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write the aggregated summary as JSON to this file")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    metrics = find_metrics(args.folder)
+    calls = load_calls(metrics)
+    summary = summarise_calls(calls)
+
+    print(f"Loaded {len(calls)} LLM calls from {len(metrics)} metrics files")
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(summary, file, indent=2)
+
+if __name__ == "__main__":
+    main()
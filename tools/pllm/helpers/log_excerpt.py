@@ -0,0 +1,143 @@
+# Relevant excerpts of build and run logs for the error prompts
+# A Docker build stream is mostly pip progress bars, ANSI escapes and {"stream": ...} JSON lines, and a container log
+# can be pages of the snippets own output. Only a few lines decide what went wrong: pip's ERROR lines, the
+# 'Could not find a version' and conflict lines, the failing command, and the last frames and exception of a traceback.
+# The excerpter reduces a log to those lines, in their original order, under a token budget.
+# The error type is still classified from the whole log, only the prompts see the excerpt.
+#
+# Policies:
+#   full      the log as it is
+#   clean     the JSON stream decoded, ANSI escapes and progress bars removed
+#   decisive  the cleaned log cut down to the decisive lines under the budget (the default)
+import argparse
+import json
+import re
+
+from helpers.tracer import tracer
+from helpers.version_window import estimate_tokens
+
+POLICIES = ['full', 'clean', 'decisive']
+
+ANSI = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|[␛␈]\[?[0-9;]*[A-Za-z]?')
+# Download and install progress, ━━━ bars, 45%|████ bars and pip's size/speed lines
+PROGRESS = re.compile(r'━|█|^\s*\d+%\||\d+(\.\d+)? [kM]B/s|eta \d|^\s*\|[ #=>-]*\|')
+
+# Lines that decide the error, most decisive first
+ERROR_LINES = [
+    re.compile(r'^\w*(Error|Exception|Warning)\b.*:|^\w+\.\w*(Error|Exception):|OOMKilled'),
+    re.compile(r'ERROR:|error:|Could not find a version|No matching distribution|dependency conflicts|ResolutionImpossible|returned a non-zero code|InvalidVersion'),
+    re.compile(r'requires|conflict|incompatible|Failed building|Failed to build|Running setup.py|Collecting '),
+]
+
+def line_priority(line):
+    for priority, pattern in enumerate(ERROR_LINES):
+        if pattern.search(line): return priority
+    return None
+
+class LogExcerpter():
+    # policy: one of POLICIES
+    # budget: tokens the excerpt may use, the most decisive lines are always kept
+    # frames: how many of the innermost traceback frames are kept
+    def __init__(self, policy='decisive', budget=400, frames=3, logging=False) -> None:
+        if policy not in POLICIES: raise ValueError(f"Unknown excerpt policy {policy}, expected one of {POLICIES}")
+        self.policy = policy
+        self.budget = budget
+        self.frames = frames
+        self.logging = logging
+        self.stats = {'logs': 0, 'raw_chars': 0, 'excerpt_chars': 0}
+
+    # The log as plain text lines, JSON stream lines decoded and ANSI escapes and progress bars removed
+    def clean(self, log):
+        lines = []
+        for line in log.replace('\r', '\n').splitlines():
+            if line.startswith('{'):
+                try:
+                    decoded = json.loads(line)
+                    line = decoded.get('stream') or decoded.get('error') or decoded.get('errorDetail', {}).get('message') or ''
+                except ValueError:
+                    pass
+            for part in ANSI.sub('', line).splitlines():
+                part = part.rstrip()
+                if not part.strip() or PROGRESS.search(part): continue
+                # Repeated lines (retries, identical warnings) only add tokens
+                if lines and lines[-1] == part: continue
+                lines.append(part)
+        return lines
+
+    # Indexes of the lines worth keeping, with their priority
+    # Each traceback keeps its header, its innermost frames and its exception line
+    def decisive(self, lines):
+        keep = {}
+        start = None
+        for index, line in enumerate(lines):
+            if line.startswith('Traceback (most recent call last)'):
+                start = index
+                keep[index] = 1
+                continue
+            priority = line_priority(line.strip())
+            if start is not None and not line.startswith(' '):
+                # The exception line ends the traceback, keep the innermost frames (a File line and its code) before it
+                frames = [i for i in range(start + 1, index) if lines[i].strip().startswith('File ')][-self.frames:]
+                for frame in frames:
+                    keep[frame] = 1
+                    if frame + 1 < index and not lines[frame + 1].strip().startswith('File '): keep[frame + 1] = 1
+                keep[index] = 0
+                start = None
+                continue
+            if priority is not None and start is None:
+                keep[index] = min(priority, keep.get(index, priority))
+        return keep
+
+    # The lines of the log that fit the budget, most decisive first, in their original order
+    def fit(self, lines, keep):
+        chosen = set()
+        used = 0
+        for priority in sorted(set(keep.values())):
+            # Later lines are closer to the failure, so they're taken first within a priority
+            for index in sorted((index for index, value in keep.items() if value == priority), reverse=True):
+                cost = estimate_tokens(lines[index])
+                if priority > 0 and used + cost > self.budget: continue
+                chosen.add(index)
+                used += cost
+        return '\n'.join(lines[index] for index in sorted(chosen))
+
+    def excerpt(self, log):
+        if self.policy == 'full' or not log: return log
+        with tracer.span('excerpt_log', policy=self.policy) as span:
+            lines = self.clean(log)
+            if self.policy == 'clean':
+                text = '\n'.join(lines)
+            else:
+                keep = self.decisive(lines)
+                # Nothing recognisable, the end of the log is the best guess
+                text = self.fit(lines, keep) if keep else '\n'.join(lines[-10:])
+            span['args']['raw_chars'] = len(log)
+            span['args']['excerpt_chars'] = len(text)
+        self.stats['logs'] += 1
+        self.stats['raw_chars'] += len(log)
+        self.stats['excerpt_chars'] += len(text)
+        if self.logging: print(f"Log excerpt: {len(log)} -> {len(text)} characters")
+        return text
+
+    # How much of the logs the excerpts removed
+    def reduction(self):
+        return 1 - self.stats['excerpt_chars'] / self.stats['raw_chars'] if self.stats['raw_chars'] else 0.0
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Shows the excerpt of a build or run log the error prompts would be given')
+    parser.add_argument('-f', '--file', type=str, help="The log file")
+    parser.add_argument('-p', '--policy', type=str, choices=POLICIES, default='decisive', help="The excerpt policy, defaults to decisive")
+    parser.add_argument('-b', '--budget', type=int, default=400, help="Tokens the excerpt may use, defaults to 400")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    with open(args.file, 'r', errors='replace') as in_file:
+        log = in_file.read()
+    excerpter = LogExcerpter(policy=args.policy, budget=args.budget)
+    print(excerpter.excerpt(log))
+    print(f"\n{excerpter.stats['raw_chars']} -> {excerpter.stats['excerpt_chars']} characters ({excerpter.reduction():.0%} smaller)")
+
+if __name__ == "__main__":
+    main()
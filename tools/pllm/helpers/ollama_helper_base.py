@@ -1,23 +1,106 @@
 # Base file for Ollama helper
 # Holds the strings needed for requests
 
-from langchain_community.chat_models import ChatOllama
-# from langchain_community.chat_models import ChatOpenAI
-from langchain_openai import ChatOpenAI
-from dotenv import load_dotenv
+# The chat model clients are imported when a model is created, only the one in use is loaded, and requests when
+# Ollama is asked to load or release a model
 import os
+import time
+
+from helpers.llm_metrics import llm_metrics, token_counts, load_time
 
 class OllamaHelperBase():
     
-    def __init__(self, base_url="http://localhost:11434", model='llama3', temp=0.7, logging=False) -> None:
+    # llm: an already constructed chat model (or stand-in) to use instead of building a client
+    # structured: send each parsers pydantic JSON schema with the request, so the output matches it by construction
+    # This needs Ollama 0.5 or newer (format takes a schema) or an OpenAI model supporting json_schema response formats
+    # keep_alive: how long Ollama keeps the model loaded after each request (e.g. '30m'), None leaves Ollamas default
+    def __init__(self, base_url="http://localhost:11434", model='llama3', temp=0.7, logging=False, llm=None, structured=False, keep_alive=None) -> None:
         self.logging = logging
-        if 'gpt' in model:
+        self.structured = structured
+        # Schema name: the model bound to that schema
+        self.structured_models = {}
+        # Which client the model is, 'ollama', 'openai' or None for a stand-in
+        self.provider = None
+        if llm is not None:
+            self.model = llm
+        elif 'gpt' in model:
+            from dotenv import load_dotenv
+            from langchain_openai import ChatOpenAI
             load_dotenv()
             OPENAI_KEY = os.getenv('OPENAI_KEY')
             self.model = ChatOpenAI(model=model, api_key=OPENAI_KEY, temperature=temp)
+            self.provider = 'openai'
         else:
-            self.model = ChatOllama(base_url=base_url, model=model, format="json", temperature=temp)
+            from langchain_community.chat_models import ChatOllama
+            self.model = ChatOllama(base_url=base_url, model=model, format="json", temperature=temp, keep_alive=keep_alive)
+            self.provider = 'ollama'
+
+    # Loads the model ahead of the first prompt and restarts its keep alive timer, which a prompt would otherwise pay for
+    # Returns the seconds it took, a cold load when the model wasn't already in memory, or None for non Ollama models
+    def warm_up(self, keep_alive=None):
+        if self.provider != 'ollama': return None
+        import requests
+        keep_alive = keep_alive if keep_alive is not None else self.model.keep_alive
+        start = time.perf_counter()
+        try:
+            loaded = requests.get(f"{self.model.base_url}/api/ps", timeout=10).json().get('models', [])
+            cold = not any(model['name'] in (self.model.model, f"{self.model.model}:latest") for model in loaded)
+            # A generate request without a prompt only loads the model
+            payload = {'model': self.model.model} if keep_alive is None else {'model': self.model.model, 'keep_alive': keep_alive}
+            requests.post(f"{self.model.base_url}/api/generate", json=payload, timeout=600).raise_for_status()
+        except Exception as e:
+            print(f"Unable to warm up {self.model.model}: {e}")
+            return None
+        elapsed = time.perf_counter() - start
+        llm_metrics.record('warm_up', elapsed, load_time=elapsed if cold else 0.0)
+        if self.logging: print(f"{self.model.model} {'loaded' if cold else 'already loaded'} in {elapsed:.2f}s, keep alive {keep_alive}")
+        return elapsed
+
+    # Hands the model back to Ollamas own keep alive (OLLAMA_KEEP_ALIVE, 5 minutes by default) once a batch is done
+    def release(self):
+        if self.provider != 'ollama' or self.model.keep_alive is None: return
+        import requests
+        try:
+            requests.post(f"{self.model.base_url}/api/generate", json={'model': self.model.model}, timeout=600).raise_for_status()
+        except Exception as e:
+            if self.logging: print(f"Unable to release {self.model.model}: {e}")
     
+    # The model constrained to the parsers schema, or the plain model when structured output is off
+    # Stand-in models (e.g. the benchmarks recorded model) are always used as they are
+    def model_for(self, parser):
+        pydantic_object = getattr(parser, 'pydantic_object', None)
+        if not self.structured or pydantic_object is None: return self.model
+        name = pydantic_object.__name__
+        if name not in self.structured_models:
+            schema = pydantic_object.schema()
+            if self.provider == 'ollama':
+                self.structured_models[name] = self.model.bind(format=schema)
+            elif self.provider == 'openai':
+                self.structured_models[name] = self.model.bind(response_format={'type': 'json_schema', 'json_schema': {'name': name, 'schema': schema}})
+            else:
+                self.structured_models[name] = self.model
+        return self.structured_models[name]
+
+    # Runs prompt | model | parser, recording the calls tokens, latency, retries and parse failures (see llm_metrics.py)
+    # call_site: names the prompt in the metrics, attempt: which try this is at the call site, later tries count as retries
+    def invoke(self, prompt, parser, call_site, attempt=0):
+        prompt_value = prompt.invoke({})
+        start = time.perf_counter()
+        try:
+            message = self.model_for(parser).invoke(prompt_value)
+        except Exception as e:
+            llm_metrics.record(call_site, time.perf_counter() - start, attempt=attempt, error=type(e).__name__)
+            raise
+        latency = time.perf_counter() - start
+        prompt_tokens, output_tokens, estimated = token_counts(message, prompt_value.to_string())
+        try:
+            out = parser.invoke(message)
+        except Exception:
+            llm_metrics.record(call_site, latency, prompt_tokens, output_tokens, estimated, attempt, parse_failure=True, load_time=load_time(message))
+            raise
+        llm_metrics.record(call_site, latency, prompt_tokens, output_tokens, estimated, attempt, load_time=load_time(message))
+        return out
+
     # Reads the contents of the given file
     def read_python_file(self, file):
         with open(file, 'r') as file:
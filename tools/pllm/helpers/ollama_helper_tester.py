@@ -5,15 +5,14 @@ import re
 
 from helpers.ollama_helper_base import OllamaHelperBase
 from helpers.py_pi_query import PyPIQuery
+from helpers.tracer import tracer
+from helpers.version_window import VersionWindow
+from helpers.log_excerpt import LogExcerpter
 
-from langchain_core.messages import SystemMessage, HumanMessage
-
+# The prompt and parser classes are imported by the methods building prompts, importing langchain_core's prompts
+# costs more than the rest of test_executor's startup and plenty of processes never build one (see test_executor.py)
 from langchain_core.pydantic_v1 import BaseModel, Field
 from typing import Dict, List
-from langchain_core.output_parsers import JsonOutputParser
-
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.prompts import PromptTemplate
 
 # PYDANTIC classes for JSON output
 class Module(BaseModel):
@@ -36,11 +35,18 @@ class ModuleVersions(BaseModel):
 # Main Ollama helper class
 class OllamaHelper(OllamaHelperBase):
     # Init defines the url to the Ollama API, the model, temp, logging and where the module information is stored
-    def __init__(self, base_url="http://localhost:11434", model='llama3', temp=1.0, logging=False, base_modules='./modules', rag=True) -> None:
-        super().__init__(base_url, model, temp, logging)
+    # llm and pypi can be given to swap in stand-ins for the model and PyPI (see benchmark.py)
+    # version_budget: tokens the module versions in a RAG prompt may use, 0 sends every version (see version_window.py)
+    # structured: constrain the models output to the pydantic schemas below, keep_alive: how long Ollama keeps the model loaded (see ollama_helper_base.py)
+    # excerpt_policy, excerpt_budget: how build and run logs are cut down before they're put in an error prompt (see log_excerpt.py)
+    # pypi_cache: folder of PyPI metadata kept between runs (see pypi_cache.py)
+    def __init__(self, base_url="http://localhost:11434", model='llama3', temp=1.0, logging=False, base_modules='./modules', rag=True, llm=None, pypi=None, version_budget=150, structured=False, keep_alive=None, excerpt_policy='decisive', excerpt_budget=400, pypi_cache=None) -> None:
+        super().__init__(base_url, model, temp, logging, llm=llm, structured=structured, keep_alive=keep_alive)
         self.base_modules = base_modules
         self.rag = rag
-        self.pypi = PyPIQuery(logging=logging, base_modules=base_modules)
+        self.pypi = pypi if pypi else PyPIQuery(logging=logging, base_modules=base_modules, pypi_cache=pypi_cache)
+        self.version_window = VersionWindow(budget=version_budget, logging=logging)
+        self.excerpter = LogExcerpter(policy=excerpt_policy, budget=excerpt_budget, logging=logging)
 
     """_summary_
     Validates the json from the model using pydantic to parse it
@@ -56,6 +62,8 @@ class OllamaHelper(OllamaHelperBase):
 
     # Initial Python file handler, gets first set of modules and Python version
     def evaluate_file(self, python_file):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         raw_file = self.read_python_file(python_file)
         
         parser = JsonOutputParser(pydantic_object=PythonFile)
@@ -66,9 +74,7 @@ class OllamaHelper(OllamaHelperBase):
             partial_variables={"raw_file": raw_file, "format_instructions": parser.get_format_instructions()}
         )
         
-        chain = prompt | self.model | parser
-
-        out = chain.invoke({})
+        out = self.invoke(prompt, parser, 'evaluate_file')
         
         print(out)
         return out
@@ -87,6 +93,8 @@ class OllamaHelper(OllamaHelperBase):
 
     # Loops through the modules and request a version for each
     def get_module_versions(self, details):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         modules = details['python_modules']
 
         if len(modules) <= 0:
@@ -105,6 +113,7 @@ class OllamaHelper(OllamaHelperBase):
             try:
                 for idx, module in enumerate(modules):
                     versions = self.read_python_file(f"{self.base_modules}/{module}_{details['python_version']}.txt")
+                    versions = self.candidate_versions(module, details, versions)
 
                     tp = "Infer a possible working version of the '{module}' module for Python {python_version}.\nReturn the information with the format {format_instructions}"
                     pv = {"version_details": versions, "module": module, "python_version": details['python_version'], "format_instructions": parser.get_format_instructions()}
@@ -118,9 +127,7 @@ class OllamaHelper(OllamaHelperBase):
                         partial_variables=pv
                     )
 
-                    chain = prompt | self.model | parser
-
-                    out = chain.invoke({})
+                    out = self.invoke(prompt, parser, 'get_module_versions', attempt=5 - attempts)
 
                     updated_modules[out['module']] = out['version'].split(' ')[0]
                 completed = True
@@ -138,12 +145,12 @@ class OllamaHelper(OllamaHelperBase):
 
 
     # NOTE: Deprecated, update instances that use this!
-    def execute_chain(self, chain, pydantic_model):
+    def execute_chain(self, prompt, parser, pydantic_model, call_site):
         loop = 5
         passed = False
         
-        while not passed or loop > 0:
-            out = chain.invoke({})
+        while not passed and loop > 0:
+            out = self.invoke(prompt, parser, call_site, attempt=5 - loop)
             if self.logging: print(out)
             passed = self.pydantic_validate(pydantic_model, out)
             if passed: return passed, out
@@ -161,7 +168,8 @@ class OllamaHelper(OllamaHelperBase):
 
     # Generic method to get the details from the error
     # Takes the prompt from the the error handler and the parser to ensure the information is returned correctly
-    def generic_get_module_from_error(self, prompt, parser):
+    # call_site: the error handler asking, for the LLM metrics
+    def generic_get_module_from_error(self, prompt, parser, call_site='get_module_from_error'):
 
         bad_module = None
 
@@ -169,9 +177,7 @@ class OllamaHelper(OllamaHelperBase):
         # We want it to extract a module name which we can work with later
         for loop in range(0, 5):
             try:
-                chain = prompt | self.model | parser
-
-                out = chain.invoke({})
+                out = self.invoke(prompt, parser, call_site, attempt=loop)
                 # Get the name of the offending module from the error message        
                 bad_module = self.pypi.check_module_name(out['module'])[0]
 
@@ -183,16 +189,17 @@ class OllamaHelper(OllamaHelperBase):
 
     # Generic method to prompt for a version
     # Uses the targeted prompt and parser plus the previous failing versions
-    def generic_get_version_with_bad_modules(self, prompt, parser, previous_versions):
+    # call_site: the error handler asking, for the LLM metrics
+    def generic_get_version_with_bad_modules(self, prompt, parser, previous_versions, call_site='get_version_with_bad_modules'):
         out = None
 
         for loop in range(0, 5):
             try:
-                chain = prompt | self.model | parser
-
-                out = chain.invoke({})
+                out = self.invoke(prompt, parser, call_site, attempt=loop)
 
                 print(out)
+                # A schema constrained version is always a string, the prompts ask for None when there isn't one
+                if out['version'] in ('None', 'null'): out['version'] = None
 
                 # If the same version is chosen by the model then there's a chance the module is exhausted
                 # We should remove and only re-add if requested during build.
@@ -223,13 +230,29 @@ class OllamaHelper(OllamaHelperBase):
         else:
             error_modules = ''
         
+        target = None
         if bad_module in details['python_modules']:
             error_modules += f"{details['python_modules'][bad_module]}" if error_modules == '' else f", {details['python_modules'][bad_module]}"
-        
+            target = details['python_modules'][bad_module] if type(details['python_modules']) == dict else None
+
+        # Only a compact window of candidates goes in the prompt, never a version that already failed
+        # Versions that built earlier in this run are always shown
+        known_good = previous_versions.get('built_modules', {}).get(bad_module, [])
+        versions = self.candidate_versions(bad_module, details, versions, negatives=error_modules.split(', '), target=target, known_good=known_good)
         return versions, error_modules
 
+    # Picks the versions of a module to show the LLM (see version_window.py)
+    def candidate_versions(self, module, details, versions, negatives=(), target=None, known_good=()):
+        dates = self.pypi.read_module_dates(module, details['python_version'])
+        return self.version_window.window(versions, target=target, negatives=negatives, known_good=known_good, dates=dates)
+
 
-    def could_not_find_version(self, error, previous_versions, details):
+    # bad_module: the module is already known (e.g. from a resolution probe), so the LLM isn't asked to find it
+    def could_not_find_version(self, error, previous_versions, details, bad_module=None):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
+        # Just the 'Could not find a version' lines, with a compact '(from versions: ...)' list
+        error = self.version_window.compact_error(error, known_good=previous_versions.get('built_modules'))
         parser = JsonOutputParser(pydantic_object=Module)
         get_module_prompt = PromptTemplate(
                     template="Given a docker build error where a version could not be found:\n{error}\nIdentify the module causing the error, which is likely in the form 'from module_name==version'.\nReturn the just the name of the module using the format instructions.\n{format_instructions}",
@@ -238,7 +261,8 @@ class OllamaHelper(OllamaHelperBase):
                 )
         
         # Generic method for handling a try loop for getting a module name
-        bad_module = self.generic_get_module_from_error(get_module_prompt, parser)
+        if bad_module == None:
+            bad_module = self.generic_get_module_from_error(get_module_prompt, parser, call_site='could_not_find_version:module')
         # If we failed to get a module then we return None
         if bad_module == None: return bad_module
 
@@ -260,7 +284,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='could_not_find_version:version')
 
         if out['module'] != bad_module:
             parser = JsonOutputParser(pydantic_object=ModuleVersion)
@@ -278,7 +302,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-            out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+            out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='could_not_find_version:version')
 
         if 'module' in out and 'version' in out:
             return out
@@ -287,6 +311,8 @@ class OllamaHelper(OllamaHelperBase):
         
 
     def dependency_conflict(self, error):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         parser = JsonOutputParser(pydantic_object=ModuleVersion)
 
         prompt = PromptTemplate(
@@ -295,15 +321,15 @@ class OllamaHelper(OllamaHelperBase):
             partial_variables={"error": error, "format_instructions": parser.get_format_instructions()}
         )
 
-        chain = prompt | self.model | parser
-
-        passed, json_out = self.execute_chain(chain, ModuleVersion)
+        passed, json_out = self.execute_chain(prompt, parser, ModuleVersion, 'dependency_conflict')
         
         print(json_out)
         return json_out
     
 
     def import_error(self, error, previous_versions, details):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         parser = JsonOutputParser(pydantic_object=Module)
         get_module_prompt = PromptTemplate(
                     template="Given an ImportError:\n{error}\n Identify the import which is causing the error.\nFor this type of error, the module is normally in the text 'from x import y', where x and y are the module to import and the offending method.\nReturn the name of the module using the format instructions.\n{format_instructions}",
@@ -312,7 +338,7 @@ class OllamaHelper(OllamaHelperBase):
                 )
         
         # Generic method for handling a try loop for getting a module name
-        bad_module = self.generic_get_module_from_error(get_module_prompt, parser)
+        bad_module = self.generic_get_module_from_error(get_module_prompt, parser, call_site='import_error:module')
         # If we failed to get a module then we return None
         if bad_module == None: return bad_module
 
@@ -332,7 +358,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='import_error:version')
 
         if 'module' in out and 'version' in out:
             return out
@@ -341,6 +367,8 @@ class OllamaHelper(OllamaHelperBase):
 
 
     def module_not_found(self, error, previous_versions, details):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         parser = JsonOutputParser(pydantic_object=Module)
         get_module_prompt = PromptTemplate(
                     template="Given a ModuleNotFound:\n{error}\nIdentify the module being imported which is causing this error.\nReturn the name of the module using the format instructions.\n{format_instructions}",
@@ -350,7 +378,7 @@ class OllamaHelper(OllamaHelperBase):
                 )
         
         # Generic method for handling a try loop for getting a module name
-        bad_module = self.generic_get_module_from_error(get_module_prompt, parser)
+        bad_module = self.generic_get_module_from_error(get_module_prompt, parser, call_site='module_not_found:module')
         # If we failed to get a module then we return None
         if bad_module == None: return bad_module
 
@@ -371,7 +399,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='module_not_found:version')
 
         if 'module' in out and 'version' in out:
             return out
@@ -380,6 +408,8 @@ class OllamaHelper(OllamaHelperBase):
         
 
     def attribute_error(self, error, previous_versions, details):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         python_modules = []
         for module in details['python_modules']:
             python_modules.append(module)
@@ -392,7 +422,7 @@ class OllamaHelper(OllamaHelperBase):
                 )
         
         # Generic method for handling a try loop for getting a module name
-        bad_module = self.generic_get_module_from_error(get_module_prompt, parser)
+        bad_module = self.generic_get_module_from_error(get_module_prompt, parser, call_site='attribute_error:module')
         # If we failed to get a module then we return None
         if bad_module == None: return bad_module
 
@@ -414,7 +444,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='attribute_error:version')
 
         if 'module' in out and 'version' in out:
             return out
@@ -423,6 +453,8 @@ class OllamaHelper(OllamaHelperBase):
 
 
     def invalid_version(self, error):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         parser = JsonOutputParser(pydantic_object=ModuleVersion)
 
         prompt = PromptTemplate(
@@ -431,15 +463,15 @@ class OllamaHelper(OllamaHelperBase):
             partial_variables={"error": error, "format_instructions": parser.get_format_instructions()}
         )
 
-        chain = prompt | self.model | parser
-
-        passed, json_out = self.execute_chain(chain, ModuleVersion)
+        passed, json_out = self.execute_chain(prompt, parser, ModuleVersion, 'invalid_version')
         
         print(json_out)
         return json_out
     
 
     def non_zero_error(self, error):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         parser = JsonOutputParser(pydantic_object=Module)
 
         get_module_prompt = PromptTemplate(
@@ -449,12 +481,14 @@ class OllamaHelper(OllamaHelperBase):
         )
         
         # Generic method for handling a try loop for getting a module name
-        bad_module = self.generic_get_module_from_error(get_module_prompt, parser)
+        bad_module = self.generic_get_module_from_error(get_module_prompt, parser, call_site='non_zero_error:module')
 
         return bad_module
     
 
     def non_zero_error_version(self, error, module, previous_versions, details):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         versions, error_modules = self.get_versions_previous_versions(module, previous_versions, details)
 
         parser = JsonOutputParser(pydantic_object=ModuleVersion)
@@ -474,7 +508,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='non_zero_error_version:version')
 
         if 'module' in out and 'version' in out:
             return out
@@ -483,6 +517,8 @@ class OllamaHelper(OllamaHelperBase):
 
 
     def syntax_error_helper(self, error, previous_versions, details):
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.prompts import PromptTemplate
         parser = JsonOutputParser(pydantic_object=Module)
         get_module_prompt = PromptTemplate(
                     template="Given a Docker build error message: {error}\nIdentify the offending Python module and output the module name using the following format instruction {format_instructions}.",
@@ -491,7 +527,7 @@ class OllamaHelper(OllamaHelperBase):
                 )
         
         # Generic method for handling a try loop for getting a module name
-        bad_module = self.generic_get_module_from_error(get_module_prompt, parser)
+        bad_module = self.generic_get_module_from_error(get_module_prompt, parser, call_site='syntax_error_helper:module')
         # If we failed to get a module then we return None
         if bad_module == None: return bad_module
 
@@ -511,7 +547,7 @@ class OllamaHelper(OllamaHelperBase):
                 partial_variables=pv
             )
         
-        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules)
+        out = self.generic_get_version_with_bad_modules(get_version_prompt, parser, error_modules, call_site='syntax_error_helper:version')
 
         if 'module' in out and 'version' in out:
             return out
@@ -519,53 +555,103 @@ class OllamaHelper(OllamaHelperBase):
             return None
  
 
+    # The module a probe blamed for a given error type, as a name we can install, or None
+    def known_module(self, conflicts, error_type):
+        for conflict in conflicts if conflicts else []:
+            if conflict['type'] == error_type and conflict['module']:
+                modules = self.pypi.check_module_name(conflict['module'])
+                return modules[0] if len(modules) > 0 else None
+        return None
+
     # Process error, makes sure we call the correct method to call the LLM with
-    def process_error(self, message, error_details, llm_eval):
-        error_type = None
+    # conflicts: structured conflicts from a resolution probe, the first one names the module to blame
+    # install_mode: how the failed build installed the pins, see classify_error
+    def process_error(self, message, error_details, llm_eval, conflicts=None, install_mode='sequential'):
+        # Each branch is traced as process_error:<error type>
+        with tracer.span('process_error') as span:
+            output, error_type = self.process_error_branch(message, error_details, llm_eval, conflicts, install_mode)
+            span['name'] = f"process_error:{error_type}"
+        return output, error_type
+
+    def process_error_branch(self, message, error_details, llm_eval, conflicts=None, install_mode='sequential'):
+        error_type = classify_error(message, install_mode)
         output = None
-        
-        if 'Could not find a version' in message:
+        # The prompts are given the decisive lines of the log (see log_excerpt.py), the error type comes from all of it
+        django_settings = 'DJANGO_SETTINGS_MODULE is undefined' in message
+        if error_type not in ('None', 'OutOfMemory'):
+            message = self.excerpter.excerpt(message)
+
+        if error_type == 'OutOfMemory':
+            # Nothing wrong with the pins, the build or run is tried again once the host has the memory
+            if self.logging: print('Out of memory')
+        elif error_type == 'VersionNotFound':
             if self.logging: print("Could not find a version")
-            error_type = 'VersionNotFound'
-            output = self.could_not_find_version(message, error_details, llm_eval)
-        elif 'dependency conflicts' in message:
+            output = self.could_not_find_version(message, error_details, llm_eval, bad_module=self.known_module(conflicts, error_type))
+        elif error_type == 'DependencyConflict':
             if self.logging: print("Dependency conflict")
-            error_type = 'DependencyConflict'
-            output = self.dependency_conflict(message)
-        elif 'ImportError' in message:
+            # The probe already blamed a module, only a version for it is needed
+            bad_module = self.known_module(conflicts, error_type)
+            if bad_module == None:
+                output = self.dependency_conflict(message)
+            else:
+                output = self.non_zero_error_version(message, bad_module, error_details, llm_eval)
+        elif error_type == 'ImportError':
             if self.logging: print('Import Error')
-            error_type = 'ImportError'
-            if 'DJANGO_SETTINGS_MODULE is undefined' in message:
+            if django_settings:
                 output = None
             else:
                 output = self.import_error(message, error_details, llm_eval)
-        elif 'ModuleNotFoundError' in message:
+        elif error_type == 'ModuleNotFound':
             if self.logging: print("Module not found")
-            error_type = 'ModuleNotFound'
             output = self.module_not_found(message, error_details, llm_eval)
-        elif 'AttributeError' in message:
+        elif error_type == 'AttributeError':
             if self.logging: print("Attribute error")
-            error_type = 'AttributeError'
             output = self.attribute_error(message, error_details, llm_eval)
-        elif 'InvalidVersion' in message:
+        elif error_type == 'InvalidVersion':
             if self.logging: print('Invalid Version')
-            error_type = 'InvalidVersion'
             output = self.invalid_version(message)
-        elif 'non-zero code' in message: # Docker specific error message
+        elif error_type == 'NonZeroCode':
             if self.logging: print('Non-zero error code from docker build')
-            error_type = 'NonZeroCode'
-            output = self.non_zero_error(message)
+            output = self.known_module(conflicts, error_type)
+            if output == None:
+                output = self.non_zero_error(message)
             output = self.non_zero_error_version(message, output, error_details, llm_eval)
-        elif 'SyntaxError' in message:
+        elif error_type == 'SyntaxError':
             if self.logging: print('Syntax Error: Python specific error that needs more information')
-            error_type = 'SyntaxError'
             output = self.syntax_error_helper(message, error_details, llm_eval)
         else:
             if self.logging: print('No error type found')
-            error_type = 'None'
 
         return output, error_type
 
+# Imports the prompt and parser classes ahead of the first prompt, in a process about to start workers that all build prompts
+def preload_prompts():
+    import langchain_core.output_parsers
+    import langchain_core.prompts
+
+# pip's markers for a package that failed to build, and the line summarise() gives a pin blamed for one
+# A single install's log holding these is a build failure, even if the failing setup.py raised an ImportError on the way,
+# the failing pin is attributed from the log. A sequential install keeps the ImportError, the LLM may add or reorder
+# the missing build dependency (see the build loop in test_executor.py)
+BUILD_FAILURES = ['could not be installed', 'subprocess-exited-with-error', 'Failed building wheel', 'metadata-generation-failed', 'failed with error code']
+
+# The error type of a build or run output, checked in the order process_error_branch handles them
+# A build or run killed for using too much memory exits with 137 (SIGKILL), or -9 from a venv's pip
+# A venv command that timed out was killed too, that's not the host running out of memory
+def classify_error(message, install_mode='sequential'):
+    killed = 'returned a non-zero code: -9' in message and 'Timed out after' not in message
+    if 'OOMKilled' in message or 'returned a non-zero code: 137' in message or killed: return 'OutOfMemory'
+    if 'Could not find a version' in message: return 'VersionNotFound'
+    if 'dependency conflicts' in message: return 'DependencyConflict'
+    if install_mode == 'single' and 'non-zero code' in message and any(marker in message for marker in BUILD_FAILURES): return 'NonZeroCode'
+    if 'ImportError' in message: return 'ImportError'
+    if 'ModuleNotFoundError' in message: return 'ModuleNotFound'
+    if 'AttributeError' in message: return 'AttributeError'
+    if 'InvalidVersion' in message: return 'InvalidVersion'
+    if 'non-zero code' in message: return 'NonZeroCode' # Docker specific error message
+    if 'SyntaxError' in message: return 'SyntaxError'
+    return 'None'
+
 # Handle argument parsing
 def process_args():
     def str2bool(value):
@@ -3,25 +3,29 @@
 import json
 import os
 import re
-from pypi_json import PyPIJSON
 from datetime import datetime
 
 from helpers.github_cruiser_core import GithubCruiserCore
 from helpers.deps_scraper import DepsScraper
+from helpers.ref_data import reference
+from helpers.pypi_cache import PyPICache
+from helpers.tracer import tracer
 
 class PyPIQuery:
     ###
     # For now we use GithubCruiserCore for certain helper functions
     ###
-    def __init__(self, logging=False, base_modules="./modules") -> None:
+    # pypi_cache: folder of PyPI metadata kept between runs (see pypi_cache.py), None asks PyPI every time
+    def __init__(self, logging=False, base_modules="./modules", pypi_cache=None) -> None:
         self.date_format = '%Y-%m-%d'
         self.output_date_format = '%b %d %Y'
         self.logging = False
         self.ghc = GithubCruiserCore(logging=False)
         self.deps = DepsScraper(logging=logging)
-        self.python_versions = self.ghc.load_json_from_file("helpers/ref_files/python_versions.json")
+        self.python_versions = reference('python_versions.json')
         os.makedirs(base_modules, exist_ok=True)
         self.base_modules = base_modules
+        self.cache = PyPICache(pypi_cache, logging=logging) if pypi_cache else None
 
     def check_format(self, python_version):
         python_version = python_version.replace('+', '')
@@ -50,6 +54,13 @@ class PyPIQuery:
                 return ''
     
 
+    # Release dates of the versions in a module file, version -> {'date', 'in_window'}, empty if there are none
+    def read_module_dates(self, module, python_version):
+        file = f"{self.base_modules}/{module}_{python_version}.json"
+        if not os.path.isfile(file): return {}
+        with open(file, 'r') as in_file:
+            return json.load(in_file)
+
     # Get a start and end date based on the Python versions we're using
     # This takes the Python version and creates a date range from release, through to the next version.
     # NOTE: DOUBLE CHECK THIS, POSSIBLE BAD RETURN IN CERTAIN CASES!
@@ -118,8 +129,7 @@ class PyPIQuery:
     # Checks the modules to ensure they look correct
     # This ensures there's no weird formatting or the model went awry
     def check_modules(self, modules):
-        f = open('./helpers/ref_files/module_link.json')
-        known_modules = json.load(f)
+        known_modules = reference('module_link.json')
         module_list = {}
 
         for module in modules:
@@ -139,8 +149,7 @@ class PyPIQuery:
     # Creates a new array of module names
     def check_module_name(self, module_name):
         # module_name = ['jinja2', 'os', 'json', 'logging', 're', 'hashlib', 'hmac', 'random', 'string', 'time', 'google.appengine.ext', 'google.appengine.api', 'blog_main', 'webapp2', 'google.appengine.ext', 'datetime', 'logging', 'json']
-        f = open('./helpers/ref_files/module_link.json')
-        known_modules = json.load(f)
+        known_modules = reference('module_link.json')
         module_list = []
         if type(module_name) == str:
             module_name = [module_name]
@@ -162,11 +171,23 @@ class PyPIQuery:
 
 
     # Calls the PyPIJSON module to get a list of all a modules versions
-    # Returns the request meta data
+    # Returns the request meta data, None if the module isn't on PyPI or the request failed
     def query_module(self, module_name):
+        if self.cache:
+            found, requests_metadata = self.cache.get(module_name)
+            if found: return requests_metadata
+        # Imported here rather than inside the try, a missing client library isn't a module missing from PyPI
+        from pypi_json import PyPIJSON
+        from packaging.requirements import InvalidRequirement
         try:
-            with PyPIJSON() as client:
-                requests_metadata = client.get_metadata(module_name)
+            with tracer.span('query_module', module=module_name):
+                with PyPIJSON() as client:
+                    try:
+                        requests_metadata = client.get_metadata(module_name)
+                    except InvalidRequirement:
+                        # Not on PyPI, that answer is cached too
+                        requests_metadata = None
+            if self.cache: self.cache.put(module_name, requests_metadata)
             return requests_metadata
         except Exception as e:
             return None
@@ -217,6 +238,9 @@ class PyPIQuery:
                                 elif 'source' in release_details['python_version'] and len(stored) <= 20:
                                     store = {'version': ele, 'date': upload_time.strftime(self.output_date_format)}
 
+                                # Whether the release came out while this Python version was current, for the version windows
+                                if store: store['in_window'] = upload_time >= start_date and upload_time <= end_date
+
                                 # Make sure we always store the latest version
                                 if upload_time >= latest_release['date']:
                                     latest_release = {'version': ele, 'date': upload_time}
@@ -248,6 +272,10 @@ class PyPIQuery:
 
 
         for dep in python_modules:
+            # Written by prewarm.py or an earlier snippet from the same metadata, nothing would change
+            if self.versions_up_to_date(dep, python_version):
+                modified_modules.append(dep)
+                continue
             modules = self.find_modules(dep, start_date, end_date, python_version)
             module_versions = []
             if len(modules) > 0:
@@ -263,16 +291,35 @@ class PyPIQuery:
             
             modified_modules.append(dep)
             module_versions.sort(key=version_key)
-            with open(f"{self.base_modules}/{dep}_{python_version}.txt", "w") as outfile:
+            # Release dates alongside the version file, e.g. requests_2.7.json
+            # Both are written then moved into place, the modules folder can be shared by processes (see prewarm.py)
+            with open(f"{self.base_modules}/{dep}_{python_version}.json.{os.getpid()}.tmp", "w") as outfile:
+                json.dump({module['version']: {'date': datetime.strptime(module['date'], self.output_date_format).strftime(self.date_format) if type(module['date']) == str else module['date'].strftime(self.date_format),
+                                               'in_window': module.get('in_window', False)} for module in modules}, outfile)
+            with open(f"{self.base_modules}/{dep}_{python_version}.txt.{os.getpid()}.tmp", "w") as outfile:
                 # outfile.write(f"Module versions: [")
                 outfile.write(', '.join(module_versions))
                 # outfile.write("]")
                 # module_details = f"Module versions: ["
                 
                 # outfile.write(module_details)
+            for extension in ['json', 'txt']:
+                os.replace(f"{self.base_modules}/{dep}_{python_version}.{extension}.{os.getpid()}.tmp", f"{self.base_modules}/{dep}_{python_version}.{extension}")
 
         return modified_modules, python_version
 
+    # Whether a modules version lists for a Python version were written after its cached PyPI metadata was fetched
+    # Without a cache the metadata is asked for every time, so the lists are always written again
+    def versions_up_to_date(self, dep, python_version):
+        if not self.cache: return False
+        found, metadata = self.cache.get(dep)
+        if not found: return False
+        try:
+            written = min(os.path.getmtime(f"{self.base_modules}/{dep}_{python_version}.{extension}") for extension in ['json', 'txt'])
+        except OSError:
+            return False
+        return written >= os.path.getmtime(self.cache.path(dep))
+
     def get_version_from_code(self, python_code):
         version = ""
 
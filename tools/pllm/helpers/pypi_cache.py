@@ -0,0 +1,75 @@
+# PyPI metadata cache
+# Every snippet looks its modules up on PyPI in the middle of its timed run, and a corpus asks for the same few
+# hundred projects thousands of times, so runs early in a sweep pay for requests that later runs don't.
+# Each projects releases (the upload time, yanked flag and python_version of every file, all find_modules looks at)
+# are kept as JSON, one file per project, so a lookup is a file read. Projects that aren't on PyPI are kept too,
+# failed requests aren't and are asked again next time.
+# prewarm.py fills the cache for a whole corpus before a sweep.
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from types import SimpleNamespace
+
+# The fields of each release file find_modules uses
+FIELDS = ['upload_time', 'yanked', 'python_version']
+
+class PyPICache():
+    # cache_dir: folder holding a file per project, shared between processes
+    # max_age: seconds an entry is trusted for, new releases show up once it runs out
+    def __init__(self, cache_dir='./pypi_cache', max_age=7 * 24 * 3600, logging=False) -> None:
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.logging = logging
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, project):
+        return f"{self.cache_dir}/{re.sub(r'[^A-Za-z0-9._-]', '_', project.lower())}.json"
+
+    # (found, metadata): found is False if the project isn't cached or is too old,
+    # metadata is None for a project that isn't on PyPI
+    def get(self, project):
+        try:
+            with open(self.path(project), 'r') as in_file:
+                entry = json.load(in_file)
+        except (OSError, ValueError):
+            return False, None
+        if time.time() - entry.get('time', 0) > self.max_age: return False, None
+        return True, SimpleNamespace(releases=entry['releases']) if entry['releases'] is not None else None
+
+    # Keeps a projects metadata (anything with .releases), None records that it isn't on PyPI
+    def put(self, project, metadata):
+        releases = None
+        if metadata is not None:
+            releases = {version: [{field: release.get(field) for field in FIELDS} for release in files] for version, files in (metadata.releases or {}).items()}
+        with open(f"{self.path(project)}.{os.getpid()}.tmp", 'w') as out_file:
+            json.dump({'project': project, 'releases': releases, 'time': time.time()}, out_file, separators=(',', ':'))
+        os.replace(f"{self.path(project)}.{os.getpid()}.tmp", self.path(project))
+
+    def stats(self):
+        found = missing = stale = 0
+        for file in glob.glob(f"{self.cache_dir}/*.json"):
+            try:
+                with open(file, 'r') as in_file:
+                    entry = json.load(in_file)
+            except (OSError, ValueError):
+                continue
+            if time.time() - entry.get('time', 0) > self.max_age: stale += 1
+            elif entry['releases'] is None: missing += 1
+            else: found += 1
+        return {'projects': found, 'not_on_pypi': missing, 'stale': stale}
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Reports on the PyPI metadata cache')
+    parser.add_argument('-c', '--cache', type=str, default='./pypi_cache', help="The PyPI cache folder")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    print(PyPICache(args.cache).stats())
+
+if __name__ == "__main__":
+    main()
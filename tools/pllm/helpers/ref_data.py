@@ -0,0 +1,19 @@
+# Shared reference data
+# The JSON files in helpers/ref_files are read once per process and cached, instead of every PyPIQuery and
+# module name check reopening them. test_executor preloads them before starting its worker processes, so the
+# forked workers share the parents copy. The returned data is shared, callers mustn't modify it.
+import json
+import os
+from functools import lru_cache
+
+REF_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ref_files')
+
+@lru_cache(maxsize=None)
+def reference(name):
+    with open(os.path.join(REF_FILES, name), 'r') as file:
+        return json.load(file)
+
+# Loads the reference files every run needs
+def preload():
+    for name in ['python_versions.json', 'module_link.json']:
+        reference(name)
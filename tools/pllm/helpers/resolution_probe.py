@@ -0,0 +1,174 @@
+# pip dry-run resolution probe
+# Before committing to a full build, the whole pin set is resolved with `pip install --dry-run --report` in a warm
+# environment for the Python version. Nothing is installed and no image is produced, so an unresolvable set is found
+# in seconds rather than after minutes of building. pip's report and errors are parsed into structured conflicts,
+# summarised in the same wording as a failed build so process_error handles them as usual.
+# --dry-run needs pip 22.2, which isn't available for Python 3.6 and older, those versions are never probed.
+# The same parsing attributes a failed single transaction install (every pin in one pip install) back to its pins.
+import json
+import re
+import shlex
+import uuid
+
+# Lowest Python version with a pip that supports --dry-run --report
+MIN_PYTHON = (3, 7)
+
+def supports_dry_run(python_version):
+    try:
+        return tuple(int(part) for part in str(python_version).split('.')[:2]) >= MIN_PYTHON
+    except ValueError:
+        return False
+
+# The pip arguments for a probe
+# The report is written to a file rather than stdout, as --quiet would also hide pips explanation of a conflict
+def probe_args(pins, report, extra_args=None):
+    args = ['install', '--dry-run', '--ignore-installed', '--disable-pip-version-check', '--report', report]
+    return args + (extra_args if extra_args else []) + [f"{name}=={version}" for name, version in pins]
+
+# The (name, version) pairs pip would install, from the JSON report
+def parse_report(report):
+    try:
+        report = json.loads(report)
+    except (ValueError, TypeError):
+        return []
+    return [(item['metadata']['name'], item['metadata']['version']) for item in report.get('install', [])]
+
+# Structured conflicts from pips error output
+# Each conflict has a type (VersionNotFound or DependencyConflict), the module to blame, the requested version and details
+def parse_errors(output, pins):
+    conflicts = []
+    requested = {name.lower(): version for name, version in pins}
+
+    for match in re.finditer(r"Could not find a version that satisfies the requirement ([A-Za-z0-9_.\-\[\]]+?)(?:[=<>!~]=?([^\s(]+))?\s*\(from versions: ([^)]*)\)", output):
+        module = match.group(1).split('[')[0]
+        available = [version.strip() for version in match.group(3).split(',') if version.strip() and version.strip() != 'none']
+        conflicts.append({'type': 'VersionNotFound', 'module': module, 'version': match.group(2) or requested.get(module.lower()),
+                          'available': available, 'detail': match.group(0)})
+
+    for match in re.finditer(r"Package '([^']+)' requires a different Python: (.+)", output):
+        module = match.group(1)
+        conflicts.append({'type': 'VersionNotFound', 'module': module, 'version': requested.get(module.lower()),
+                          'available': [], 'detail': f"requires a different Python: {match.group(2).strip()}"})
+
+    match = re.search(r"Cannot install (.+?) because these package versions have conflicting dependencies", output)
+    if match:
+        involved = [pin.strip() for pin in re.split(r',\s*|\s+and\s+', match.group(1)) if pin.strip()]
+        # "The conflict is caused by:" lines, e.g. "    flask 0.12 depends on werkzeug>=0.7"
+        causes = re.findall(r"^\s+(\S+) (\S+) depends on (.+)$", output, re.MULTILINE)
+        # Blame the last requested module involved, the earlier pins have already been accepted by previous builds
+        names = [re.split(r'[=<>!~]', pin)[0] for pin in involved]
+        order = [name.lower() for name, version in pins]
+        names.sort(key=lambda name: order.index(name.lower()) if name.lower() in order else -1)
+        module = names[-1] if names else None
+        conflicts.append({'type': 'DependencyConflict', 'module': module, 'version': requested.get(module.lower()) if module else None,
+                          'involved': involved, 'causes': [f"{name} {version} depends on {dependency}" for name, version, dependency in causes],
+                          'detail': match.group(0)})
+
+    return conflicts
+
+def normalise_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+# Attributes a failed single transaction install (every pin in one pip install) back to the pins responsible
+# Adds a NonZeroCode conflict for each pin whose build failed, following 'Collecting dep (from pin...)' lines so
+# a dependency that fails to build is blamed on the pin that pulled it in
+def attribute_failure(output, pins):
+    conflicts = parse_errors(output, pins)
+    pin_names = {normalise_name(name): (name, version) for name, version in pins}
+    parents = {}
+    for dependency, requester in re.findall(r"Collecting ([A-Za-z0-9_.\-]+)[^\n(]*\(from ([A-Za-z0-9_.\-]+)", output):
+        parents.setdefault(normalise_name(dependency), normalise_name(requester))
+
+    def to_pin(name):
+        name = normalise_name(name)
+        seen = set()
+        while name not in pin_names and name in parents and name not in seen:
+            seen.add(name)
+            name = parents[name]
+        return pin_names.get(name)
+
+    failed = re.findall(r"Failed building wheel for ([A-Za-z0-9_.\-]+)", output)
+    failed += re.findall(r"Running setup\.py install for ([A-Za-z0-9_.\-]+) \.\.\. error", output)
+    # Older pips: Command "python setup.py egg_info" failed with error code 1 in /tmp/pip-build-xyz/<name>/
+    failed += re.findall(r"failed with error code \d+ in /tmp/pip-[a-z\-]*build[^/\s]*/([A-Za-z0-9_.\-]+)", output)
+    if not failed:
+        # Newer pips only say which step failed, the package is the last one collected before it
+        match = re.search(r"did not run successfully|metadata-generation-failed|Encountered error while", output)
+        if match:
+            collecting = re.findall(r"Collecting ([A-Za-z0-9_.\-]+)", output[:match.start()])
+            if collecting: failed.append(collecting[-1])
+
+    blamed = set(normalise_name(conflict['module']) for conflict in conflicts if conflict['module'])
+    for name in failed:
+        pin = to_pin(name)
+        if pin and normalise_name(pin[0]) not in blamed:
+            blamed.add(normalise_name(pin[0]))
+            conflicts.append({'type': 'NonZeroCode', 'module': pin[0], 'version': pin[1], 'detail': f"{name} failed to build"})
+    return conflicts
+
+# Summarises conflicts in the wording process_error expects from a failed build
+def summarise(conflicts, python_version):
+    lines = []
+    for conflict in conflicts:
+        if conflict['type'] == 'VersionNotFound':
+            if conflict['available']:
+                lines.append(f"ERROR: Could not find a version that satisfies the requirement {conflict['module']}=={conflict['version']} (from versions: {', '.join(conflict['available'])})")
+            else:
+                lines.append(f"ERROR: Could not find a version that satisfies the requirement {conflict['module']}=={conflict['version']} for Python {python_version} ({conflict['detail']})")
+        elif conflict['type'] == 'DependencyConflict':
+            lines.append(f"ERROR: dependency conflicts between {', '.join(conflict['involved'])}: {'; '.join(conflict['causes'])}")
+        elif conflict['type'] == 'NonZeroCode':
+            lines.append(f"ERROR: {conflict['module']}=={conflict['version']} could not be installed, {conflict['detail']}")
+    return '\n'.join(lines)
+
+# Turns a finished pip probe into a result
+# None when the probe can't tell us anything (old pip, network trouble...), the full build then goes ahead as normal
+def probe_result(code, stdout, stderr, pins, python_version):
+    if 'no such option: --dry-run' in stderr or 'no such option: --report' in stderr:
+        return None
+    if code == 0:
+        return {'passed': True, 'resolved': parse_report(stdout), 'conflicts': [], 'output': ''}
+    conflicts = parse_errors(stderr, pins)
+    if not conflicts:
+        return None
+    return {'passed': False, 'resolved': [], 'conflicts': conflicts, 'output': f"{summarise(conflicts, python_version)}\n{stderr}"}
+
+# Runs probes in a warm, long running container per Python version (pllm-probe-<version>)
+# The containers are left running so every later snippet on that version probes without a container start
+class DockerProbe():
+    def __init__(self, client, network=None, logging=False) -> None:
+        self.client = client
+        self.network = network
+        self.logging = logging
+
+    def container(self, python_version):
+        import docker
+        name = f"pllm-probe-{python_version}"
+        try:
+            container = self.client.containers.get(name)
+            if container.status != 'running':
+                container.start()
+            return container
+        except docker.errors.NotFound:
+            try:
+                return self.client.containers.run(f"python:{python_version}", ['sleep', 'infinity'], name=name, detach=True, network=self.network)
+            except docker.errors.APIError:
+                # Another process created it first
+                return self.client.containers.get(name)
+
+    def probe(self, python_version, pins, extra_args=None):
+        if not supports_dry_run(python_version) or not pins: return None
+        try:
+            container = self.container(python_version)
+            # pips output goes to stderr and the report to stdout
+            report = f"/tmp/pllm-probe-{uuid.uuid4().hex}.json"
+            pip = ' '.join(shlex.quote(arg) for arg in ['python', '-m', 'pip'] + probe_args(pins, report, extra_args))
+            script = f"{pip} >&2; code=$?; cat {report} 2>/dev/null; rm -f {report}; exit $code"
+            code, (stdout, stderr) = container.exec_run(['sh', '-c', script], demux=True)
+        except Exception as e:
+            if self.logging: print(f"Probe failed to run: {e}")
+            return None
+        stdout = stdout.decode('utf-8', errors='replace') if stdout else ''
+        stderr = stderr.decode('utf-8', errors='replace') if stderr else ''
+        if self.logging: print(stderr)
+        return probe_result(code, stdout, stderr, pins, python_version)
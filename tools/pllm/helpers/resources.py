@@ -0,0 +1,154 @@
+# Host resource accounting and admission control
+# With many snippets and Python versions running at once, unbounded builds and runs (plus Ollama inference) use up
+# the hosts memory, and the kernel starts killing builds. Before each build or run a backend asks the admission
+# controller for a slot: there are at most `slots` builds and runs at once across every process sharing the state
+# folder, and one is only started while the host has `min_free` bytes of memory available on top of what it's
+# expected to use. Admissions that have only just started aren't visible in the hosts memory yet, so their
+# reservations are counted against it for the first `ramp` seconds.
+# Anything waiting polls until it's admitted, so new builds queue while the host is over budget.
+import argparse
+import fcntl
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from helpers.tracer import tracer
+
+# Memory a build or run is expected to use when no container memory limit is set
+DEFAULT_RESERVE = 512 * 1024 * 1024
+
+# The hosts total and available memory in bytes, from /proc/meminfo, (None, None) where there isn't one
+def host_memory():
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            meminfo = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in file if len(line.split()) >= 2}
+    except (OSError, ValueError):
+        return None, None
+    return meminfo.get('MemTotal'), meminfo.get('MemAvailable', meminfo.get('MemFree'))
+
+# Resident memory of a process in bytes, None if it can't be read
+def process_rss(pid='self'):
+    try:
+        with open(f"/proc/{pid}/status", 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+# Peak resident memory of this process in bytes
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class AdmissionController():
+    # slots: most builds and runs at once, None for no limit
+    # min_free: bytes of host memory that must stay available, None to not check the memory
+    # reserve: bytes each build or run is expected to use
+    # state_dir: folder holding a lock file per slot, shared by every process
+    # ramp: seconds an admissions reservation is counted against the host memory
+    # poll: seconds between checks while waiting
+    def __init__(self, slots=None, min_free=None, reserve=DEFAULT_RESERVE, state_dir='./admission', ramp=30.0, poll=2.0, logging=False) -> None:
+        self.slots = slots
+        self.min_free = min_free
+        self.reserve = reserve
+        self.state_dir = state_dir
+        self.ramp = ramp
+        self.poll = poll
+        self.logging = logging
+        os.makedirs(state_dir, exist_ok=True)
+
+    def slot_files(self):
+        # Without a slot limit every admission gets its own slot file, only the memory is checked
+        if self.slots is None:
+            return [f"{self.state_dir}/slot_{os.getpid()}_{time.time_ns()}"]
+        return [f"{self.state_dir}/slot_{slot}" for slot in range(self.slots)]
+
+    # Takes the first free slot, returning its open (locked) file or None if every slot is taken
+    def take_slot(self):
+        for slot_file in self.slot_files():
+            lock_file = open(slot_file, 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except OSError:
+                lock_file.close()
+        return None
+
+    def release_slot(self, lock_file):
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.flush()
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+        if self.slots is None: os.remove(lock_file.name)
+
+    # Bytes reserved by admissions that started less than `ramp` seconds ago
+    def ramping(self):
+        reserved = 0
+        for file in os.listdir(self.state_dir):
+            try:
+                with open(f"{self.state_dir}/{file}", 'r') as in_file:
+                    holder = json.loads(in_file.read() or '{}')
+            except (OSError, ValueError):
+                continue
+            if holder and time.time() - holder['time'] < self.ramp:
+                reserved += holder['reserve']
+        return reserved
+
+    # Whether the host has the memory for another build or run
+    def memory_ok(self):
+        if self.min_free is None: return True
+        total, available = host_memory()
+        if available is None: return True
+        return available - self.ramping() - self.reserve >= self.min_free
+
+    # Holds a slot for the wrapped build or run, waiting until one is free and the host has the memory for it
+    @contextmanager
+    def admit(self, stage):
+        start = time.time()
+        with tracer.span(f"admission:{stage}") as span:
+            while True:
+                lock_file = self.take_slot()
+                if lock_file is not None:
+                    if self.memory_ok(): break
+                    self.release_slot(lock_file)
+                if self.logging and time.time() - start < self.poll: print(f"Waiting for resources to {stage}")
+                time.sleep(self.poll)
+            span['args']['waited'] = time.time() - start
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(json.dumps({'pid': os.getpid(), 'stage': stage, 'reserve': self.reserve, 'time': time.time()}))
+        lock_file.flush()
+        try:
+            yield time.time() - start
+        finally:
+            self.release_slot(lock_file)
+
+    # Who holds the slots right now
+    def status(self):
+        total, available = host_memory()
+        holders = []
+        for file in sorted(os.listdir(self.state_dir)):
+            try:
+                with open(f"{self.state_dir}/{file}", 'r') as in_file:
+                    holder = json.loads(in_file.read() or '{}')
+            except (OSError, ValueError):
+                continue
+            if holder: holders.append(holder)
+        return {'slots': self.slots, 'held': holders, 'host_total': total, 'host_available': available, 'ramping': self.ramping()}
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Reports the hosts memory and who holds the admission slots')
+    parser.add_argument('-s', '--state', type=str, default='./admission', help="The admission state folder")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    print(AdmissionController(state_dir=args.state).status())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Run outcome cache
+# Once a build passes the snippet is always run, even when this exact snippet has already run on an identical
+# environment (repeated runs of a corpus, a resumed run...). Run outcomes are kept by a hash of the snippet and the
+# environment it ran in (the image ID for Docker), one JSON file per key, so a re-run gets its answer immediately.
+# Each outcome holds the exit code, the classified error and the logs, cut down to their start and end.
+# Snippets that don't give the same answer twice can opt out with a '# pllm: no-run-cache' comment, and runs that
+# look like network trouble or were killed for running out of memory are never kept.
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+# Comment a snippet can include to never have its runs cached
+OPT_OUT = 'pllm: no-run-cache'
+
+# Run output that could be different next time
+TRANSIENT = ['ConnectionError', 'Connection refused', 'Max retries exceeded', 'timed out', 'Temporary failure in name resolution', 'URLError', 'OOMKilled']
+
+# Cuts logs down to their start and end, where pythons errors and tracebacks are
+def truncate(logs, limit=20000):
+    if len(logs) <= limit: return logs
+    half = limit // 2
+    return f"{logs[:half]}\n... {len(logs) - limit} characters cut ...\n{logs[-half:]}"
+
+class RunCache():
+    # cache_dir: folder holding the outcomes, shared between processes
+    # max_age: seconds an outcome is trusted for
+    def __init__(self, cache_dir='./run_cache', max_age=30 * 24 * 3600, logging=False) -> None:
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.logging = logging
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # The key for a snippet run in an environment, None if the run can't be cached
+    def key(self, file, environment_id):
+        if not environment_id: return None
+        with open(file, 'rb') as in_file:
+            source = in_file.read()
+        if OPT_OUT.encode('utf-8') in source: return None
+        return hashlib.sha256(hashlib.sha256(source).hexdigest().encode('utf-8') + b'\n' + environment_id.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return f"{self.cache_dir}/{key}.json"
+
+    # The recorded outcome for a key, None if there isn't one or it's too old
+    def lookup(self, key):
+        if key is None: return None
+        try:
+            with open(self.path(key), 'r') as in_file:
+                entry = json.load(in_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('time', 0) > self.max_age: return None
+        return entry
+
+    def record(self, key, exit_code, error_type, logs):
+        if key is None or any(pattern in logs for pattern in TRANSIENT): return
+        entry = {'exit_code': exit_code, 'error_type': error_type, 'logs': truncate(logs), 'time': time.time()}
+        with open(f"{self.path(key)}.tmp", 'w') as out_file:
+            json.dump(entry, out_file)
+        os.replace(f"{self.path(key)}.tmp", self.path(key))
+
+    def stats(self):
+        entries = [self.lookup(os.path.basename(file)[:-len('.json')]) for file in glob.glob(f"{self.cache_dir}/*.json")]
+        entries = [entry for entry in entries if entry]
+        error_types = {}
+        for entry in entries:
+            error_types[entry['error_type']] = error_types.get(entry['error_type'], 0) + 1
+        return {'outcomes': len(entries), 'error_types': error_types}
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Reports on the run outcome cache')
+    parser.add_argument('-c', '--cache', type=str, default='./run_cache', help="The run cache folder")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    print(RunCache(args.cache).stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Cache-affinity scheduling of snippets
+# Running snippets in directory order (folder_to_file.sh) means consecutive builds rarely share a base image,
+# Docker layers or PyPI lookups. This orders snippets by their likely Python version, then greedily by how much
+# their modules overlap with what's already been built, so those caches stay hot. The order can be split into
+# contiguous chunks, one per worker, so each worker keeps its own caches hot.
+# The cache hit rate is predicted with a simple LRU model, and measured from finished runs (result_*.json).
+import argparse
+import csv
+import glob
+import json
+import os
+from collections import OrderedDict, defaultdict, Counter
+
+class AffinityScheduler():
+    # cache_size: how many base images + module layers the LRU model keeps hot
+    def __init__(self, cache_size=200, logging=False) -> None:
+        self.cache_size = cache_size
+        self.logging = logging
+        # name: {'python_version', 'modules'}
+        self.snippets = OrderedDict()
+
+    def add(self, name, python_version, modules):
+        self.snippets[name] = {'python_version': python_version if python_version else 'unknown', 'modules': sorted(set(modules))}
+
+    # Python version hints from a previous run summary (e.g. summary-all-runs.csv), preferring the version that passed
+    def load_hints(self, results_csv):
+        hints = {}
+        with open(results_csv, 'r') as file:
+            for row in csv.DictReader(file):
+                # Rows without an output log have no Python version to go on
+                if not row['file'].startswith('output_data_'): continue
+                python_version = row['file'].replace('output_data_', '').replace('.yml', '')
+                passed = int(row['passed']) if row['passed'] else 0
+                modules = [module for module in row['python_modules'].split(';') if module and module != 'none']
+                if not row['name'] in hints or passed > hints[row['name']]['passed']:
+                    hints[row['name']] = {'python_version': python_version, 'modules': modules, 'passed': passed}
+        return hints
+
+    # Adds every snippet in an archive, using the hints where there are any and the snippets own imports otherwise
+    def add_archive(self, archive, hints=None, names=None):
+        from helpers.snippet_dedup import SnippetDeduplicator
+        dedup = SnippetDeduplicator()
+        hints = hints if hints else {}
+        for name, source in archive.snippets(names):
+            hint = hints.get(name, {})
+            modules = hint.get('modules')
+            if not modules:
+                modules = dedup.import_signature(source.decode('utf-8', errors='replace'))
+            self.add(name, hint.get('python_version'), modules)
+
+    # The cache keys a snippet needs: its base image and a layer per module
+    def cache_keys(self, name):
+        snippet = self.snippets[name]
+        python_version = snippet['python_version']
+        return [f"python:{python_version}"] + [f"{python_version}/{module}" for module in snippet['modules']]
+
+    # Predicts the cache hit rate of running the snippets in the given order
+    # Every base image and module is looked up in an LRU cache of cache_size entries
+    def simulate(self, order):
+        cache = OrderedDict()
+        hits = 0
+        lookups = 0
+        for name in order:
+            for key in self.cache_keys(name):
+                lookups += 1
+                if key in cache:
+                    hits += 1
+                    cache.move_to_end(key)
+                else:
+                    cache[key] = True
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+        return {'hits': hits, 'lookups': lookups, 'hit_rate': hits / lookups if lookups > 0 else 0.0}
+
+    def jaccard(self, a, b):
+        if not a and not b: return 1.0
+        return len(a & b) / len(a | b)
+
+    # Greedy nearest neighbour within a Python version
+    # Starts from the snippet whose modules are most common, then always picks the snippet that overlaps most with the
+    # modules of the last few snippets run
+    def order_group(self, names, window=5):
+        remaining = {name: set(self.snippets[name]['modules']) for name in names}
+        popularity = Counter(module for modules in remaining.values() for module in modules)
+        current = max(remaining, key=lambda name: (sum(popularity[module] for module in remaining[name]), name))
+        order = []
+        recent = []
+        while remaining:
+            order.append(current)
+            recent = (recent + [remaining.pop(current)])[-window:]
+            if not remaining: break
+            hot = set().union(*recent)
+            # Ties go to the larger module set, so shared prefixes are built before the snippets that extend them
+            current = max(remaining, key=lambda name: (self.jaccard(remaining[name], hot), len(remaining[name]), name))
+        return order
+
+    # Orders every snippet, largest Python version group first so the most reused base images are pulled once
+    def schedule(self):
+        groups = defaultdict(list)
+        for name, snippet in self.snippets.items():
+            groups[snippet['python_version']].append(name)
+        order = []
+        for python_version in sorted(groups, key=lambda version: (-len(groups[version]), version)):
+            if self.logging: print(f"Python {python_version}: {len(groups[python_version])} snippets")
+            order += self.order_group(groups[python_version])
+        return order
+
+    # Splits an order into contiguous chunks, one per worker, so related snippets stay on the same worker
+    def partition(self, order, workers):
+        size = -(-len(order) // workers) if workers > 0 else len(order)
+        return [order[i:i + size] for i in range(0, len(order), size)]
+
+    # Deals an order out round robin, as workers taking the next snippet from a shared queue would
+    def deal(self, order, workers):
+        return [order[i::workers] for i in range(min(workers, len(order)))] if workers > 1 else [order]
+
+    # Hit rate across every workers own cache
+    def hit_rate(self, chunks):
+        results = [self.simulate(chunk) for chunk in chunks]
+        hits = sum(result['hits'] for result in results)
+        lookups = sum(result['lookups'] for result in results)
+        return hits / lookups if lookups > 0 else 0.0
+
+    # Predicted hit rates for directory order against the schedule, with the same number of workers
+    # Directory order is dealt round robin, the schedule is split into the contiguous chunks partition gives each worker
+    def report(self, order, workers=1):
+        chunks = self.partition(order, workers)
+        return {
+            'snippets': len(order),
+            'workers': len(chunks),
+            'cache_size': self.cache_size,
+            'directory_order_hit_rate': self.hit_rate(self.deal(list(self.snippets), len(chunks))),
+            'scheduled_hit_rate': self.hit_rate(chunks),
+        }
+
+# Measures the Docker layer cache hit rate achieved by finished runs in a results tree
+def measure(results_dir):
+    hits = 0
+    steps = 0
+    for file in glob.glob(f"{results_dir}/*/result_*.json"):
+        with open(file, 'r') as in_file:
+            result = json.load(in_file)
+        hits += result.get('cache_hits', 0)
+        steps += result.get('cache_steps', 0)
+    return {'cache_hits': hits, 'cache_steps': steps, 'hit_rate': hits / steps if steps > 0 else 0.0}
+
+# Writes the order out in the same format as folder_to_file.sh, one gist per line
+def write_order(order, output, prefix=''):
+    with open(output, 'w') as file:
+        for name in order:
+            file.write(f"{prefix}{name}\n")
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Orders snippets so consecutive builds share base images, layers and PyPI lookups')
+    parser.add_argument('-a', '--archive', type=str, default='../../hard-gists.tar.gz', help="The gist archive to schedule")
+    parser.add_argument('-c', '--csv', type=str, default='../../pllm_results/csv/summary-all-runs.csv', help="Previous results, used for Python version and module hints")
+    parser.add_argument('-o', '--output', type=str, default='my_gists.csv', help="Where to write the ordered gist list, with -w each worker gets its own numbered file")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Split the order into this many contiguous lists")
+    parser.add_argument('-s', '--cache-size', type=int, default=200, help="Base images + module layers kept hot in the cache model")
+    parser.add_argument('-m', '--measure', type=str, default=None, help="Report the layer cache hit rate measured in a results tree instead of scheduling")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Verbose logging of information")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    if args.measure:
+        print(measure(args.measure))
+        return
+
+    from helpers.gist_archive import GistArchive
+    scheduler = AffinityScheduler(cache_size=args.cache_size, logging=args.verbose)
+    hints = scheduler.load_hints(args.csv) if args.csv and os.path.isfile(args.csv) else {}
+    scheduler.add_archive(GistArchive(args.archive), hints)
+    order = scheduler.schedule()
+
+    chunks = scheduler.partition(order, args.workers)
+    if len(chunks) == 1:
+        write_order(order, args.output)
+    else:
+        root, ext = os.path.splitext(args.output)
+        for i, chunk in enumerate(chunks):
+            write_order(chunk, f"{root}_{i}{ext}")
+    print(scheduler.report(order, args.workers))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Snippet deduplication and import-signature clustering
+# Many gists are near-identical copies, or share exactly the same set of imports.
+# Snippets are grouped by a hash of their normalised content (exact duplicates, which can share a result outright)
+# and by their set of non standard library imports (which can warm start from each other's result).
+# The first snippet seen in each group is its representative, the mapping is persisted as JSON along with what it was
+# built from, and built again when the archive, the snippets picked from it or the normalisation change.
+import hashlib
+import json
+import os
+
+from helpers.deps_scraper import DepsScraper
+
+# Bumped whenever normalise changes, mappings made with an older one are built again
+NORMALISER_VERSION = 2
+
+class SnippetDeduplicator():
+    def __init__(self, logging=False) -> None:
+        self.logging = logging
+        self.deps = DepsScraper(logging=False)
+        self.snippets = {}
+        self.content_groups = {}
+        self.import_groups = {}
+
+    # Strips comments, blank lines and trailing whitespace so trivially different copies hash the same
+    # Indentation is kept, it's the block structure, copies indented differently can run differently
+    def normalise(self, source):
+        lines = []
+        for line in source.replace('\r\n', '\n').split('\n'):
+            line = line.rstrip()
+            if line.strip() == '' or line.lstrip().startswith('#'):
+                continue
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def content_hash(self, source):
+        return hashlib.sha256(self.normalise(source).encode('utf-8')).hexdigest()
+
+    # Sorted, top level, non standard library imports of a snippet
+    def import_signature(self, source):
+        try:
+            imports = self.deps.find_word_in_lines(source.split('\n'), 'import', [])
+        except Exception as e:
+            imports = []
+        modules = []
+        for module in imports:
+            module = module.split('.')[0].replace(';', '').replace(',', '').strip()
+            # Skips relative imports, __main__/__future__ and anything that isn't a module name
+            if module.isidentifier() and not module.startswith('__') and not module in modules:
+                modules.append(module)
+        return sorted(self.deps.clean_deps(modules))
+
+    # Adds a snippet to its content and import groups
+    def add(self, name, source):
+        if type(source) == bytes:
+            source = source.decode('utf-8', errors='replace')
+        content_hash = self.content_hash(source)
+        imports = self.import_signature(source)
+        import_hash = hashlib.sha256(','.join(imports).encode('utf-8')).hexdigest()
+
+        self.content_groups.setdefault(content_hash, []).append(name)
+        if len(imports) > 0:
+            self.import_groups.setdefault(import_hash, {'imports': imports, 'snippets': []})['snippets'].append(name)
+
+        self.snippets[name] = {
+            'content_hash': content_hash,
+            'imports': imports,
+            'import_hash': import_hash if len(imports) > 0 else None,
+        }
+
+    # Builds the groups from (name, source) pairs, e.g. GistArchive.snippets()
+    def build(self, snippets):
+        for name, source in snippets:
+            self.add(name, source)
+        if self.logging: print(self.summary())
+        return self
+
+    # The representative of an exact duplicate, None if the snippet is its own representative
+    def duplicate_of(self, name):
+        if name not in self.snippets: return None
+        representative = self.content_groups[self.snippets[name]['content_hash']][0]
+        return representative if representative != name else None
+
+    # The representative of the snippets import group, None if the snippet is its own representative or has no imports
+    def warm_start_from(self, name):
+        if name not in self.snippets or not self.snippets[name]['import_hash']: return None
+        representative = self.import_groups[self.snippets[name]['import_hash']]['snippets'][0]
+        return representative if representative != name else None
+
+    def summary(self):
+        exact = sum(len(names) - 1 for names in self.content_groups.values())
+        shared = sum(len(group['snippets']) - 1 for group in self.import_groups.values())
+        return {
+            'snippets': len(self.snippets),
+            'unique_contents': len(self.content_groups),
+            'exact_duplicates': exact,
+            'import_groups': len(self.import_groups),
+            'warm_startable': shared,
+        }
+
+    # What a mapping is built from: the archive (path, size, modification time), the snippets picked from it and the normaliser
+    def source(self, archive=None, names=None):
+        source = {'normaliser': NORMALISER_VERSION}
+        if archive:
+            stat = os.stat(archive)
+            source.update({'archive': os.path.abspath(archive), 'size': stat.st_size, 'mtime': stat.st_mtime})
+        if names:
+            source['names'] = hashlib.sha256('\n'.join(sorted(names)).encode('utf-8')).hexdigest()
+        return source
+
+    def save(self, file, source=None):
+        with open(file, 'w') as out_file:
+            json.dump({'summary': self.summary(), 'source': source, 'snippets': self.snippets, 'content_groups': self.content_groups, 'import_groups': self.import_groups}, out_file, indent=2)
+
+    def load(self, file):
+        with open(file, 'r') as in_file:
+            mapping = json.load(in_file)
+        self.snippets = mapping['snippets']
+        self.content_groups = mapping['content_groups']
+        self.import_groups = mapping['import_groups']
+        return self
+
+    # Puts each groups snippets in the order they'll run, so its representative is the first to have results
+    # Snippets that aren't in names go last
+    def order(self, names):
+        position = {name: index for index, name in enumerate(names)}
+        def run_order(group):
+            return sorted(group, key=lambda name: position.get(name, len(position)))
+        self.content_groups = {key: run_order(group) for key, group in self.content_groups.items()}
+        for group in self.import_groups.values():
+            group['snippets'] = run_order(group['snippets'])
+        return self
+
+    # Loads the mapping if it's already been persisted from the same archive, snippets and normaliser
+    # Otherwise builds and saves it, snippets is only read then
+    def load_or_build(self, file, snippets, archive=None, names=None):
+        source = self.source(archive, names)
+        if os.path.isfile(file):
+            with open(file, 'r') as in_file:
+                saved = json.load(in_file).get('source')
+            if saved == source:
+                return self.load(file)
+            if self.logging: print(f"{file} was built from a different archive, snippet list or normaliser, building it again")
+        self.build(snippets)
+        self.save(file, source)
+        return self
@@ -0,0 +1,129 @@
+# Lightweight tracing for the build/run loop
+# Spans are stored as Chrome trace 'complete' events so the exported files open in chrome://tracing or Perfetto
+# There is one tracer per process (see `tracer` below), forked worker processes reset it and export their own file
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+class Tracer():
+    def __init__(self, enabled=False) -> None:
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+
+    # Times the wrapped block as a span
+    # Yields the event so the caller can rename it or add args once more is known (e.g. the error type)
+    @contextmanager
+    def span(self, name, **args):
+        event = {'name': name, 'cat': name.split(':')[0], 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        if not self.enabled:
+            yield event
+            return
+        start = time.time()
+        try:
+            yield event
+        finally:
+            end = time.time()
+            event['ts'] = start * 1e6
+            event['dur'] = (end - start) * 1e6
+            with self.lock:
+                self.events.append(event)
+
+    # Drops all recorded spans, used by forked processes so the parents spans aren't exported twice
+    def reset(self):
+        with self.lock:
+            self.events = []
+
+    # Hands over the recorded spans and starts again, for callers keeping spans across several runs (see benchmark.py)
+    def drain(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    # Writes the spans out as a Chrome trace file
+    def export(self, file, metadata=None):
+        if not self.enabled: return
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'otherData': metadata if metadata else {}}
+        with open(file, 'w') as out_file:
+            json.dump(trace, out_file)
+
+    def summary(self):
+        with self.lock:
+            return summarise_events(self.events)
+
+# The tracer for this process
+tracer = Tracer()
+
+
+# Count, total, mean and max time (in seconds) for each span name
+def summarise_events(events):
+    totals = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+    for event in events:
+        if event.get('ph') != 'X': continue
+        details = totals[event['name']]
+        duration = event['dur'] / 1e6
+        details['count'] += 1
+        details['total'] += duration
+        details['max'] = max(details['max'], duration)
+    for details in totals.values():
+        details['mean'] = details['total'] / details['count']
+    return dict(totals)
+
+# Finds every exported trace file under the given folder
+def find_traces(folder):
+    traces = []
+    for root, dirs, files in os.walk(folder):
+        for file_name in files:
+            if file_name.startswith('trace_') and file_name.endswith('.json'):
+                traces.append(os.path.join(root, file_name))
+    return sorted(traces)
+
+# Loads the events from a list of trace files
+def load_events(traces):
+    events = []
+    for trace in traces:
+        try:
+            with open(trace, 'r') as file:
+                events += json.load(file)['traceEvents']
+        except Exception as e:
+            print(f"Unable to load trace {trace}: {e}")
+    return events
+
+def print_summary(summary):
+    wall_time = sum(details['total'] for details in summary.values())
+    print(f"{'span':<36}{'count':>8}{'total (s)':>12}{'mean (s)':>10}{'max (s)':>10}")
+    for name, details in sorted(summary.items(), key=lambda item: item[1]['total'], reverse=True):
+        print(f"{name:<36}{details['count']:>8}{details['total']:>12.2f}{details['mean']:>10.2f}{details['max']:>10.2f}")
+    print(f"Sum of span time: {wall_time:.2f}s (spans can nest)")
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Aggregate trace files across a corpus run')
+    parser.add_argument('-f', '--folder', type=str, help="The folder containing the snippets and their trace_*.json files")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write the aggregated summary as JSON to this file")
+    parser.add_argument('-m', '--merge', type=str, default=None, help="Write all events into a single Chrome trace file")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    traces = find_traces(args.folder)
+    events = load_events(traces)
+    summary = summarise_events(events)
+
+    print(f"Loaded {len(events)} spans from {len(traces)} trace files")
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(summary, file, indent=2)
+    if args.merge:
+        with open(args.merge, 'w') as file:
+            json.dump({'traceEvents': events}, file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# Local interpreter + virtualenv execution backend
+# Uses Python versions already installed on the host instead of Docker images, for hosts where
+# Docker-in-Docker is slow or unavailable. Creating a venv is much cheaper than building an image.
+# Packages can be installed from a local wheelhouse (--find-links), optionally with no index at all.
+import glob
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from helpers.execution_backend import ExecutionBackend
+from helpers.version_window import version_key
+from helpers.wheelhouse import wheel_tag
+from helpers.resolution_probe import supports_dry_run, probe_args, probe_result
+
+# Exit code reported for a command that ran past the timeout, the same as coreutils timeout
+# Not -9, which classify_error takes as a process the kernel killed for using too much memory
+TIMED_OUT = 124
+
+class VenvHelper(ExecutionBackend):
+    # python_dirs: extra folders to look for pythonX.Y interpreters in, before the PATH
+    # wheelhouse: local folder of wheels/sdists to install from
+    # no_index: only install from the wheelhouse, never from PyPI
+    # venv_root: where the venvs are created, defaults to a .venvs folder next to the snippet
+    # shared_wheels: build each pin into the wheelhouse (one folder per Python tag, e.g. cp27) before installing it
+    def __init__(self, logging=False, python_dirs=None, wheelhouse=None, no_index=False, venv_root=None, timeout=600, shared_wheels=False, install_mode='sequential', admission=None) -> None:
+        super().__init__(logging=logging, install_mode=install_mode, admission=admission)
+        self.python_dirs = python_dirs if python_dirs else []
+        self.wheelhouse = wheelhouse
+        self.no_index = no_index
+        self.venv_root = venv_root
+        self.timeout = timeout
+        self.shared_wheels = shared_wheels and wheelhouse is not None
+        self.python_version = ''
+        self.pins = []
+        self.venv_dir = ''
+        self.project_dir = ''
+        self.project_file = ''
+        # Names match the Docker backend so logging reads the same
+        self.requirements_name = ''
+        self.container_name = ''
+
+    # Finds an interpreter for the given Python version (e.g. 2.7)
+    # Looks in the given folders, then pyenv, then the PATH
+    def find_interpreter(self, python_version):
+        name = f"python{python_version}"
+        for python_dir in self.python_dirs:
+            candidate = os.path.join(python_dir, name)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+        # pyenv folders are full versions (3.10.4), the newest patch release of exactly this version is used
+        pyenv = [folder for folder in glob.glob(os.path.expanduser(f"~/.pyenv/versions/{python_version}*"))
+                 if re.fullmatch(rf"{re.escape(python_version)}(\.\d+)?", os.path.basename(folder)) and os.path.isfile(f"{folder}/bin/python")]
+        if pyenv:
+            return f"{max(pyenv, key=lambda folder: version_key(os.path.basename(folder)))}/bin/python"
+        return shutil.which(name)
+
+    # Records the pins and writes them out as requirements-llm-<python version>.txt, the venv equivalent of the Dockerfile
+    def create_environment(self, llm_out, file):
+        self.project_dir, dir_name, self.project_file = self.get_project_dir(file)
+        self.python_version = llm_out['python_version']
+        self.pins = self.get_pins(llm_out)
+        if self.logging: print(self.pins)
+
+        self.container_name = f"{dir_name}_{self.python_version}"
+        self.requirements_name = f"requirements-llm-{self.python_version}.txt"
+        venv_root = self.venv_root if self.venv_root else f"{self.project_dir}/.venvs"
+        self.venv_dir = f"{venv_root}/{self.container_name}"
+
+        with open(f"{self.project_dir}/{self.requirements_name}", "w") as out_file:
+            out_file.write('\n'.join(f"{name}=={version}" for name, version in self.pins))
+
+    # Calls a command, returning the exit code and the combined output
+    def call(self, cmd, cwd=None):
+        try:
+            process = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=self.timeout)
+            return process.returncode, process.stdout
+        except subprocess.TimeoutExpired as e:
+            output = e.stdout if e.stdout else ''
+            output = output.decode('utf-8', errors='replace') if type(output) == bytes else output
+            return TIMED_OUT, f"{output}\nTimed out after {self.timeout} seconds"
+
+    # Creates a fresh venv, using virtualenv for Python 2 which has no venv module
+    def create_venv(self, interpreter):
+        if self.python_version.startswith('2.'):
+            virtualenv = shutil.which('virtualenv')
+            cmd = [virtualenv, '-p', interpreter, '--clear', self.venv_dir] if virtualenv else [interpreter, '-m', 'virtualenv', '--clear', self.venv_dir]
+        else:
+            cmd = [interpreter, '-m', 'venv', '--clear', self.venv_dir]
+        return self.call(cmd)
+
+    def venv_python(self):
+        return f"{self.venv_dir}/bin/python"
+
+    # Folder this Python versions wheels are shared in
+    def wheel_dir(self):
+        return f"{self.wheelhouse}/{wheel_tag(self.python_version)}"
+
+    def pip_command(self, requirements, action='install'):
+        cmd = [self.venv_python(), '-m', 'pip', action, '--disable-pip-version-check', '--default-timeout=100']
+        if self.wheelhouse:
+            cmd += ['--find-links', self.wheelhouse]
+        if self.shared_wheels:
+            cmd += ['--find-links', self.wheel_dir()]
+        if self.no_index:
+            cmd += ['--no-index']
+        return cmd + requirements
+
+    # Creates the venv and installs the pins, one at a time (or all together in single mode) like the Dockerfile RUN lines
+    # Failures are reported with the same 'returned a non-zero code' line as a Docker build so process_error handles them
+    def build_environment(self, file):
+        interpreter = self.find_interpreter(self.python_version)
+        if not interpreter:
+            print(f"No interpreter found for Python {self.python_version}")
+            return False, f"ERROR: No interpreter found for Python {self.python_version}"
+
+        code, output = self.create_venv(interpreter)
+        if self.logging: print(output)
+        if code != 0:
+            return False, f"ERROR: Could not create a venv for Python {self.python_version}\n{output}"
+
+        requirements = [f"{name}=={version}" for name, version in self.pins]
+        # Single mode hands pip every pin at once, otherwise one install per pin
+        installs = [requirements] if self.install_mode == 'single' and requirements else [[requirement] for requirement in requirements]
+        self.build_log = ''
+        with self.admit('build'):
+            for install in installs:
+                if self.shared_wheels:
+                    # A pin that won't wheel is left for the install to report
+                    os.makedirs(self.wheel_dir(), exist_ok=True)
+                    code, output = self.call(self.pip_command(['-w', self.wheel_dir()] + install, action='wheel'))
+                    if self.logging: print(output)
+                cmd = self.pip_command(install)
+                code, output = self.call(cmd)
+                self.build_log += output
+                if self.logging: print(output)
+                if code != 0:
+                    return False, f"{output}\nERROR: The command 'pip {' '.join(cmd[3:])}' returned a non-zero code: {code}"
+
+        return True, ""
+
+    # Resolves the pins with the interpreters own pip, nothing is installed so no venv is needed
+    def probe_environment(self, llm_out):
+        python_version = llm_out['python_version']
+        interpreter = self.find_interpreter(python_version)
+        pins = self.get_pins(llm_out)
+        if not interpreter or not pins or not supports_dry_run(python_version): return None
+
+        extra_args = ['--find-links', self.wheelhouse] if self.wheelhouse else []
+        if self.shared_wheels: extra_args += ['--find-links', f"{self.wheelhouse}/{wheel_tag(python_version)}"]
+        if self.no_index: extra_args += ['--no-index']
+        handle, report = tempfile.mkstemp(prefix='pllm-probe-', suffix='.json')
+        os.close(handle)
+        try:
+            code, output = self.call([interpreter, '-m', 'pip'] + probe_args(pins, report, extra_args))
+            with open(report, 'r') as in_file:
+                report_json = in_file.read()
+        finally:
+            os.remove(report)
+        if self.logging: print(output)
+        return probe_result(code, report_json, output, pins, python_version)
+
+    # Runs the snippet with the venvs interpreter, returning stdout and stderr together like the container logs
+    def run_test(self):
+        with self.admit('run'):
+            code, output = self.call([self.venv_python(), self.project_file], cwd=self.project_dir)
+        self.exit_code = code
+        if self.logging: print(f"exit code {code}")
+        return output
+
+    def cleanup(self):
+        if self.venv_dir:
+            shutil.rmtree(self.venv_dir, ignore_errors=True)
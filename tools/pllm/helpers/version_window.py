@@ -0,0 +1,96 @@
+# Compact version-candidate windows for the RAG prompts
+# The version files can hold hundreds of versions (django, numpy...) and pasting them all makes every prompt long,
+# which is what drives inference time on CPU-only Ollama hosts. This picks a representative subset within a token
+# budget, in priority order:
+#   known good versions, releases from the target Pythons date window (newest first), neighbours of the version being
+#   replaced, the most recent releases, the latest release of each major.minor line and then evenly spaced samples.
+# Previously failing versions are never included. The subset is returned oldest to newest, like the version files.
+import math
+import re
+
+# Rough token count, ~4 characters a token for version strings and separators
+def estimate_tokens(text):
+    return math.ceil(len(text) / 4)
+
+# Sorts versions the same way PyPIQuery writes them
+def version_key(version):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', version)]
+
+def release_line(version):
+    return '.'.join(version.split('.')[:2])
+
+class VersionWindow():
+    # budget: tokens the joined versions may use, 0 or None sends every version
+    # recent: how many of the newest releases to include, neighbours: how many either side of the version being replaced
+    def __init__(self, budget=150, recent=3, neighbours=2, logging=False) -> None:
+        self.budget = budget
+        self.recent = recent
+        self.neighbours = neighbours
+        self.logging = logging
+
+    # versions: list or comma separated string, oldest to newest
+    # target: the version being replaced, its neighbours are included
+    # negatives: versions that have already failed
+    # known_good: versions that have worked before
+    # dates: version -> {'date', 'in_window'} from PyPIQuery.read_module_dates
+    def select(self, versions, target=None, negatives=(), known_good=(), dates=None):
+        if type(versions) == str:
+            versions = [version.strip() for version in versions.split(',')]
+        negatives = set(str(version) for version in negatives if version)
+        versions = [version for version in versions if version and version not in negatives]
+        if not self.budget or estimate_tokens(', '.join(versions)) <= self.budget:
+            return versions
+
+        tiers = [[version for version in known_good if version in versions]]
+
+        if dates:
+            in_window = [version for version in versions if dates.get(version, {}).get('in_window')]
+            tiers.append(sorted(in_window, key=lambda version: dates[version]['date'], reverse=True))
+
+        if target:
+            others = [version for version in versions if version != target]
+            position = sorted(others + [target], key=version_key).index(target)
+            below = others[max(0, position - self.neighbours):position]
+            above = others[position:position + self.neighbours]
+            tiers.append([version for pair in zip(reversed(below), above) for version in pair] + below + above)
+
+        tiers.append(list(reversed(versions[-self.recent:])))
+
+        heads = {}
+        for version in versions:
+            heads[release_line(version)] = version
+        tiers.append(sorted(heads.values(), key=version_key, reverse=True))
+
+        # Evenly spaced samples fill anything left in the budget
+        step = max(1, len(versions) // 10)
+        tiers.append(versions[::step])
+
+        selected = set()
+        used = 0
+        for tier in tiers:
+            for version in tier:
+                if version in selected: continue
+                cost = estimate_tokens(f"{version}, ")
+                if used + cost > self.budget: break
+                selected.add(version)
+                used += cost
+        if self.logging: print(f"Version window: {len(selected)} of {len(versions)} versions")
+        return sorted(selected, key=version_key)
+
+    # The selected versions joined for a prompt
+    def window(self, versions, target=None, negatives=(), known_good=(), dates=None):
+        return ', '.join(self.select(versions, target, negatives, known_good, dates))
+
+    # Shortens a pip error to its 'Could not find a version' lines, windowing the '(from versions: ...)' list
+    # known_good: module -> versions that have worked before, kept in that modules window
+    def compact_error(self, error, negatives=(), known_good=None):
+        if not self.budget: return error
+        lines = [line for line in error.split('\n') if 'Could not find a version' in line or 'No matching distribution' in line]
+        if not lines: return error
+        known_good = known_good if known_good else {}
+
+        def compact(line):
+            module = re.search(r"requirement ([A-Za-z0-9_.\-]+)", line)
+            good = known_good.get(module.group(1), ()) if module else ()
+            return re.sub(r"\(from versions: ([^)]*)\)", lambda match: f"(from versions: {self.window(match.group(1), negatives=negatives, known_good=good)})", line)
+        return '\n'.join(compact(line) for line in lines)
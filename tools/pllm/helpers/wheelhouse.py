@@ -0,0 +1,94 @@
+# Shared wheelhouse for generated Docker builds
+# Every RUN pip install in a generated Dockerfile downloads, and for sdists compiles, its package from scratch.
+# Before a build the pins are turned into wheels (with their dependencies) in a named volume, one folder per
+# Python tag (e.g. cp27), using a shared pip cache volume for the downloads. A small index container serves the
+# volume over HTTP on a Docker network the builds join, so the Dockerfiles install with --find-links and a repeat
+# install is a local copy rather than another compile.
+# BuildKit cache mounts would be the other way to do this, but the docker SDK only drives the classic builder.
+import shlex
+
+# Python/ABI tag folder for a Python version, e.g. 2.7 -> cp27
+def wheel_tag(python_version):
+    return 'cp' + ''.join(str(python_version).split('.')[:2])
+
+# Wheel file names use the normalised project name, e.g. python-dateutil -> python_dateutil
+def wheel_name(name):
+    return name.replace('-', '_').replace('.', '_').lower()
+
+class Wheelhouse():
+    # client: docker client
+    # volume: named volume holding the wheels, pip_cache: named volume for pips download cache
+    # network: Docker network shared by the index container and the builds
+    def __init__(self, client, volume='pllm-wheelhouse', pip_cache='pllm-pip-cache', network='pllm-wheelhouse',
+                 server_name='pllm-wheelhouse', server_image='python:3.11-slim', port=8000, logging=False) -> None:
+        self.client = client
+        self.volume = volume
+        self.pip_cache = pip_cache
+        self.network = network
+        self.server_name = server_name
+        self.server_image = server_image
+        self.port = port
+        self.logging = logging
+        # Pins already wheeled (or tried) by this process
+        self.seen = set()
+
+    # Base URL the builds read wheels from
+    def url(self, python_version):
+        return f"http://{self.server_name}:{self.port}/{wheel_tag(python_version)}/"
+
+    # Extra pip install arguments for a generated Dockerfile
+    def pip_args(self, python_version):
+        return ['--find-links', self.url(python_version), '--trusted-host', self.server_name]
+
+    # Creates the network, volumes and index container if they don't already exist
+    # Every process calls this, so losing a race to create something is fine
+    def start(self):
+        import docker
+        try:
+            if not self.client.networks.list(names=[self.network]):
+                self.client.networks.create(self.network, driver='bridge')
+            # Creating a volume that already exists just returns it
+            self.client.volumes.create(self.volume)
+            self.client.volumes.create(self.pip_cache)
+        except docker.errors.APIError as e:
+            if self.logging: print(e)
+
+        try:
+            server = self.client.containers.get(self.server_name)
+            if server.status != 'running':
+                server.start()
+        except docker.errors.NotFound:
+            try:
+                self.client.containers.run(self.server_image, ['python', '-m', 'http.server', str(self.port), '--directory', '/wheels'],
+                                           name=self.server_name, detach=True, network=self.network, restart_policy={'Name': 'unless-stopped'},
+                                           volumes={self.volume: {'bind': '/wheels', 'mode': 'ro'}})
+            except docker.errors.APIError as e:
+                if self.logging: print(e)
+
+    # Builds wheels for any pins the wheelhouse doesn't have yet, in a throwaway container of the matching Python
+    # Pins that fail to wheel are marked so they aren't retried, the real build reports the error
+    def ensure(self, python_version, pins):
+        tag = wheel_tag(python_version)
+        pins = [(name, version) for name, version in pins if (tag, name, version) not in self.seen]
+        if not pins: return ''
+
+        wheels = f"/wheels/{tag}"
+        script = [f"mkdir -p {wheels}"]
+        for name, version in pins:
+            pin = shlex.quote(f"{name}=={version}")
+            marker = shlex.quote(f"{wheels}/.failed-{wheel_name(name)}-{version}")
+            prefix = shlex.quote(f"^{wheel_name(name)}-{version}-")
+            script.append(f"ls {wheels} | grep -qi {prefix} || [ -e {marker} ] || "
+                          f"pip wheel --disable-pip-version-check --find-links {wheels} -w {wheels} {pin} || touch {marker}")
+
+        self.start()
+        output = ''
+        try:
+            output = self.client.containers.run(f"python:{python_version}", ['sh', '-c', ' ; '.join(script)], remove=True,
+                                                volumes={self.volume: {'bind': '/wheels', 'mode': 'rw'}, self.pip_cache: {'bind': '/root/.cache/pip', 'mode': 'rw'}})
+            output = output.decode('utf-8', errors='replace') if type(output) == bytes else output
+        except Exception as e:
+            output = str(e)
+        if self.logging: print(output)
+        self.seen.update((tag, name, version) for name, version in pins)
+        return output
@@ -0,0 +1,176 @@
+# Durable job queue for distributed corpus runs
+# A corpus run is split into a job per snippet. Workers on any number of hosts claim jobs, run them and hand back
+# their outputs, so throughput scales with the number of Docker daemons rather than being capped by one host.
+# Claiming a job takes a lease on it. A worker renews its lease with heartbeats while the job runs, and a job whose
+# lease runs out (the worker died, lost its network or was killed) is handed to the next worker that asks, up to
+# `max_attempts` times. Each finished job's output files are stored with it, so every worker's results merge into
+# one results tree, whichever host they ran on.
+# This implementation is a SQLite file, fine for several workers on one host or a shared filesystem with working
+# locks. Another store (a database server, a cloud queue) only needs the same methods.
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    source BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    queued REAL,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    name TEXT NOT NULL,
+    file TEXT NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (name, file)
+);
+"""
+
+class WorkQueue():
+    # path: the SQLite file holding the jobs and their outputs
+    # lease: seconds a claimed job belongs to its worker without a heartbeat
+    # max_attempts: how many times a job is handed out before it's marked failed
+    def __init__(self, path='./work_queue.db', lease=600, max_attempts=3, logging=False) -> None:
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.logging = logging
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    # A connection per call, so the queue can be used from the heartbeat thread and forked processes
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    # Runs the wrapped statements as one write transaction
+    @contextmanager
+    def transaction(self):
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    # Queues snippets as (name, source) pairs, snippets already in the queue are left as they are
+    # Returns how many were added
+    def enqueue(self, snippets):
+        added = 0
+        with self.transaction() as db:
+            for name, source in snippets:
+                cursor = db.execute('INSERT OR IGNORE INTO jobs (name, source, queued) VALUES (?, ?, ?)', (name, source, time.time()))
+                added += cursor.rowcount
+        return added
+
+    # Leases the next job to a worker, a queued job or one whose lease has run out
+    # Returns {'name', 'source', 'attempts'} or None once there's nothing left to hand out
+    def claim(self, worker):
+        now = time.time()
+        with self.transaction() as db:
+            # Abandoned jobs that have used up their attempts are given up on
+            db.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', finished = ? WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                       (now, now, self.max_attempts))
+            row = db.execute("SELECT name, source, attempts FROM jobs WHERE status = 'queued' OR (status = 'leased' AND lease_until < ?) ORDER BY attempts, queued LIMIT 1",
+                             (now,)).fetchone()
+            if row is None: return None
+            if self.logging and row['attempts'] > 0: print(f"Retrying {row['name']}, attempt {row['attempts'] + 1}")
+            db.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, started = ? WHERE name = ?",
+                       (worker, now + self.lease, now, row['name']))
+        return {'name': row['name'], 'source': row['source'], 'attempts': row['attempts'] + 1}
+
+    # Renews a workers lease on a job, False if the job isn't the workers any more
+    def heartbeat(self, name, worker):
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET lease_until = ? WHERE name = ? AND worker = ? AND status = 'leased'", (time.time() + self.lease, name, worker))
+        return cursor.rowcount == 1
+
+    # Keeps a workers lease on a job renewed from a background thread while the wrapped block runs
+    @contextmanager
+    def leased(self, name, worker):
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(self.lease / 3):
+                if not self.heartbeat(name, worker) and self.logging:
+                    print(f"Lost the lease on {name}")
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    # Marks a job done and stores its output files ({file name: bytes})
+    # Returns False if the lease was lost and another worker has the job, the outputs are then dropped
+    def complete(self, name, worker, outputs):
+        with self.transaction() as db:
+            cursor = db.execute("UPDATE jobs SET status = 'done', lease_until = NULL, error = NULL, finished = ? WHERE name = ? AND worker = ? AND status = 'leased'",
+                                (time.time(), name, worker))
+            if cursor.rowcount != 1: return False
+            db.execute('DELETE FROM outputs WHERE name = ?', (name,))
+            db.executemany('INSERT INTO outputs (name, file, content) VALUES (?, ?, ?)', [(name, file, content) for file, content in outputs.items()])
+        return True
+
+    # Hands a job back after an error, it's queued again until it's used up its attempts
+    def fail(self, name, worker, error):
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, lease_until = NULL, error = ?, finished = ? "
+                       "WHERE name = ? AND worker = ? AND status = 'leased'", (self.max_attempts, error, time.time(), name, worker))
+
+    # Writes every finished jobs outputs into one results tree, laid out like archive mode (<results_dir>/<name>/...)
+    # Returns how many jobs were written
+    def merge(self, results_dir):
+        names = set()
+        with self.connect() as db:
+            for row in db.execute("SELECT outputs.name, outputs.file, outputs.content FROM outputs JOIN jobs ON jobs.name = outputs.name WHERE jobs.status = 'done'"):
+                os.makedirs(f"{results_dir}/{row['name']}", exist_ok=True)
+                with open(f"{results_dir}/{row['name']}/{row['file']}", 'wb') as out_file:
+                    out_file.write(row['content'])
+                names.add(row['name'])
+        return len(names)
+
+    def stats(self):
+        with self.connect() as db:
+            counts = {row['status']: row['count'] for row in db.execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status')}
+            workers = {row['worker']: row['count'] for row in db.execute("SELECT worker, COUNT(*) AS count FROM jobs WHERE status = 'done' GROUP BY worker")}
+            retried = db.execute('SELECT COUNT(*) FROM jobs WHERE attempts > 1').fetchone()[0]
+        return {'jobs': counts, 'done_by_worker': workers, 'retried': retried}
+
+    def failures(self):
+        with self.connect() as db:
+            return {row['name']: row['error'] for row in db.execute("SELECT name, error FROM jobs WHERE status = 'failed'")}
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Reports on a work queue and merges its results')
+    parser.add_argument('-q', '--queue', type=str, default='./work_queue.db', help="The work queue file")
+    parser.add_argument('-m', '--merge', type=str, default=None, help="Write every finished jobs outputs into this results tree")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    queue = WorkQueue(args.queue)
+    print(json.dumps(queue.stats(), indent=2))
+    if args.merge:
+        print(f"Merged {queue.merge(args.merge)} jobs into {args.merge}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# Corpus prewarm
+# Every cache a sweep relies on (PyPI metadata, the module version lists per Python version) is otherwise filled
+# lazily, in the middle of timed runs, so the first snippets to import a module pay for looking it up and the
+# durations are skewed towards whichever snippets ran first. The imports of the whole corpus are known before the
+# sweep starts, so this fills the caches up front: every snippets imports are mapped to their PyPI distributions,
+# each distributions metadata is fetched once in parallel, and the version lists are written for each Python version
+# the snippets are likely to run on. The report says how much of the corpus the caches cover.
+#
+#   python prewarm.py -a ../../hard-gists.tar.gz -c ../../pllm_results/csv/summary-all-runs.csv -pc ./pypi_cache -mo ./modules
+#   python test_executor.py -a ../../hard-gists.tar.gz -pc ./pypi_cache -mo ./modules ...
+#
+# Python versions come from the previous runs in -c (with -r versions either side), snippets without one get every
+# version given with -pv.
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers.gist_archive import GistArchive
+from helpers.py_pi_query import PyPIQuery
+from helpers.ref_data import reference
+from helpers.scheduler import AffinityScheduler
+from helpers.snippet_dedup import SnippetDeduplicator
+
+class Prewarm():
+    # pypi_cache: the PyPI metadata folder, modules: the shared version lists folder, both given to test_executor after
+    # jobs: how many PyPI requests and version lists are worked on at once
+    # search_range: Python versions either side of a snippets hinted version to write version lists for
+    # python_versions: versions used for snippets with no hint, defaults to every version in python_versions.json
+    def __init__(self, pypi_cache='./pypi_cache', modules='./modules', jobs=16, search_range=1, python_versions=None, logging=False) -> None:
+        self.pypi = PyPIQuery(logging=False, base_modules=modules, pypi_cache=pypi_cache)
+        self.dedup = SnippetDeduplicator()
+        self.jobs = jobs
+        self.search_range = search_range
+        self.python_versions = python_versions if python_versions else [version['cycle'] for version in reference('python_versions.json')]
+        self.logging = logging
+
+    # The distributions each snippet needs and the Python versions it's likely to run on
+    # name: {'distributions', 'python_versions'}
+    def plan(self, snippets, hints=None):
+        hints = hints if hints else {}
+        plan = {}
+        for name, source in snippets:
+            if type(source) == bytes:
+                source = source.decode('utf-8', errors='replace')
+            hint = hints.get(name, {})
+            # Modules the LLM settled on last time may not be imported under their distribution name
+            modules = self.dedup.import_signature(source) + hint.get('modules', [])
+            distributions = sorted(set(self.pypi.check_module_name(modules))) if modules else []
+            python_versions = self.pypi.get_python_range(hint['python_version'], pyrange=self.search_range) if hint.get('python_version') else self.python_versions
+            plan[name] = {'distributions': distributions, 'python_versions': python_versions}
+        return plan
+
+    # Fetches a distributions metadata unless it's already cached
+    # Returns 'cached', 'found', 'not_on_pypi' or 'failed'
+    def fetch(self, distribution):
+        found, metadata = self.pypi.cache.get(distribution)
+        if found: return 'cached' if metadata is not None else 'not_on_pypi'
+        self.pypi.query_module(distribution)
+        found, metadata = self.pypi.cache.get(distribution)
+        # A failed request isn't cached
+        if not found: return 'failed'
+        if self.logging: print(f"Fetched {distribution}")
+        return 'found' if metadata is not None else 'not_on_pypi'
+
+    # Writes a distributions version list for a Python version, from the cached metadata
+    def write_versions(self, distribution, python_version):
+        try:
+            self.pypi.get_module_specifics({'python_version': python_version, 'python_modules': [distribution]})
+            return True
+        except Exception as e:
+            if self.logging: print(f"Unable to write the {distribution} versions for Python {python_version}: {e}")
+            return False
+
+    def run(self, snippets, hints=None):
+        start = time.perf_counter()
+        plan = self.plan(snippets, hints)
+        distributions = sorted({distribution for details in plan.values() for distribution in details['distributions']})
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            statuses = dict(zip(distributions, pool.map(self.fetch, distributions)))
+        on_pypi = {distribution for distribution, status in statuses.items() if status in ('cached', 'found')}
+
+        # A version list per distribution and Python version, any snippet wanting it shares it
+        pairs = sorted({(distribution, python_version) for details in plan.values() for distribution in details['distributions'] if distribution in on_pypi
+                        for python_version in details['python_versions']})
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            written = sum(pool.map(lambda pair: self.write_versions(*pair), pairs))
+
+        # A snippet is covered when every one of its distributions has an answer, on PyPI or not
+        covered = [name for name, details in plan.items() if all(statuses[distribution] != 'failed' for distribution in details['distributions'])]
+        counts = {status: list(statuses.values()).count(status) for status in ['cached', 'found', 'not_on_pypi', 'failed']}
+        return {
+            'snippets': len(plan),
+            'snippets_with_imports': len([details for details in plan.values() if details['distributions']]),
+            'distributions': len(distributions),
+            'already_cached': counts['cached'],
+            'fetched': counts['found'],
+            'not_on_pypi': counts['not_on_pypi'],
+            'failed': counts['failed'],
+            'version_lists': written,
+            'version_list_failures': len(pairs) - written,
+            'covered_snippets': len(covered),
+            'coverage': len(covered) / len(plan) if plan else 0.0,
+            'wall_time': time.perf_counter() - start,
+            'failed_distributions': sorted(distribution for distribution, status in statuses.items() if status == 'failed'),
+        }
+
+# Prints the coverage report
+def print_report(report):
+    print(f"Snippets: {report['snippets']} ({report['snippets_with_imports']} with imports) | Distributions: {report['distributions']} | Wall time: {report['wall_time']:.1f}s")
+    print(f"Metadata: {report['already_cached']} already cached, {report['fetched']} fetched, {report['not_on_pypi']} not on PyPI, {report['failed']} failed")
+    print(f"Version lists: {report['version_lists']} written, {report['version_list_failures']} failed")
+    print(f"Coverage: {report['covered_snippets']}/{report['snippets']} snippets ({report['coverage']:.1%}) have every distribution cached")
+    if report['failed_distributions']:
+        print(f"Failed, run again to retry: {', '.join(report['failed_distributions'][:50])}")
+
+# Handle argument parsing
+def process_args():
+    parser = argparse.ArgumentParser(description='Fills the PyPI metadata cache and shared module version lists for a corpus before a sweep')
+    parser.add_argument('-a', '--archive', type=str, default='../../hard-gists.tar.gz', help="The gist archive to prewarm for")
+    parser.add_argument('-g', '--gists', type=str, default=None, help="Only the gists listed in this file, one per line")
+    parser.add_argument('-n', '--limit', type=int, default=None, help="Only the first n snippets")
+    parser.add_argument('-c', '--csv', type=str, default='../../pllm_results/csv/summary-all-runs.csv', help="Previous results, used for Python version and module hints")
+    parser.add_argument('-pc', '--pypi-cache', type=str, default='./pypi_cache', help="The PyPI metadata folder to fill, defaults to ./pypi_cache")
+    parser.add_argument('-mo', '--modules', type=str, default='./modules', help="The shared module version lists folder to fill, defaults to ./modules")
+    parser.add_argument('-j', '--jobs', type=int, default=16, help="How many PyPI requests are made at once, defaults to 16")
+    parser.add_argument('-r', '--range', type=int, default=1, help="Python versions either side of a hinted version to write version lists for, defaults to 1")
+    parser.add_argument('-pv', '--python-versions', type=str, default=None, help="Comma separated Python versions for snippets without a hint, defaults to every known version")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write the report as JSON to this file")
+    parser.add_argument('-v', '--verbose', action="store_true", help="Show each distribution as it's fetched")
+    return parser.parse_args()
+
+def main():
+    args = process_args()
+    archive = GistArchive(args.archive)
+    names = None
+    if args.gists:
+        with open(args.gists, 'r') as file:
+            names = [line.strip().split('/')[-1] for line in file if line.strip()]
+    snippets = list(archive.snippets(names))
+    if args.limit: snippets = snippets[:args.limit]
+    hints = AffinityScheduler().load_hints(args.csv) if args.csv and os.path.isfile(args.csv) else {}
+
+    prewarm = Prewarm(pypi_cache=args.pypi_cache, modules=args.modules, jobs=args.jobs, search_range=args.range,
+                      python_versions=args.python_versions.split(',') if args.python_versions else None, logging=args.verbose)
+    report = prewarm.run(snippets, hints)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
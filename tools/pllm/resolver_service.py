@@ -0,0 +1,236 @@
+# Resolver service
+# Runs test_executor as a long running daemon with a local HTTP job API, instead of a cold
+# `python test_executor.py -f ...` process per snippet. The reference data, client libraries, Ollama model (with
+# --keep-alive), PyPI version files and the Docker probe/wheelhouse containers stay warm between jobs, and any tool
+# can submit snippets to the same resolver.
+#
+#   POST /jobs                  {"file": "/path/to/snippet.py"} or {"name": "my-gist", "source": "import numpy..."}
+#   GET  /jobs                  every job and its status
+#   GET  /jobs/<id>             status (queued, running, done or failed) and, once done, the result per Python version
+#   GET  /jobs/<id>/events      each iteration as a line of JSON, as it finishes, until the job is done
+#
+# Every other option (model, executor, loop, range...) is a test_executor flag, used for every job.
+import argparse
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import test_executor
+from helpers.gist_archive import GistArchive
+
+# Characters a job name can't use in its folder name
+UNSAFE_NAME = re.compile(r'[^A-Za-z0-9._-]+')
+
+class Job():
+    def __init__(self, file=None) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.file = file
+        self.status = 'queued'
+        self.error = None
+        self.events = []
+        self.results = {}
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def details(self):
+        return {'id': self.id, 'file': self.file, 'status': self.status, 'error': self.error, 'submitted': self.submitted,
+                'started': self.started, 'finished': self.finished, 'iterations': len(self.events), 'results': self.results}
+
+class ResolverService():
+    # args: test_executor arguments used for every job
+    # workers: how many jobs run at once, each job still runs a process per Python version
+    # base_modules: PyPI version files shared by every job, rather than a modules folder per snippet
+    def __init__(self, args, workers=1, base_modules=None, logging=False) -> None:
+        self.args = args
+        self.workers = workers
+        self.base_modules = base_modules if base_modules else f"{args.output}/modules"
+        self.logging = logging
+        self.jobs = {}
+        self.pending = queue.Queue()
+        # Notified whenever a job changes or has a new event
+        self.changed = threading.Condition()
+        # Snippets sent as source are laid out like archive mode, <output>/<name>/snippet.py
+        self.archive = GistArchive(None)
+
+    # Queues a snippet, either a file already on disk or source, copied into the jobs own folder in the results tree
+    # <output>/<name>-<job id>/snippet.py, so a job never sees another jobs outputs, even one with the same name
+    def submit(self, file=None, source=None, name=None):
+        if source is None:
+            if not file or not os.path.isfile(file):
+                raise ValueError(f"No snippet at {file}")
+            with open(file, 'r', errors='replace') as in_file:
+                source = in_file.read()
+            name = name if name else os.path.basename(os.path.dirname(os.path.abspath(file)))
+        job = Job()
+        # The name only labels the folder, anything that could leave the results tree is replaced
+        name = UNSAFE_NAME.sub('_', name).strip('._') if name else ''
+        folder = f"{name}-{job.id}" if name else job.id
+        job.file = os.path.abspath(self.archive.write_snippet(self.args.output, folder, source.encode('utf-8')))
+        with self.changed:
+            self.jobs[job.id] = job
+        self.pending.put(job)
+        return job
+
+    def update(self, job, **changes):
+        with self.changed:
+            for key, value in changes.items():
+                setattr(job, key, value)
+            self.changed.notify_all()
+
+    # Blocks until the job has more than `seen` events or is finished, returns the new events and whether it's finished
+    def wait_events(self, job, seen, timeout=30):
+        with self.changed:
+            self.changed.wait_for(lambda: len(job.events) > seen or job.status in ('done', 'failed'), timeout=timeout)
+            return job.events[seen:], job.status in ('done', 'failed')
+
+    # Moves the iterations reported by a jobs processes onto the job, until the job is finished
+    def pump_events(self, job, events, running):
+        while running.is_set() or not events.empty():
+            try:
+                event = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.changed:
+                job.events.append(event)
+                self.changed.notify_all()
+
+    # The result_<python version>.json files the job wrote
+    def collect_results(self, job):
+        results = {}
+        for file in glob.glob(f"{os.path.dirname(job.file)}/result_*.json"):
+            with open(file, 'r') as in_file:
+                results[os.path.basename(file)[len('result_'):-len('.json')]] = json.load(in_file)
+        return results
+
+    def run_job(self, job):
+        self.update(job, status='running', started=time.time())
+        events = test_executor.snippet_context().Queue()
+        running = threading.Event()
+        running.set()
+        pump = threading.Thread(target=self.pump_events, args=(job, events, running), daemon=True)
+        pump.start()
+        # Each job runs in its own process, jobs running at once would otherwise share the tracer and LLM metrics
+        try:
+            error = test_executor.run_snippet_process(self.args, job.file, base_modules=self.base_modules, events=events)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        status = 'failed' if error else 'done'
+        running.clear()
+        pump.join()
+        self.update(job, status=status, error=error, results=self.collect_results(job), finished=time.time())
+        if self.logging: print(f"Job {job.id} {status}")
+
+    def worker(self):
+        while True:
+            job = self.pending.get()
+            self.run_job(job)
+
+    def start(self):
+        os.makedirs(self.args.output, exist_ok=True)
+        test_executor.preload_workers(self.args)
+        for i in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+# HTTP front end for a ResolverService
+class JobHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def find_job(self, job_id):
+        job = self.service.jobs.get(job_id)
+        if job is None: self.send_json(404, {'error': f"No job {job_id}"})
+        return job
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': f"Unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job = self.service.submit(file=body.get('file'), source=body.get('source'), name=body.get('name'))
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(201, job.details())
+
+    def do_GET(self):
+        parts = [part for part in self.path.split('/') if part]
+        if parts == ['jobs']:
+            with self.service.changed:
+                jobs = [job.details() for job in self.service.jobs.values()]
+            return self.send_json(200, jobs)
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self.find_job(parts[1])
+            if job: self.send_json(200, job.details())
+            return
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self.find_job(parts[1])
+            if job: self.stream_events(job)
+            return
+        self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+    # Newline delimited JSON, one line per iteration, the connection closes once the job is finished
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        seen = 0
+        finished = False
+        while not finished:
+            events, finished = self.service.wait_events(job, seen)
+            seen += len(events)
+            try:
+                for event in events:
+                    self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+        self.wfile.write((json.dumps({'status': job.status, 'results': job.results}) + '\n').encode('utf-8'))
+
+    def log_message(self, format, *args):
+        if self.service.logging: super().log_message(format, *args)
+
+# Handle argument parsing
+# The service options are long flags only, everything else is passed on to test_executor
+def process_args():
+    parser = argparse.ArgumentParser(description='Runs test_executor as a service with a local job API, other flags are passed to test_executor')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="The address to listen on, defaults to 127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765, help="The port to listen on, defaults to 8765")
+    parser.add_argument('--jobs', type=int, default=1, help="How many snippets are resolved at once, defaults to 1")
+    parser.add_argument('--modules', type=str, default=None, help="PyPI version files shared by every job, defaults to a modules folder in the results tree")
+    args, executor_args = parser.parse_known_args()
+    return args, test_executor.process_args(executor_args)
+
+def main():
+    args, executor_args = process_args()
+    test_executor.tracer.enabled = executor_args.trace
+    test_executor.llm_metrics.enabled = executor_args.llm_metrics
+
+    service = ResolverService(executor_args, workers=args.jobs, base_modules=args.modules, logging=executor_args.verbose)
+    service.start()
+    JobHandler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), JobHandler)
+    print(f"Resolver listening on http://{args.host}:{args.port}, results in {executor_args.output}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if executor_args.keep_alive:
+            test_executor.OllamaHelperBase(base_url=executor_args.base, model=executor_args.model, logging=True, keep_alive=executor_args.keep_alive).release()
+
+if __name__ == "__main__":
+    main()
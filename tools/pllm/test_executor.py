@@ -1,27 +1,61 @@
 # Python file to validate a full paththrough
 # Everything should be automated through this file
 import argparse
+import gc
 import json
+import os
 import time
 import multiprocessing as mp
+import queue
+from functools import partial
 from multiprocessing import Process
 
-from helpers.ollama_helper_tester import OllamaHelper
+from helpers.ollama_helper_base import OllamaHelperBase
+from helpers.ollama_helper_tester import OllamaHelper, preload_prompts
 from helpers.py_pi_query import PyPIQuery
 from helpers.build_dockerfile import DockerHelper
+from helpers.venv_helper import VenvHelper
 from helpers.deps_scraper import DepsScraper
+from helpers.gist_archive import GistArchive
+from helpers.snippet_dedup import SnippetDeduplicator
+from helpers.ref_data import preload
+from helpers.tracer import tracer
+from helpers.llm_metrics import llm_metrics
+from helpers.resources import AdmissionController, DEFAULT_RESERVE, peak_rss
+from helpers.checkpoint import Checkpoint
+from helpers.error_fingerprint import LoopDetector, fingerprint
+from helpers.version_window import version_key
+from helpers.log_excerpt import POLICIES
+from helpers.resolution_probe import attribute_failure, summarise
 
 class TestExecutor():
 
-    def __init__(self, base_url="http://localhost:11434", model='gemma2', logging=True, temp=0.7, end_loop=5, search_range=1, base_modules='./modules') -> None:
+    # ollama_helper, pypi and backend can be swapped for stand-ins (see benchmark.py)
+    # backend is any callable taking logging=... and returning an ExecutionBackend (DockerHelper, VenvHelper...)
+    # probe: resolve the pins with a pip dry-run before each build (see helpers/resolution_probe.py)
+    # version_budget: tokens the module versions in a RAG prompt may use, 0 sends every version (see helpers/version_window.py)
+    # structured: constrain the models output to the expected JSON schema, keep_alive: how long Ollama keeps the model loaded (see helpers/ollama_helper_base.py)
+    # events: a multiprocessing queue each iteration is reported on as it finishes (see resolver_service.py)
+    # loop_repeats: how many identical failures in a row count as going round in circles, 0 turns loop detection off (see helpers/error_fingerprint.py)
+    # excerpt_policy, excerpt_budget: how logs are cut down for the error prompts (see helpers/log_excerpt.py)
+    # pypi_cache: folder of PyPI metadata kept between runs, filled ahead of a sweep by prewarm.py (see helpers/pypi_cache.py)
+    def __init__(self, base_url="http://localhost:11434", model='gemma2', logging=True, temp=0.7, end_loop=5, search_range=1, base_modules='./modules', ollama_helper=None, pypi=None, backend=DockerHelper, probe=False, version_budget=150, structured=False, keep_alive=None, events=None, loop_repeats=3, excerpt_policy='decisive', excerpt_budget=400, pypi_cache=None) -> None:
         # Initiate instance of Ollama helper and PyPi Query
         print(f'Running model- {model} with temp {temp}. Looping {end_loop} times with a search range of {search_range}')
-        self.ollama_helper = OllamaHelper(base_url=base_url, model=model, logging=logging, temp=temp, base_modules=base_modules)
-        self.pypi = PyPIQuery(logging=True, base_modules=base_modules)
+        self.ollama_helper = ollama_helper if ollama_helper else OllamaHelper(base_url=base_url, model=model, logging=logging, temp=temp, base_modules=base_modules, version_budget=version_budget, structured=structured, keep_alive=keep_alive, excerpt_policy=excerpt_policy, excerpt_budget=excerpt_budget, pypi_cache=pypi_cache)
+        self.pypi = pypi if pypi else PyPIQuery(logging=True, base_modules=base_modules, pypi_cache=pypi_cache)
         self.deps = DepsScraper(logging=True)
+        self.backend = backend
+        self.probe = probe
+        self.events = events
         self.end_loop = end_loop
         self.search_range = search_range
+        self.loop_repeats = loop_repeats
+        self.detector = None
         self.start_time = time.time()
+        # Where each worker process saves its iteration state, set once the process knows its snippet and Python version
+        self.checkpoint = None
+        self.checkpoint_name = None
         pass
 
     # Defines JSONObject dictionary for dot notation
@@ -40,7 +74,8 @@ class TestExecutor():
 
     def evaluate_file(self, llm, file):
         # First LLM pass- Evaluates the Python file and gives us the initial JSON
-        llm_eval = llm.evaluate_file(file)
+        with tracer.span('evaluate_file'):
+            llm_eval = llm.evaluate_file(file)
         llm_eval['python_version'] = str(llm_eval['python_version'])
 
         # Should normally be a list. Re-format to a list if it is a dict.
@@ -53,23 +88,84 @@ class TestExecutor():
 
         return llm_eval
 
+    # Gets the initial set of assumptions for a snippet before any builds happen
+    # Combines the simple import search (RAG) with the LLMs evaluation of the file
+    # Falls back to Python 3.8 and the simple search if the LLM never returns anything usable
+    def initial_evaluation(self, file, rag=True):
+        llm_eval = None
+        llm_details = False
+        loop = 0
+
+        # Use a simple search to grab imports from file without the LLM
+        python_deps = []
+        if rag:
+            python_deps = self.deps.find_word_in_file(file, 'import', [])
+
+        # Loop to ensure we handle invalid responses from the model
+        while not llm_details:
+            try:
+                # Evaluate the file to get an initial set of assumptions
+                llm_eval = self.evaluate_file(self.ollama_helper, file)
+
+                # Run through all the dependencies and clean them for use. Removes useless imports
+                python_deps = self.pypi.check_module_name(python_deps + llm_eval['python_modules'])
+
+                # Combine the simple search modules with the LLMs suggestions.
+                llm_eval['python_modules'] = python_deps
+
+                print(llm_eval)
+                llm_details = True
+            except Exception as e:
+                print(f"Failed to get Python modules from file: {e}")
+                llm_details = False
+                loop += 1
+
+            if loop >= 5: break
+        # If the LLM didn't return anything, set the Python version to 3.8
+        if not llm_details:
+            llm_eval = {'python_version': '3.8'}
+            llm_eval['python_modules'] = self.pypi.check_module_name(python_deps)
+
+        return llm_eval
+
     def get_module_specifics(self, llm, llm_eval):
         # Uses the modules from the LLM output to get a specific set of versions for the inferred Python version
         # Also returns an updated python version, based on what the model had provided
-        llm_eval['python_modules'], llm_eval['python_version'] = llm.pypi.get_module_specifics(llm_eval)
-        
-        module_versions = llm.get_module_versions(llm_eval)
-        llm_eval['python_modules'] = module_versions
+        with tracer.span('get_module_specifics', python_version=llm_eval['python_version']):
+            llm_eval['python_modules'], llm_eval['python_version'] = llm.pypi.get_module_specifics(llm_eval)
+
+            with tracer.span('get_module_versions', python_version=llm_eval['python_version']):
+                module_versions = llm.get_module_versions(llm_eval)
+            llm_eval['python_modules'] = module_versions
 
         return llm_eval
 
-    def build_container(self, dockerHelper, llm, llm_eval, file, error_details = {}):
-        # Build the docker image with the given JSON and file/ paths
-        dockerHelper.create_dockerfile(llm_eval, file)
-        passed, docker_build_output = dockerHelper.build_dockerfile(file)
+    def build_container(self, backend, llm, llm_eval, file, error_details = {}):
+        # Build the environment (docker image, venv...) with the given JSON and file/ paths
+        with tracer.span('create_dockerfile'):
+            backend.create_environment(llm_eval, file)
+        # Check the pins resolve together before paying for a full build
+        if self.probe:
+            with tracer.span('probe_environment', python_version=llm_eval['python_version']) as span:
+                probe = backend.probe_environment(llm_eval)
+                span['args']['passed'] = probe['passed'] if probe else None
+            if probe and not probe['passed']:
+                print(probe['output'])
+                output, error_type = llm.process_error(probe['output'], error_details, llm_eval, conflicts=probe['conflicts'])
+                print(f"resolution probe failed!")
+                return False, probe['output'], output, error_type
+        with tracer.span('build_dockerfile', python_version=llm_eval['python_version']) as span:
+            passed, docker_build_output = backend.build_environment(file)
+            span['args']['passed'] = passed
         if not passed:
             print(docker_build_output)
-            output, error_type = llm.process_error(docker_build_output, error_details, llm_eval)
+            conflicts = None
+            if backend.install_mode == 'single':
+                # pip saw every pin at once, work out which of them failed from its full output
+                conflicts = attribute_failure(backend.build_log if backend.build_log else docker_build_output, backend.get_pins(llm_eval))
+                if conflicts:
+                    docker_build_output = f"{summarise(conflicts, llm_eval['python_version'])}\n{docker_build_output}"
+            output, error_type = llm.process_error(docker_build_output, error_details, llm_eval, conflicts=conflicts, install_mode=backend.install_mode)
             print(f"docker build failed!")
             return False, docker_build_output, output, error_type
         else:
@@ -93,6 +189,14 @@ class TestExecutor():
         return error_handler
 
 
+    # Records the pins of a build that passed as known good versions
+    def record_built(self, error_handler, llm_eval):
+        built = error_handler.setdefault('built_modules', {})
+        for module, version in llm_eval['python_modules'].items():
+            if type(version) == str and version not in built.setdefault(module, []):
+                built[module].append(version)
+        return error_handler
+
     # Update the llm details
     # Set previous modules, so our output is correct
     # Removes and adds modules based on the new module returned by the LLM
@@ -131,20 +235,40 @@ class TestExecutor():
     # Main docker process loop
     # This method is given as a process to run in parallel with each other
     # Handles the main loop of building | running | validating
-    def docker_create_process(self, ollama_helper, llm_eval, file, process_num):
+    # warm_start: module pins that already worked for a snippet with the same imports, skips the LLMs version selection
+    # resume: the state from this Python versions checkpoint, carries on from its last iteration (see helpers/checkpoint.py)
+    def docker_create_process(self, ollama_helper, llm_eval, file, process_num, warm_start=None, resume=None):
+        # Worker processes only export their own spans and LLM calls, the parent's are exported by main
+        if mp.parent_process() is not None:
+            tracer.reset()
+            llm_metrics.reset()
         # Create the YAML file in the same folder as the snippet
-        dockerHelper = DockerHelper(logging=True)
+        backend = self.backend(logging=True)
+        # Get the project folder so we can write out our data and checkpoint files
+        project_dir, dir_name, project_file = backend.get_project_dir(file)
+        # Checkpoints are named by the Python version the process started with, get_module_specifics can change it
+        self.checkpoint = Checkpoint(project_dir)
+        self.checkpoint_name = llm_eval['python_version']
+        self.detector = LoopDetector(repeats=self.loop_repeats, logging=True).restore(resume.get('loop_detector') if resume else None)
 
         # Get a set of modules, based on the evaluation
         # Also pull down working versions from PyPi at the same time.
-        llm_eval = self.get_module_specifics(ollama_helper, llm_eval)
+        if resume:
+            print(f"Resuming Python {self.checkpoint_name} at iteration {resume['loop']}")
+            llm_eval = resume['llm_eval']
+        elif warm_start:
+            llm_eval['python_modules'] = dict(warm_start)
+        else:
+            llm_eval = self.get_module_specifics(ollama_helper, llm_eval)
 
         print(llm_eval)
 
         # Dictionary to store erroring module versions and keep a list of error types
-        error_handler = {
+        error_handler = resume['error_handler'] if resume else {
             'previous': '',
             'error_modules': {},
+            # Versions of each module that have built, kept in the versions shown to the LLM
+            'built_modules': {},
             'ImportError': 0,
             'ModuleNotFound': 0,
             'VersionNotFound': 0,
@@ -152,29 +276,33 @@ class TestExecutor():
             'AttributeError': 0,
             'NonZeroCode': 0,
             'SyntaxError': 0,
+            'OutOfMemory': 0,
         }
 
-        # Get the project folder so we can write out our data file
-        project_dir, dir_name, project_file = dockerHelper.get_project_dir(file)
         # File to open is unique based on the python version
         file_to_open = f"{project_dir}/output_data_{llm_eval['python_version']}.yml"
 
-        # Output to the log file
-        output_file = open(file_to_open, "a")
-        output_file.write('---\n')
-        output_file.write(f"python_version: {llm_eval['python_version']}\n")
-        output_file.write(f"start_time: {self.start_time}\n")
-        output_file.write('iterations:\n')
-        output_file.close()
+        # Output to the log file, a resumed run carries on with the iterations it already logged
+        if not resume:
+            self.save_checkpoint(llm_eval, error_handler, 1, 'Unknown')
+            output_file = open(file_to_open, "a")
+            output_file.write('---\n')
+            output_file.write(f"python_version: {llm_eval['python_version']}\n")
+            output_file.write(f"start_time: {self.start_time}\n")
+            output_file.write('iterations:\n')
+            output_file.close()
         # Build loop
         run_complete = False
         build_complete = False
         # job_complete = False
-        loop = 1
-        error_type = 'Unknown'  # Initialize error_type to avoid UnboundLocalError
+        loop = resume['loop'] if resume else 1
 
         while not run_complete:
             error = ''
+            # Set each iteration, so a failure part way is never logged or fingerprinted with the previous iterations output
+            output = None
+            docker_output = ''
+            error_type = 'Unknown'
             try:
                 print(f"In process {process_num}")
                 # time.sleep(5)
@@ -182,7 +310,7 @@ class TestExecutor():
                 while not build_complete:
                     # Build the container and report any error that may occur during the build
                     # Returns if the build completed, docker output (error), output (details from the LLM) and the error type
-                    build_complete, docker_output, output, error_type = self.build_container(dockerHelper, ollama_helper, llm_eval, file, error_handler)
+                    build_complete, docker_output, output, error_type = self.build_container(backend, ollama_helper, llm_eval, file, error_handler)
                     # If the build failed, handle the error
                     if not build_complete:
                         # Update error_handler with any failing module and version
@@ -190,17 +318,28 @@ class TestExecutor():
                         # Update the LLM details with the information from the build ouput
                         llm_eval = self.update_llm_eval(output, llm_eval)
                         # If we had an import error, and a non zero code, then we may have an ordering issue and need to reshuffle the modules
-                        if error_type == 'ImportError' and 'returned a non-zero code: 1' in docker_output:
+                        # A single install has no order to fix, pip already saw every module together
+                        if error_type == 'ImportError' and 'returned a non-zero code: 1' in docker_output and backend.install_mode != 'single':
                             zero_code_module = ollama_helper.non_zero_error(docker_output)
                             llm_eval = self.shuffle_modules(output['module'], zero_code_module, llm_eval)
                         # Given a Non Zero and PATH environment in the output, remove this module as it may be completely erroneous
                         if error_type == 'NonZeroCode' and 'PATH environment' in docker_output:
                             llm_eval['python_modules'].pop(output['module'])
+                        # Out of memory with nothing to wait for, building again would fail the same way
+                        if error_type == 'OutOfMemory' and not self.retry_out_of_memory(backend, error_handler):
+                            loop = self.end_loop
+                        # Going round in circles, change tack or give up early
+                        llm_eval, stop = self.check_loop(error_type, output, docker_output, llm_eval, error_handler)
+                        if stop: loop = self.end_loop
                         # Update the loop number and log the details to the log file
-                        loop = self.end_test(file_to_open, llm_eval, dockerHelper, error_type, docker_output, loop, False)
+                        loop = self.end_test(file_to_open, llm_eval, backend, ollama_helper, error_type, docker_output, loop, False)
+                        self.save_checkpoint(llm_eval, error_handler, loop, error_type)
+
+                self.record_built(error_handler, llm_eval)
 
                 # while not run_complete:
-                docker_output = dockerHelper.run_container_test()
+                with tracer.span('run_container_test', python_version=llm_eval['python_version']):
+                    docker_output = backend.run_test()
                 print(docker_output)
 
                 # Processes Docker run information (after a build has been successul we must run it to see if everything is correct)
@@ -248,18 +387,78 @@ class TestExecutor():
                     run_complete = True
                     error_handler = self.naughty_bois(output, error_handler, error_type, llm_eval)
                     llm_eval = self.update_llm_eval(output, llm_eval)
+                elif 'OutOfMemory' in error_type:
+                    # The image is fine, run it again once there's the memory, unless it will never have it
+                    error_handler = self.naughty_bois(None, error_handler, error_type, llm_eval)
+                    llm_eval = self.update_llm_eval(None, llm_eval)
+                    if not self.retry_out_of_memory(backend, error_handler):
+                        loop = self.end_loop
                 elif 'None' in error_type:
                     run_complete = True
                     llm_eval = self.update_llm_eval(None, llm_eval)
             except Exception as e:
                 print(f"Failed to build container: {e}")
+            if not run_complete:
+                llm_eval, stop = self.check_loop(error_type, output, docker_output, llm_eval, error_handler)
+                if stop: loop = self.end_loop
             # Update the loop number and log the details to the log file
-            loop = self.end_test(file_to_open, llm_eval, dockerHelper, error_type, docker_output, loop, run_complete)
+            loop = self.end_test(file_to_open, llm_eval, backend, ollama_helper, error_type, docker_output, loop, run_complete)
+            self.save_checkpoint(llm_eval, error_handler, loop, error_type)
         
         # If we've left the while loop then we need to make sure everything is killed correctly
         loop = self.end_loop
         # Update the loop number and log the details to the log file
-        self.end_test(file_to_open, llm_eval, dockerHelper, error_type, docker_output, loop, True)
+        self.end_test(file_to_open, llm_eval, backend, ollama_helper, error_type, docker_output, loop, True)
+
+    # Whether an OutOfMemory is worth trying again with the same pins
+    # Retried while admission control shows the host is short of memory, the next build or run then waits for it
+    # Otherwise under a --memory-limit the snippet needs more than the limit and fails the same way every time,
+    # so it stops. Without a limit the first is retried, other processes may have been using the memory
+    def retry_out_of_memory(self, backend, error_handler):
+        if backend.admission is not None and not backend.admission.memory_ok():
+            print('Out of memory while the host is short of memory, trying again once there is more')
+            return True
+        if getattr(backend, 'memory_limit', None) or error_handler['OutOfMemory'] > 1:
+            print('Out of memory with memory to spare on the host, stopping as it will keep happening')
+            return False
+        return True
+
+    # Saves where this process is up to, the next iteration to run and everything it needs to run it
+    def save_checkpoint(self, llm_eval, error_handler, loop, error_type):
+        self.checkpoint.save(self.checkpoint_name, llm_eval=llm_eval, error_handler=error_handler, loop=loop, error_type=error_type, loop_detector=self.detector.state())
+
+    # Fingerprints a failure and escalates if the recent failures repeat or cycle
+    # 'switch' replaces the modules version with the newest one that hasn't failed, 'drop' removes the module and 'stop' ends the loop
+    # Returns the updated llm_eval and whether to stop
+    def check_loop(self, error_type, output, docker_output, llm_eval, error_handler):
+        module = output.get('module') if type(output) == dict else None
+        # The LLM may have already removed the module, then there's nothing to switch or drop
+        action = self.detector.add(fingerprint(error_type, module, docker_output if docker_output else ''), has_module=module in llm_eval['python_modules'])
+        if action is None: return llm_eval, False
+        with tracer.span('loop_detected', error_type=error_type, module=module, action=action):
+            if action == 'switch':
+                version = self.fallback_version(module, llm_eval, error_handler)
+                if version:
+                    print(f"Switching {module} to {version}, the newest version that hasn't failed")
+                    llm_eval['python_modules'][module] = version
+                    return llm_eval, False
+                action = 'drop'
+            if action == 'drop':
+                print(f"Dropping {module}, it keeps failing the same way")
+                llm_eval['python_modules'].pop(module)
+                return llm_eval, False
+        print('Stopping early, the same failure keeps coming back')
+        return llm_eval, True
+
+    # The newest version of a module that hasn't failed, preferring versions released in the Python versions window
+    def fallback_version(self, module, llm_eval, error_handler):
+        failed = set(error_handler['error_modules'].get(module, [])) | {llm_eval['python_modules'].get(module)}
+        versions = [version.strip() for version in self.pypi.read_module_file(module, llm_eval['python_version']).split(',') if version.strip()]
+        versions = [version for version in versions if version not in failed]
+        dates = self.pypi.read_module_dates(module, llm_eval['python_version'])
+        in_window = [version for version in versions if dates.get(version, {}).get('in_window')]
+        candidates = in_window if in_window else versions
+        return sorted(candidates, key=version_key)[-1] if candidates else None
 
     # Logging specific, ensures correct spaces in log file to avoid later errors
     def ensure_8_spaces(self, line):
@@ -286,7 +485,53 @@ class TestExecutor():
         return line
 
     # Handles the logging of the error messages and iterations to the log file
-    def end_test(self, file_to_open, llm_eval, dockerHelper, error_type, docker_message, loop, run_complete):
+    # ollama_helper is the processes own, it holds what its error handling did (e.g. how much the logs were excerpted)
+    def end_test(self, file_to_open, llm_eval, backend, ollama_helper, error_type, docker_message, loop, run_complete):
+        with tracer.span('end_test', iteration=loop, error_type=error_type):
+            self.write_iteration(file_to_open, llm_eval, error_type, docker_message, loop)
+        print(loop)
+        finished = loop + 1 > self.end_loop or run_complete
+        if self.events is not None:
+            self.events.put({'python_version': llm_eval['python_version'], 'iteration': loop, 'error_type': error_type,
+                             'python_modules': llm_eval['python_modules'], 'finished': bool(finished), 'passed': bool(run_complete) and error_type == 'None'})
+        if finished:
+            end_time = time.time()
+            out_file = open(file_to_open, "a")
+            out_file.write(f'end_time: {end_time}\n')
+            out_file.write(f'total_time: {end_time - self.start_time}')
+            out_file.close()
+            backend.cleanup()
+            # Machine readable outcome next to the log file, e.g. result_3.7.json, used to share results between duplicate snippets
+            self.write_result(file_to_open.replace('output_data_', 'result_').replace('.yml', '.json'), llm_eval, backend, ollama_helper, error_type, loop, run_complete)
+            # Export this processes spans next to the log file, e.g. trace_3.7.json
+            tracer.export(file_to_open.replace('output_data_', 'trace_').replace('.yml', '.json'), {'file': file_to_open, 'iterations': loop})
+            # and its LLM calls, e.g. llm_metrics_3.7.json
+            llm_metrics.export(file_to_open.replace('output_data_', 'llm_metrics_').replace('.yml', '.json'), {'file': file_to_open, 'iterations': loop})
+            # Nothing left to resume
+            if self.checkpoint: self.checkpoint.save(self.checkpoint_name, finished=True)
+            exit(0)
+        else:
+            return loop + 1
+
+    # Writes the final Python version, modules, whether the snippet ran and how many build steps were cached
+    def write_result(self, result_file, llm_eval, backend, ollama_helper, error_type, loop, run_complete):
+        with open(result_file, 'w') as out_file:
+            json.dump({
+                'python_version': llm_eval['python_version'],
+                'python_modules': llm_eval['python_modules'],
+                'error_type': error_type,
+                'passed': bool(run_complete) and error_type == 'None',
+                'iterations': loop,
+                'cache_hits': backend.cache_hits,
+                'cache_steps': backend.cache_steps,
+                'run_cache_hits': backend.run_cache_hits,
+                'peak_rss': peak_rss(),
+                'loop_escalations': self.detector.escalations if self.detector else [],
+                'log_excerpt': dict(ollama_helper.excerpter.stats, policy=ollama_helper.excerpter.policy, reduction=round(ollama_helper.excerpter.reduction(), 3)),
+            }, out_file, indent=2)
+
+    # Writes a single iteration to the log file
+    def write_iteration(self, file_to_open, llm_eval, error_type, docker_message, loop):
         out_file = open(file_to_open, "a")
         python_modules = llm_eval["previous_python_modules"] if 'previous_python_modules' in llm_eval else llm_eval['python_modules']
         out_file.write(f"  iteration_{loop}:\n")
@@ -306,20 +551,10 @@ class TestExecutor():
                 out_line = self.fix_error_line(out_line)
                 out_file.write(f'{extend}{out_line}')
                 previous_line = line
-        print(loop)
-        if loop + 1 > self.end_loop or run_complete:
-            end_time = time.time()
-            out_file.write(f'end_time: {end_time}\n')
-            out_file.write(f'total_time: {end_time - self.start_time}')
-            out_file.close()
-            dockerHelper.delete_container()
-            dockerHelper.delete_image()
-            exit(0)
-        else:
-            return loop + 1
+        out_file.close()
 
 # Handle argument parsing
-def process_args():
+def process_args(argv=None):
     def str2bool(value):
         """Convert a string representation of a boolean to an actual boolean value."""
         if isinstance(value, bool):
@@ -331,58 +566,96 @@ def process_args():
         else:
             raise argparse.ArgumentTypeError(f'Boolean value expected, got "{value}".')
 
+    def duration(value):
+        """Ollama takes a keep alive as a duration string (30m) or a number of seconds, -1 keeps the model loaded."""
+        return int(value) if value.lstrip('-').isdigit() else value
+
     parser = argparse.ArgumentParser(description='File to evaluate')
     parser.add_argument('-f', '--file', type=str, help="The full path and name of the file to evaluate")
+    parser.add_argument('-a', '--archive', type=str, nargs="?", default=None, help="Run every snippet in a gist archive (e.g. hard-gists.tar.gz) without extracting it, instead of a single file")
+    parser.add_argument('-o', '--output', type=str, nargs="?", default='./results', const='./results', help="Archive mode: the results tree each snippet and its outputs are written to, defaults to ./results")
+    parser.add_argument('-g', '--gists', type=str, nargs="?", default=None, help="Archive mode: a file listing the gists to run (e.g. my_gists.csv), defaults to all of them")
+    parser.add_argument('-n', '--limit', type=int, nargs="?", default=0, const=0, help="Archive mode: stop after this many snippets")
+    parser.add_argument('-d', '--dedup', action="store_true", help="Archive mode: share results between duplicate snippets and warm start snippets with the same imports as one that passed")
+    parser.add_argument('-p', '--pack', type=str, nargs="?", default=None, help="Archive mode: move each finished snippets results into this tar file")
     parser.add_argument('-b', '--base', type=str, nargs="?", default='http://localhost:11434', const='http://localhost:11434', help="The ollama URL can vary depending on the system")
     parser.add_argument('-m', '--model', type=str, nargs="?", default='phi3:medium', const='phi3:medium', help="The name of the model to use for evaluation")
     parser.add_argument('-t', '--temp', type=str, nargs="?", default='0.7', const='0.7', help="The temperature for the models predictive output. Typically a range from 0-2, default is 0.7")
     parser.add_argument('-l', '--loop', type=int, nargs="?", default=5, const=5, help="How many times we will loop to find a solution")
     parser.add_argument('-r', '--range', type=int, nargs="?", default=0, const=0, help="The search range, expands out above and below the found Python version, defaults to 0")
     parser.add_argument('-ra', '--rag', type=str2bool, nargs="?", default=True, const=True, help="Flag to enable RAG in the system.")
+    parser.add_argument('-ka', '--keep-alive', type=duration, nargs="?", default=None, help="Ollama only: load the model before each snippet and keep it loaded this long after each request (e.g. 30m, -1 for always), Ollama's own setting applies again once the run is done")
+    parser.add_argument('-so', '--structured-output', type=str2bool, nargs="?", default=False, const=True, help="Send the expected JSON schema with every LLM request so responses match it, needs Ollama 0.5 or newer")
+    parser.add_argument('-ep', '--excerpt-policy', type=str, choices=POLICIES, nargs="?", default='decisive', const='decisive', help="How build and run logs are cut down before they go in an error prompt: full (as they are), clean (decoded, no ANSI escapes or progress bars) or decisive (just the error lines and innermost traceback frames), defaults to decisive")
+    parser.add_argument('-eb', '--excerpt-budget', type=int, nargs="?", default=400, const=400, help="Tokens a decisive log excerpt may use, the error lines themselves are always kept, defaults to 400")
+    parser.add_argument('-vb', '--version-budget', type=int, nargs="?", default=150, const=150, help="Roughly how many tokens of module versions a RAG prompt may use, 0 sends every version, defaults to 150")
+    parser.add_argument('-pc', '--pypi-cache', type=str, nargs="?", default=None, const='./pypi_cache', help="Keep PyPI metadata in this folder between runs (./pypi_cache if no folder is given), fill it before a sweep with prewarm.py")
+    parser.add_argument('-mo', '--modules', type=str, default=None, help="A modules folder of version lists shared by every snippet (e.g. filled by prewarm.py), defaults to a modules folder next to each snippet")
+    parser.add_argument('-e', '--executor', type=str, nargs="?", default='docker', const='docker', choices=['docker', 'venv'], help="Where snippets are built and run, docker (default) or venv for local interpreters and virtualenvs")
+    parser.add_argument('-pd', '--python-dirs', type=str, nargs="*", default=[], help="venv executor: extra folders containing pythonX.Y interpreters")
+    parser.add_argument('-wh', '--wheelhouse', type=str, nargs="?", default=None, help="venv executor: local folder of wheels to install from")
+    parser.add_argument('-ni', '--no-index', action="store_true", help="venv executor: only install from the wheelhouse, never PyPI")
+    parser.add_argument('-im', '--install-mode', type=str, nargs="?", default='sequential', const='sequential', choices=['sequential', 'single'], help="sequential (default) installs one module at a time, single hands pip every module in one install")
+    parser.add_argument('-pr', '--probe', action="store_true", help="Resolve the pins with pip install --dry-run before each build, Python 3.7 and newer")
+    parser.add_argument('-sw', '--shared-wheels', action="store_true", help="Build pins into a shared wheelhouse and install from it, docker serves it from a local index container, venv needs --wheelhouse")
+    parser.add_argument('-ib', '--image-budget', type=float, nargs="?", default=None, help="docker executor: keep finished images for reuse under this many GB of image disk use, instead of deleting them")
+    parser.add_argument('-bm', '--build-memo', type=str, nargs="?", default=None, const='./build_memo', help="docker executor: remember build outcomes in this folder (./build_memo if no folder is given), a Dockerfile that already failed isn't built again")
+    parser.add_argument('-rc', '--run-cache', type=str, nargs="?", default=None, const='./run_cache', help="docker executor: remember run outcomes in this folder (./run_cache if no folder is given), a snippet that already ran in an identical image isn't run again")
+    parser.add_argument('-ml', '--memory-limit', type=float, nargs="?", default=None, help="docker executor: GB of memory each build and run container may use, a container going over it is reported as OutOfMemory")
+    parser.add_argument('-cl', '--cpu-limit', type=float, nargs="?", default=None, help="docker executor: CPUs each run container may use, builds get the same share of the CPU")
+    parser.add_argument('-mb', '--max-builds', type=int, nargs="?", default=None, help="Most builds and runs at once, across every process sharing the admission folder (./admission)")
+    parser.add_argument('-mf', '--min-free', type=float, nargs="?", default=None, help="GB of host memory to keep available, builds and runs wait until starting one wouldn't go below it")
+    parser.add_argument('-is', '--image-state', type=str, nargs="?", default='./image_cache.json', const='./image_cache.json', help="docker executor: the file tracking retained images, shared by every process")
+    parser.add_argument('-lr', '--loop-repeats', type=int, nargs="?", default=3, const=3, help="How many identical failures in a row (or twice round a short cycle) before changing tack: the newest version that hasn't failed, then dropping the module, then stopping early. 0 turns this off, defaults to 3")
+    parser.add_argument('-rs', '--resume', type=str2bool, nargs="?", default=False, const=True, help="Carry on from a snippets checkpoints (checkpoint_*.json) where a run was stopped, instead of starting again")
+    parser.add_argument('-tr', '--trace', type=str2bool, nargs="?", default=False, const=True, help="Write per-stage tracing spans to trace_*.json files next to the snippet")
+    parser.add_argument('-lm', '--llm-metrics', type=str2bool, nargs="?", default=False, const=True, help="Write each LLM call's tokens, latency, retries and parse failures to llm_metrics_*.json files next to the snippet")
     parser.add_argument('-v', '--verbose', action="store_true", help="Verbose logging of information")
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 # Main loop
-def main():
-    llm_eval = None
-    llm_details = False
-    loop = 0
-    
-    # Process the arguments, file, model ...
-    args = process_args()
-    file_path = '/'.join(args.file.split('/')[:-1])
+# Runs a single snippet, evaluating it and then building/running each Python version in its own process
+# warm_start: a passing result from a snippet with the same imports (see helpers/snippet_dedup.py), used instead of the initial evaluation
+# base_modules: where the PyPI version files are kept, defaults to a modules folder next to the snippet
+# events: a multiprocessing queue the iterations are reported on as they finish
+def run_snippet(args, file, warm_start=None, base_modules=None, events=None):
+    file_path = '/'.join(file.split('/')[:-1])
+    # A modules folder shared by every snippet (e.g. filled by prewarm.py), or one per snippet
+    base_modules = base_modules if base_modules else (args.modules if args.modules else file_path+"/modules")
+    tracer.reset()
+    llm_metrics.reset()
+    # Load the model, or restart its keep alive, before any process needs it
+    if args.keep_alive:
+        OllamaHelperBase(base_url=args.base, model=args.model, logging=True, keep_alive=args.keep_alive).warm_up()
+
+    # Builds and runs queue for a slot while the host is short of memory
+    memory_limit = int(args.memory_limit * 1e9) if args.memory_limit else None
+    admission = None
+    if args.max_builds or args.min_free is not None:
+        admission = AdmissionController(slots=args.max_builds, min_free=int(args.min_free * 1e9) if args.min_free is not None else None,
+                                        reserve=memory_limit if memory_limit else DEFAULT_RESERVE, logging=True)
+
+    # Select where the snippets are built and run
+    backend = partial(DockerHelper, image_budget=int(args.image_budget * 1e9) if args.image_budget else None, image_state=args.image_state, shared_wheels=args.shared_wheels, install_mode=args.install_mode, build_memo=args.build_memo, run_cache=args.run_cache,
+                      memory_limit=memory_limit, cpu_limit=args.cpu_limit, admission=admission)
+    if args.executor == 'venv':
+        backend = partial(VenvHelper, python_dirs=args.python_dirs, wheelhouse=args.wheelhouse, no_index=args.no_index, shared_wheels=args.shared_wheels, install_mode=args.install_mode, admission=admission)
 
     # Create the main 
-    testExecutor = TestExecutor(base_url=args.base, model=args.model, logging=True, temp=args.temp, end_loop=args.loop, search_range=args.range, base_modules=file_path+"/modules")
-    # Use a simple search to grab imports from file without the LLM
-    python_deps = []
-    if args.rag:
-        python_deps = testExecutor.deps.find_word_in_file(args.file, 'import', [])
-
-    # Loop to ensure we handle invalid responses from the model
-    while not llm_details:
-        try:
-            # Evaluate the file to get an initial set of assumptions
-            llm_eval = testExecutor.evaluate_file(testExecutor.ollama_helper, args.file)
-            
-            # Run through all the dependencies and clean them for use. Removes useless imports
-            python_deps = testExecutor.pypi.check_module_name(python_deps + llm_eval['python_modules'])
-
-            # Combine the simple search modules with the LLMs suggestions.
-            llm_eval['python_modules'] = python_deps
-
-            print(llm_eval)
-            llm_details = True
-        except Exception as e:
-            print(f"Failed to get Python modules from file: {e}")
-            llm_details = False
-            loop += 1
-        
-        if loop >= 5: break
-    # If the LLM didn't return anything, set the Python version to 3.8
-    if not llm_details:
-        llm_eval = {'python_version': '3.8'}
-        llm_eval['python_modules'] = testExecutor.pypi.check_module_name(python_deps)
+    testExecutor = TestExecutor(base_url=args.base, model=args.model, logging=True, temp=args.temp, end_loop=args.loop, search_range=args.range, base_modules=base_modules, backend=backend, probe=args.probe, version_budget=args.version_budget, structured=args.structured_output, keep_alive=args.keep_alive, events=events, loop_repeats=args.loop_repeats, excerpt_policy=args.excerpt_policy, excerpt_budget=args.excerpt_budget, pypi_cache=args.pypi_cache)
+    # Get the initial evaluation of the snippet (LLM + simple import search)
+    # With --resume, a snippet that was stopped part way carries on from its checkpoints
+    checkpoint = Checkpoint(file_path)
+    resumed = checkpoint.load('main') if args.resume else None
+    if resumed:
+        print(f"Resuming from the checkpoint of {time.ctime(resumed['time'])}, unfinished: {checkpoint.unfinished()}")
+        llm_eval = resumed['llm_eval']
+    elif warm_start:
+        print(f"Warm starting from Python {warm_start['python_version']} with {warm_start['python_modules']}")
+        llm_eval = {'python_version': warm_start['python_version'], 'python_modules': list(warm_start['python_modules'])}
+    else:
+        llm_eval = testExecutor.initial_evaluation(file, rag=args.rag)
+    checkpoint.save('main', llm_eval=llm_eval)
 
     # testExecutor.docker_create_process(ollama_helper, llm_eval, args.file, 1)
     # Search range is how far either side of the found Python verion we want to look.
@@ -401,20 +674,33 @@ def main():
     # NOTE: CHANGE THIS TO TEST SPECIFIC VERSION
     # python_versions = ['3.8']
 
+    # The processes are forked, so they start with this processes modules and reference data already loaded
+    # Freezing the objects created so far stops the garbage collector touching, and so copying, them in every process
+    gc.freeze()
+
     # Create and start the processes
     for i in range(num_processes):
         run_details = llm_eval.copy()
         # Select a version from the python range
         run_details['python_version'] = python_versions[i]
         # run_details['python_version'] = '3.6'
+        # Only the version the warm start passed on can reuse its pins
+        pins = warm_start['python_modules'] if warm_start and python_versions[i] == warm_start['python_version'] else None
+        # A resumed version carries on from its checkpoint, one that already finished isn't run again
+        state = checkpoint.load(python_versions[i]) if resumed else None
+        if state and state.get('finished'):
+            print(f"Python {python_versions[i]} already finished")
+            continue
         # Give the docker create process, ollama helper, the snippet analysis, python file and the iteration
-        p = mp.Process(
+        p = mp.get_context('fork').Process(
             target=testExecutor.docker_create_process,
             args=(
-                OllamaHelper(base_url=args.base, model=args.model, logging=True, temp=args.temp, base_modules=file_path+"/modules", rag=args.rag),
+                OllamaHelper(base_url=args.base, model=args.model, logging=True, temp=args.temp, base_modules=base_modules, rag=args.rag, version_budget=args.version_budget, structured=args.structured_output, keep_alive=args.keep_alive,
+                             excerpt_policy=args.excerpt_policy, excerpt_budget=args.excerpt_budget, pypi_cache=args.pypi_cache),
                 run_details,
-                args.file,
-                i)
+                file,
+                i),
+            kwargs={'warm_start': pins, 'resume': state}
             )
         processes.append(p)
         p.start()
@@ -429,6 +715,118 @@ def main():
             p.terminate()
         else:
             print("Processing completed without the timeout")
+    # The frozen objects are only worth keeping out of the collector while there are processes sharing them,
+    # archive runs and the services would otherwise keep every earlier snippets objects forever
+    gc.unfreeze()
+
+    # Spans from the initial evaluation, each version process has already written its own
+    tracer.export(f"{file_path}/trace_main.json", {'file': file})
+    llm_metrics.export(f"{file_path}/llm_metrics_main.json", {'file': file})
+
+# Callers running several snippets at once from threads (resolver_service.py, corpus_worker.py) run each one in its
+# own process from a forkserver. Each snippet then has its own tracer and LLM metrics, and its version processes are
+# forked from a single threaded process rather than the threaded caller. The forkserver already has this module
+# and the langchain prompts and parsers every snippet builds loaded, so each process starts warm.
+def snippet_context():
+    context = mp.get_context('forkserver')
+    context.set_forkserver_preload(['test_executor', 'langchain_core.prompts', 'langchain_core.output_parsers'])
+    return context
+
+def snippet_process(args, file, base_modules, events, outcome):
+    preload_workers(args)
+    tracer.enabled = args.trace
+    llm_metrics.enabled = args.llm_metrics
+    error = None
+    try:
+        run_snippet(args, file, base_modules=base_modules, events=events)
+    except BaseException as e:
+        # run_snippet can exit (e.g. no versions found), that's reported as the snippets error
+        error = f"{type(e).__name__}: {e}"
+    outcome.put(error)
+
+# Runs run_snippet in its own process, events must be a queue from snippet_context()
+# Returns None once the snippet has finished, otherwise the error that stopped it
+def run_snippet_process(args, file, base_modules=None, events=None):
+    context = snippet_context()
+    outcome = context.Queue()
+    process = context.Process(target=snippet_process, args=(args, file, base_modules, events, outcome))
+    process.start()
+    process.join()
+    try:
+        return outcome.get(timeout=5)
+    except queue.Empty:
+        return f"Snippet process stopped with exit code {process.exitcode}"
+
+# Streams every snippet out of a gist archive, running each one in a separate results tree
+# Only the current snippet is written to disk, nothing needs extracting or cleaning up between runs
+def run_archive(args):
+    archive = GistArchive(args.archive)
+    names = None
+    if args.gists:
+        with open(args.gists, 'r') as file:
+            names = [line.strip().split('/')[-1] for line in file if line.strip()]
+
+    # Group exact duplicates and snippets with the same imports, the mapping is kept in the results tree
+    dedup = None
+    if args.dedup:
+        os.makedirs(args.output, exist_ok=True)
+        dedup = SnippetDeduplicator().load_or_build(f"{args.output}/dedup_map.json", archive.snippets(names), archive=args.archive, names=names)
+        # The representatives are the first of each group to run, the list can run in a different order to the archive
+        if names: dedup.order(names)
+        print(dedup.summary())
+
+    # Follow the order of the list (e.g. from helpers/scheduler.py), the archive can only be streamed in its own order
+    snippets = archive.snippets_in_order(names) if names else archive.snippets()
+
+    # Snippets already packed into the results archive no longer have a folder in the results tree
+    packed = archive.packed(args.pack) if args.pack else set()
+
+    count = 0
+    for name, source in snippets:
+        if archive.is_done(args.output, name, packed):
+            print(f"Skipping {name}, already has results")
+            continue
+        # A snippet stopped part way is started again from scratch unless it's resumed, its logs would otherwise get a second run appended
+        if not args.resume: archive.clear_results(args.output, name)
+        file = archive.write_snippet(args.output, name, source)
+        duplicate_of = dedup.duplicate_of(name) if dedup else None
+        if duplicate_of and archive.is_done(args.output, duplicate_of, packed):
+            # Exact duplicates share the representatives outputs instead of running again
+            print(f"{name} is a duplicate of {duplicate_of}, sharing its results")
+            archive.copy_results(args.output, duplicate_of, name, args.pack)
+        else:
+            # Same imports as a snippet that passed, start from its Python version and pins
+            warm_start = archive.load_result(args.output, dedup.warm_start_from(name), args.pack) if dedup else None
+            print(f"Running {name}")
+            run_snippet(args, file, warm_start=warm_start)
+        if args.pack and archive.pack_results(args.output, name, args.pack):
+            packed.add(name)
+        count += 1
+        if args.limit and count >= args.limit: break
+
+# Loads what every worker process needs before any are forked, so they share it rather than each loading their own
+# The Docker client library is otherwise only imported when a worker creates its DockerHelper, and the prompt classes
+# when a worker builds its first prompt
+def preload_workers(args):
+    preload()
+    preload_prompts()
+    if args.executor == 'docker':
+        import docker
+
+def main():
+    # Process the arguments, file, model ...
+    args = process_args()
+    preload_workers(args)
+    tracer.enabled = args.trace
+    llm_metrics.enabled = args.llm_metrics
+
+    if args.archive:
+        run_archive(args)
+    else:
+        run_snippet(args, args.file)
+
+    if args.keep_alive:
+        OllamaHelperBase(base_url=args.base, model=args.model, logging=True, keep_alive=args.keep_alive).release()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,24 @@
+# Tests for the build and run error classification (classify_error in helpers/ollama_helper_tester.py)
+# Run from the tools/pllm folder: python -m unittest discover -s tests -t .
+import unittest
+
+from helpers.ollama_helper_tester import classify_error
+
+# A package whose setup.py imports a module that isn't installed yet
+SETUP_IMPORT_ERROR = """Collecting pandas==0.20.3
+  error: subprocess-exited-with-error
+  ImportError: No module named 'numpy'
+The command '/bin/sh -c pip install pandas==0.20.3' returned a non-zero code: 1"""
+
+class ClassifyErrorTest(unittest.TestCase):
+    def test_sequential_build_keeps_the_import_error(self):
+        self.assertEqual(classify_error(SETUP_IMPORT_ERROR), 'ImportError')
+
+    def test_single_install_build_failure_is_non_zero_code(self):
+        self.assertEqual(classify_error(SETUP_IMPORT_ERROR, 'single'), 'NonZeroCode')
+
+    def test_single_install_run_import_error(self):
+        self.assertEqual(classify_error("Traceback (most recent call last):\nImportError: cannot import name 'x'", 'single'), 'ImportError')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# Tests for snippet deduplication (helpers/snippet_dedup.py)
+# Run from the tools/pllm folder: python -m unittest discover -s tests -t .
+import json
+import os
+import tempfile
+import unittest
+
+from helpers.snippet_dedup import SnippetDeduplicator
+
+IN_LOOP = "for x in range(3):\n    print(x)\n    total = x\n"
+AFTER_LOOP = "for x in range(3):\n    print(x)\ntotal = x\n"
+
+class SnippetDeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_copies_differing_in_comments_and_blank_lines_are_duplicates(self):
+        dedup = SnippetDeduplicator().build([('a', IN_LOOP), ('b', f"# copied\n{IN_LOOP.replace('print(x)', 'print(x)   ')}\n\n")])
+        self.assertEqual(dedup.duplicate_of('b'), 'a')
+
+    def test_different_block_structure_is_not_a_duplicate(self):
+        dedup = SnippetDeduplicator().build([('a', IN_LOOP), ('b', AFTER_LOOP)])
+        self.assertIsNone(dedup.duplicate_of('b'))
+
+    def test_map_is_built_again_when_the_archive_changes(self):
+        archive = f"{self.folder.name}/gists.tar.gz"
+        mapping = f"{self.folder.name}/dedup_map.json"
+        with open(archive, 'w') as out_file:
+            out_file.write('first')
+        SnippetDeduplicator().load_or_build(mapping, [('a', IN_LOOP), ('b', IN_LOOP)], archive=archive)
+        # Unchanged, the saved map is used and the snippets aren't read
+        self.assertEqual(SnippetDeduplicator().load_or_build(mapping, None, archive=archive).duplicate_of('b'), 'a')
+        with open(archive, 'w') as out_file:
+            out_file.write('second, longer')
+        dedup = SnippetDeduplicator().load_or_build(mapping, [('a', IN_LOOP), ('b', AFTER_LOOP)], archive=archive)
+        self.assertIsNone(dedup.duplicate_of('b'))
+        with open(mapping, 'r') as in_file:
+            self.assertEqual(json.load(in_file)['source']['size'], os.path.getsize(archive))
+
+if __name__ == '__main__':
+    unittest.main()
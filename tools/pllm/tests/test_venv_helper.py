@@ -0,0 +1,38 @@
+# Tests for the venv execution backend (helpers/venv_helper.py)
+# Run from the tools/pllm folder: python -m unittest discover -s tests -t .
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers.venv_helper import VenvHelper, TIMED_OUT
+from helpers.ollama_helper_tester import classify_error
+
+class VenvHelperTest(unittest.TestCase):
+    def test_timeout_is_not_out_of_memory(self):
+        backend = VenvHelper(timeout=0.2)
+        code, output = backend.call(['sleep', '5'])
+        self.assertEqual(code, TIMED_OUT)
+        # The line build_environment reports a failed install with
+        message = f"{output}\nERROR: The command 'pip install numpy==1.16.0' returned a non-zero code: {code}"
+        self.assertNotEqual(classify_error(message), 'OutOfMemory')
+
+    def test_killed_pip_is_out_of_memory(self):
+        message = "Collecting numpy==1.16.0\nERROR: The command 'pip install numpy==1.16.0' returned a non-zero code: -9"
+        self.assertEqual(classify_error(message), 'OutOfMemory')
+        # An older timeout message still carrying -9 isn't
+        self.assertNotEqual(classify_error(f"Timed out after 600 seconds\n{message}"), 'OutOfMemory')
+
+    def test_pyenv_interpreter_matches_the_version_exactly(self):
+        with tempfile.TemporaryDirectory() as home:
+            for version in ['3.1.5', '3.10.4', '3.11.2', '2.7.9', '2.7.18', '3.1.10rc1']:
+                os.makedirs(f"{home}/.pyenv/versions/{version}/bin")
+                open(f"{home}/.pyenv/versions/{version}/bin/python", 'w').close()
+            with mock.patch.dict(os.environ, {'HOME': home}):
+                backend = VenvHelper()
+                self.assertEqual(backend.find_interpreter('3.1'), f"{home}/.pyenv/versions/3.1.5/bin/python")
+                self.assertEqual(backend.find_interpreter('2.7'), f"{home}/.pyenv/versions/2.7.18/bin/python")
+                self.assertEqual(backend.find_interpreter('3.10.4'), f"{home}/.pyenv/versions/3.10.4/bin/python")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+# Tests for the version candidate windows (helpers/version_window.py)
+# Run from the tools/pllm folder: python -m unittest discover -s tests -t .
+import unittest
+
+from helpers.version_window import VersionWindow
+
+# Far more versions than a small budget holds
+VERSIONS = [f"1.{minor}.{patch}" for minor in range(20) for patch in range(10)]
+
+class VersionWindowTest(unittest.TestCase):
+    def test_known_good_versions_are_kept(self):
+        window = VersionWindow(budget=20)
+        selected = window.select(VERSIONS, known_good=['1.0.3', '1.7.5'])
+        self.assertIn('1.0.3', selected)
+        self.assertIn('1.7.5', selected)
+
+    def test_failed_versions_are_never_kept(self):
+        window = VersionWindow(budget=20)
+        self.assertNotIn('1.0.3', window.select(VERSIONS, negatives=['1.0.3'], known_good=['1.0.3']))
+
+    def test_compact_error_keeps_known_good_versions_of_its_module(self):
+        window = VersionWindow(budget=20)
+        error = f"ERROR: Could not find a version that satisfies the requirement numpy==9.9 (from versions: {', '.join(VERSIONS)})"
+        self.assertIn('1.0.3', window.compact_error(error, known_good={'numpy': ['1.0.3']}))
+        self.assertNotIn('1.0.3', window.compact_error(error, known_good={'scipy': ['1.0.3']}))
+
+if __name__ == '__main__':
+    unittest.main()
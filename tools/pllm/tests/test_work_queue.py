@@ -0,0 +1,100 @@
+# Tests for the distributed corpus work queue (helpers/work_queue.py)
+# Run from the tools/pllm folder: python -m unittest discover -s tests -t .
+import os
+import tempfile
+import time
+import unittest
+
+from helpers.work_queue import WorkQueue
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = f"{self.folder.name}/work_queue.db"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def queue(self, lease=600, max_attempts=3):
+        return WorkQueue(self.path, lease=lease, max_attempts=max_attempts)
+
+    # Lets a leases run out without waiting on the real clock for long
+    def expire(self, queue):
+        time.sleep(queue.lease + 0.05)
+
+    def test_enqueue_skips_snippets_already_queued(self):
+        queue = self.queue()
+        self.assertEqual(queue.enqueue([('a', b'import os'), ('a', b'import sys'), ('b', b'import re')]), 2)
+        self.assertEqual(queue.enqueue([('a', b'import json'), ('c', b'import csv')]), 1)
+        self.assertEqual(queue.stats()['jobs'], {'queued': 3})
+        # The first source queued is kept
+        self.assertEqual(queue.claim('w1'), {'name': 'a', 'source': b'import os', 'attempts': 1})
+
+    def test_claim_hands_each_job_to_one_worker(self):
+        queue = self.queue()
+        queue.enqueue([('a', b'1'), ('b', b'2')])
+        first = queue.claim('w1')
+        second = queue.claim('w2')
+        self.assertEqual({first['name'], second['name']}, {'a', 'b'})
+        self.assertIsNone(queue.claim('w3'))
+        self.assertEqual(queue.stats()['jobs'], {'leased': 2})
+
+    def test_expired_lease_is_reassigned(self):
+        queue = self.queue(lease=0.2)
+        queue.enqueue([('a', b'1')])
+        self.assertEqual(queue.claim('w1')['attempts'], 1)
+        self.assertIsNone(queue.claim('w2'))
+        self.expire(queue)
+        job = queue.claim('w2')
+        self.assertEqual((job['name'], job['attempts']), ('a', 2))
+        # The first worker has lost the job
+        self.assertFalse(queue.heartbeat('a', 'w1'))
+        self.assertTrue(queue.heartbeat('a', 'w2'))
+
+    def test_heartbeat_keeps_the_lease(self):
+        queue = self.queue(lease=0.3)
+        queue.enqueue([('a', b'1')])
+        queue.claim('w1')
+        for i in range(3):
+            time.sleep(0.15)
+            self.assertTrue(queue.heartbeat('a', 'w1'))
+        self.assertIsNone(queue.claim('w2'))
+
+    def test_complete_after_losing_the_lease_drops_the_outputs(self):
+        queue = self.queue(lease=0.2)
+        queue.enqueue([('a', b'1')])
+        queue.claim('w1')
+        self.expire(queue)
+        queue.claim('w2')
+        self.assertFalse(queue.complete('a', 'w1', {'result_3.7.json': b'stale'}))
+        self.assertEqual(queue.stats()['jobs'], {'leased': 1})
+        self.assertTrue(queue.complete('a', 'w2', {'result_3.7.json': b'fresh'}))
+        self.assertEqual(queue.stats()['done_by_worker'], {'w2': 1})
+        self.assertEqual(queue.merge(f"{self.folder.name}/results"), 1)
+        with open(f"{self.folder.name}/results/a/result_3.7.json", 'rb') as in_file:
+            self.assertEqual(in_file.read(), b'fresh')
+
+    def test_expired_leases_stop_at_the_attempt_cap(self):
+        queue = self.queue(lease=0.2, max_attempts=2)
+        queue.enqueue([('a', b'1')])
+        queue.claim('w1')
+        self.expire(queue)
+        queue.claim('w2')
+        self.expire(queue)
+        self.assertIsNone(queue.claim('w3'))
+        self.assertEqual(queue.failures(), {'a': 'lease expired'})
+
+    def test_failed_jobs_are_retried_up_to_the_attempt_cap(self):
+        queue = self.queue(max_attempts=2)
+        queue.enqueue([('a', b'1')])
+        queue.claim('w1')
+        queue.fail('a', 'w1', 'SystemExit: 0')
+        self.assertEqual(queue.stats()['jobs'], {'queued': 1})
+        self.assertEqual(queue.claim('w2')['attempts'], 2)
+        queue.fail('a', 'w2', 'SystemExit: 0')
+        self.assertIsNone(queue.claim('w3'))
+        self.assertEqual(queue.failures(), {'a': 'SystemExit: 0'})
+        self.assertEqual(queue.stats()['retried'], 1)
+
+if __name__ == '__main__':
+    unittest.main()